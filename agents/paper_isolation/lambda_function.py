@@ -4,6 +4,11 @@ import base64
 import requests
 import os
 
+# Longest detection budget asked of the API, below API Gateway's 29 s timeout
+API_DEADLINE_MS = 25000
+# Time kept back for the upload, the response and the agent reply
+RESPONSE_MARGIN_MS = 3000
+
 def lambda_handler(event, context):
     """
     Lambda function to handle image processing for Bedrock Agent
@@ -34,9 +39,14 @@ def lambda_handler(event, context):
             
             print(f"Calling API: {api_url}/paper-isolate")
             
+            # Detection budget: what is left of this invocation, less time for
+            # the reply, and within API Gateway's integration timeout
+            deadline_ms = min(API_DEADLINE_MS, context.get_remaining_time_in_millis() - RESPONSE_MARGIN_MS)
+            
             response = requests.post(
                 f"{api_url}/paper-isolate",
                 json={'image': image_b64},
+                headers={'X-Deadline-Ms': str(max(1, deadline_ms))},
                 timeout=60  # Increased timeout for image processing
             )
             
@@ -1,13 +1,133 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, g, url_for
+import atexit
 import base64
 import cv2
+import json
 import numpy as np
 import traceback
 import logging
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from buffers import local_pool
+from cache import ResultCache, cache_key
+from jobs import JobQueue, QueueFull
+from jpegstrips import StripEncoder, strip_rows
+from load import LoadMonitor
+from scheduler import StrategyScheduler
+from uploads import BadRequest, BodyTooLarge, read_json_image, read_stream
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# OpenCV's internal thread count per process. gunicorn.conf.py sets this so
+# that workers x OpenCV threads matches the cores; 0 keeps OpenCV's default.
+OPENCV_THREADS = int(os.environ.get('OPENCV_THREADS', '0'))
+if OPENCV_THREADS > 0:
+    cv2.setNumThreads(OPENCV_THREADS)
+
+# Long edge (px) of the proxy image used for corner detection. The warp always
+# runs on the original pixels; 0 disables the proxy and detects at full size.
+DETECT_MAX_EDGE = int(os.environ.get('DETECT_MAX_EDGE', '1000'))
+
+# Decode JPEGs at 1/2, 1/4 or 1/8 scale straight to grayscale for detection
+# and only decode at full resolution once a page has been found. This makes
+# misses much cheaper, but a found page is entropy-decoded twice, so it is off
+# unless most uploads are expected to miss or memory is the constraint.
+REDUCED_DECODE = os.environ.get('REDUCED_DECODE', '0') == '1'
+
+# Paper sizes in millimetres (short edge, long edge) for the output_paper option
+PAPER_SIZES = {
+    'a4': (210.0, 297.0),
+    'a5': (148.0, 210.0),
+    'letter': (215.9, 279.4),
+    'legal': (215.9, 355.6),
+}
+
+# Resolution of output_paper when the request does not give output_dpi, and
+# the highest a request may ask for
+OUTPUT_DPI = int(os.environ.get('OUTPUT_DPI', '150'))
+MAX_OUTPUT_DPI = 600
+
+# Largest output page in pixels. Paper output is scaled up to its size at
+# output_dpi whatever the upload's resolution, so without a limit any small
+# upload could ask for a huge warp and encode; larger requests get 400.
+MAX_OUTPUT_PIXELS = int(os.environ.get('MAX_OUTPUT_PIXELS', str(40 * 1000 * 1000)))
+
+# Pages whose warped output would take more than this many bytes are warped
+# and JPEG encoded in horizontal strips of at most this size, so the full
+# size page never exists in memory (see warp_and_encode). 0 disables strips.
+WARP_STRIP_BYTES = int(os.environ.get('WARP_STRIP_BYTES', str(16 * 1024 * 1024)))
+
+# Compute the area of every contour of an edge map once, as an array shared
+# by strategies 1 and 2 (and multi-document mode), and select / sort by it
+# with NumPy. The areas themselves are still one cv2.contourArea call per
+# contour; what this saves is each strategy computing them again, and the
+# Python work on the contours outside the area limits
+CONTOUR_PREFILTER = os.environ.get('CONTOUR_PREFILTER', '1') == '1'
+
+# Run the detection strategies on a thread pool instead of one after another.
+# OpenCV releases the GIL, so this lowers latency on images that fall through
+# to the later strategies at the cost of extra CPU on easy ones.
+DETECT_CONCURRENT = os.environ.get('DETECT_CONCURRENT', '0') == '1'
+DETECT_THREADS = int(os.environ.get('DETECT_THREADS', str(os.cpu_count() or 1)))
+
+# Detection engine used when a request does not pick one (see DETECTION_ENGINES)
+DETECT_ENGINE = os.environ.get('DETECT_ENGINE', 'contour')
+
+# Upload limits: request bodies larger than MAX_BODY_BYTES are rejected while
+# reading, images over MAX_IMAGE_PIXELS from their JPEG / PNG header before
+# decoding. 0 disables either limit.
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', str(64 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(120 * 1000 * 1000)))
+
+# Detection time budget per request in ms, counted from the start of the
+# request, 0 for none. A request may ask for a tighter one with an
+# X-Deadline-Ms header. Past the deadline detection stops between stages
+# and strategies and answers with what it has (see DeadlineExceeded).
+DETECT_DEADLINE_MS = int(os.environ.get('DETECT_DEADLINE_MS', '0'))
+
+# Try each engine's strategies in the order that has found the best pages,
+# scored by capture_quality confidence, for similar images (same engine,
+# megapixel and brightness bucket) instead of the engine's fixed order (see
+# scheduler.py); the FALLBACK_STRATEGIES always run last. ADAPTIVE_EXPLORE
+# of the requests put another strategy first to keep the counts fresh. With
+# ADAPTIVE_STATS_PATH set the counts survive restarts and are shared by the
+# workers. Off by default: the corners of an image may then depend on which
+# strategy past traffic favoured.
+ADAPTIVE_ORDER = os.environ.get('ADAPTIVE_ORDER', '0') == '1'
+ADAPTIVE_EXPLORE = float(os.environ.get('ADAPTIVE_EXPLORE', '0.05'))
+ADAPTIVE_STATS_PATH = os.environ.get('ADAPTIVE_STATS_PATH', '')
+
+# Most pages a multi-document request (detect_multi) returns from one photo
+MULTI_MAX_DOCUMENTS = int(os.environ.get('MULTI_MAX_DOCUMENTS', '8'))
+
+# Let OpenCV write the detection proxy and stage images into arrays kept per
+# request thread (see buffers.py) instead of allocating new ones on every
+# request. Off by default: measured under gunicorn it saves no time and keeps
+# ~7 MB per request thread resident, since freed arrays already go back to
+# the OS. Concurrent detection never pools, a cancelled strategy may still be
+# running when the thread's next request starts.
+BUFFER_POOL = os.environ.get('BUFFER_POOL', '0') == '1'
+
+_detect_pool = None
+_detect_pool_lock = threading.Lock()
+
+
+def detection_pool():
+    """Shared thread pool for concurrent detection, created on first use"""
+    global _detect_pool
+    with _detect_pool_lock:
+        if _detect_pool is None:
+            _detect_pool = ThreadPoolExecutor(max_workers=DETECT_THREADS, thread_name_prefix='detect')
+        return _detect_pool
+
 def order_points(pts):
     rect = np.zeros((4, 2), dtype="float32")
     s = pts.sum(axis=1)
@@ -41,384 +161,2677 @@ def four_point_transform(image, pts):
     warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
     return warped
 
-def detect_document(image, debug=False):
+def resize_for_detection(image, max_edge, buffers=None):
     """
-    Improved document detection with multiple strategies
-    
+    Downscale an image so its long edge is at most max_edge pixels
+
     Args:
         image: Input BGR image
-        debug: If True, return debug images
-    
+        max_edge: Long edge of the proxy in pixels (0 or None keeps full size)
+        buffers: Optional BufferPool the proxy is written into
+
     Returns:
-        (result_image, detected) or (result_image, detected, debug_info) if debug=True
+        (proxy_image, scale) where proxy coordinates = original coordinates * scale
     """
-    
-    # Store original for fallback
-    original = image.copy()
     height, width = image.shape[:2]
-    min_area = (width * height) * 0.1  # Document must be at least 10% of image
-    max_area = (width * height) * 0.95  # But not more than 95%
-    
-    debug_images = {} if debug else None
-    
-    # Strategy 1: Enhanced edge detection with adaptive thresholding
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    if debug:
-        debug_images['01_grayscale'] = gray.copy()
-    
-    # Enhance contrast
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply(gray)
-    if debug:
-        debug_images['02_enhanced'] = enhanced.copy()
-    
-    # Multiple blur and edge detection attempts
-    blurred1 = cv2.GaussianBlur(enhanced, (5, 5), 0)
-    blurred2 = cv2.bilateralFilter(enhanced, 9, 75, 75)
-    
-    # Try multiple edge detection thresholds
-    edges_list = [
-        cv2.Canny(blurred1, 50, 150),
-        cv2.Canny(blurred1, 75, 200),
-        cv2.Canny(blurred2, 30, 100),
-    ]
-    
-    if debug:
-        for i, edges in enumerate(edges_list):
-            debug_images[f'03_edges_{i}'] = edges.copy()
-    
-    # Dilate edges to connect gaps
-    kernel = np.ones((3, 3), np.uint8)
-    for i, edges in enumerate(edges_list):
-        edges_list[i] = cv2.dilate(edges, kernel, iterations=1)
-    
-    if debug:
-        debug_images['04_dilated'] = edges_list[0].copy()
-    
-    best_contour = None
-    best_score = 0
-    
-    # Try each edge detection result
-    for edges in edges_list:
-        contours, _ = cv2.findContours(edges, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            
-            # Filter by area
-            if area < min_area or area > max_area:
-                continue
-            
-            # Approximate contour
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            # Look for quadrilaterals (4 corners)
-            if len(approx) == 4:
-                # Calculate score based on area and aspect ratio
-                x, y, w, h = cv2.boundingRect(approx)
-                aspect_ratio = float(w) / h if h > 0 else 0
-                
-                # Prefer rectangles with reasonable aspect ratios (0.3 to 3.0)
-                if 0.3 <= aspect_ratio <= 3.0:
-                    score = area
-                    
-                    if score > best_score:
-                        best_score = score
-                        best_contour = approx
-    
-    # Strategy 2: If no 4-sided contour found, try approximating largest contour
-    if best_contour is None:
-        # Use the first edge detection result
-        contours, _ = cv2.findContours(edges_list[0], cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:10]
-        
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            
-            if area < min_area or area > max_area:
-                continue
-            
-            # Try different approximation accuracies
-            peri = cv2.arcLength(contour, True)
-            
-            for epsilon_factor in [0.02, 0.03, 0.04, 0.05]:
-                approx = cv2.approxPolyDP(contour, epsilon_factor * peri, True)
-                
-                if len(approx) == 4:
-                    best_contour = approx
-                    break
-            
-            if best_contour is not None:
-                break
-    
-    # Strategy 3: White region detection (for white paper on dark background)
-    if best_contour is None:
-        # Threshold to find bright regions
-        _, thresh = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        
-        if debug:
-            debug_images['05_threshold'] = thresh.copy()
-        
-        # Morphological operations to clean up
-        kernel = np.ones((5, 5), np.uint8)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        
-        if debug:
-            debug_images['06_morphology'] = thresh.copy()
-        
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = sorted(contours, key=cv2.contourArea, reverse=True)[:5]
-        
-        for contour in contours:
-            area = cv2.contourArea(contour)
-            
-            if area < min_area or area > max_area:
-                continue
-            
-            peri = cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
-            
-            if len(approx) == 4:
-                best_contour = approx
-                break
-    
-    # Strategy 4: Convex hull of largest contour
-    if best_contour is None:
-        contours, _ = cv2.findContours(edges_list[0], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if contours:
-            largest_contour = max(contours, key=cv2.contourArea)
-            area = cv2.contourArea(largest_contour)
-            
-            if min_area <= area <= max_area:
-                hull = cv2.convexHull(largest_contour)
-                peri = cv2.arcLength(hull, True)
-                approx = cv2.approxPolyDP(hull, 0.02 * peri, True)
-                
-                if len(approx) >= 4:
-                    # If we have more than 4 points, find the 4 corner points
-                    if len(approx) > 4:
-                        # Get bounding rectangle corners
-                        rect = cv2.minAreaRect(largest_contour)
-                        box = cv2.boxPoints(rect)
-                        best_contour = np.int0(box).reshape(-1, 1, 2)
-                    else:
-                        best_contour = approx
-    
-    # If we found a contour, apply perspective transform
-    if best_contour is not None and len(best_contour) == 4:
-        if debug:
-            # Draw the detected contour
-            debug_img = image.copy()
-            cv2.drawContours(debug_img, [best_contour], -1, (0, 255, 0), 3)
-            debug_images['07_detected_contour'] = debug_img
-        
-        pts = best_contour.reshape(4, 2)
-        rect = order_points(pts)
-        
-        # Validate the detected rectangle
-        if is_valid_document_shape(rect, width, height):
-            warped = four_point_transform(image, rect)
-            
-            if debug:
-                return warped, True, debug_images
-            return warped, True
-    
-    # No valid document found
-    if debug:
-        return None, False, debug_images
-    return None, False
+    long_edge = max(height, width)
 
+    if not max_edge or long_edge <= max_edge:
+        return image, 1.0
 
-def is_valid_document_shape(rect, img_width, img_height):
+    scale = max_edge / float(long_edge)
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    dst = buffers.get('proxy', (size[1], size[0]) + image.shape[2:], image.dtype) if buffers else None
+    proxy = cv2.resize(image, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return proxy, scale
+
+
+def refine_corners(image, rect, scale):
     """
-    Validate that the detected rectangle is a reasonable document shape
-    
+    Snap corners found on the detection proxy to the full resolution image
+
+    Only a small window around each corner is converted and searched, so the
+    cost does not grow with the image size.
+
     Args:
-        rect: Ordered points of rectangle
-        img_width: Original image width
-        img_height: Original image height
-    
+        image: Original BGR image
+        rect: Ordered corners in original image coordinates
+        scale: Proxy scale the corners were detected at
+
     Returns:
-        bool: True if valid document shape
+        Refined corners (float32), unchanged where refinement drifted too far
     """
-    (tl, tr, br, bl) = rect
-    
-    # Calculate width and height
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    
-    maxWidth = max(int(widthA), int(widthB))
-    maxHeight = max(int(heightA), int(heightB))
-    
-    # Check if dimensions are reasonable
-    if maxWidth < 50 or maxHeight < 50:
-        return False
-    
-    # Check aspect ratio (typical document ratios: A4 is ~1.414, Letter is ~1.294)
-    aspect_ratio = maxWidth / maxHeight if maxHeight > 0 else 0
-    
-    # Allow aspect ratios between 1:3 and 3:1
-    if aspect_ratio < 0.33 or aspect_ratio > 3.0:
-        return False
-    
-    # Check that it's not too close to image boundaries (likely the image itself)
-    min_margin = 10
-    if (tl[0] < min_margin and tr[0] > img_width - min_margin and
-        tl[1] < min_margin and bl[1] > img_height - min_margin):
-        return False
-    
-    return True
+    height, width = image.shape[:2]
+    win = int(np.ceil(2.0 / scale)) + 2
+    pad = 3 * win
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.1)
 
+    refined = rect.copy()
+    for i, (x, y) in enumerate(rect):
+        # Hull and minAreaRect corners can sit on or past the frame edge
+        x, y = min(max(float(x), 0.0), width - 1.0), min(max(float(y), 0.0), height - 1.0)
+        x0, y0 = max(0, int(x) - pad), max(0, int(y) - pad)
+        x1, y1 = min(width, int(x) + pad + 1), min(height, int(y) + pad + 1)
+        if x1 - x0 <= 2 * win + 5 or y1 - y0 <= 2 * win + 5:
+            continue
+        if not (0 <= x - x0 < x1 - x0 and 0 <= y - y0 < y1 - y0):
+            continue
 
-def order_points(pts):
-    """Order points in top-left, top-right, bottom-right, bottom-left order"""
-    rect = np.zeros((4, 2), dtype="float32")
-    
-    # Sum and diff to find corners
-    s = pts.sum(axis=1)
-    diff = np.diff(pts, axis=1)
-    
-    rect[0] = pts[np.argmin(s)]      # top-left (smallest sum)
-    rect[2] = pts[np.argmax(s)]      # bottom-right (largest sum)
-    rect[1] = pts[np.argmin(diff)]   # top-right (smallest difference)
-    rect[3] = pts[np.argmax(diff)]   # bottom-left (largest difference)
-    
-    return rect
+        patch = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+        corner = np.array([[[x - x0, y - y0]]], dtype="float32")
+        cv2.cornerSubPix(patch, corner, (win, win), (-1, -1), criteria)
 
+        candidate = corner[0, 0] + (x0, y0)
+        if np.linalg.norm(candidate - rect[i]) <= win:
+            refined[i] = candidate
 
-def four_point_transform(image, pts):
-    """Apply perspective transform to get bird's eye view"""
-    rect = order_points(pts)
-    (tl, tr, br, bl) = rect
-    
-    # Calculate width
-    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
-    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
-    maxWidth = max(int(widthA), int(widthB))
-    
-    # Calculate height
-    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
-    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
-    maxHeight = max(int(heightA), int(heightB))
-    
-    # Ensure minimum dimensions
-    maxWidth = max(maxWidth, 100)
-    maxHeight = max(maxHeight, 100)
-    
-    # Destination points
-    dst = np.array([
-        [0, 0],
-        [maxWidth - 1, 0],
-        [maxWidth - 1, maxHeight - 1],
-        [0, maxHeight - 1]
-    ], dtype="float32")
-    
-    # Perspective transform
-    M = cv2.getPerspectiveTransform(rect, dst)
-    warped = cv2.warpPerspective(image, M, (maxWidth, maxHeight))
-    
-    return warped
+    return refined
 
 
-def save_debug_images(debug_images, prefix="debug"):
-    """Save debug images to disk for inspection"""
-    import os
-    os.makedirs("debug_output", exist_ok=True)
-    
-    for name, img in debug_images.items():
-        cv2.imwrite(f"debug_output/{prefix}_{name}.jpg", img)
-    
-    print(f"Saved {len(debug_images)} debug images to debug_output/")
+def locate_document(image, max_edge=DETECT_MAX_EDGE, debug_images=None, stats=None,
+                    concurrent=DETECT_CONCURRENT, engine=DETECT_ENGINE, multi=False, hint=None, deadline=None):
+    """
+    Find the document corners, searching on a downscaled proxy of the image
 
+    Args:
+        image: Input BGR image
+        max_edge: Long edge of the detection proxy (0 detects at full size)
+        debug_images: Optional dict that collects intermediate images
+        stats: Optional dict that collects the stages run and the strategy used
+        concurrent: Run the strategies on the detection thread pool
+        engine: Name of the detection engine (see DETECTION_ENGINES)
+        multi: Find every page in the image (see find_documents)
+        hint: Optional approximate page corners, only a window around
+            them is searched first (see locate_with_hint)
+        deadline: Optional time.perf_counter() value after which detection
+            stops and answers with what it has; stats['truncated'] is then set
 
-# Example usage with debugging
-if __name__ == "__main__":
-    # Test the function
-    image = cv2.imread("test_document.jpg")
-    
-    if image is not None:
-        # Run with debug mode
-        result, detected, debug_info = detect_document(image, debug=True)
-        
-        if detected:
-            print("✅ Document detected!")
-            cv2.imwrite("detected_document.jpg", result)
-            print(f"Saved to detected_document.jpg")
+    Returns:
+        Ordered corners (tl, tr, br, bl) in original image coordinates, or
+        None; with multi a list of them, one per page
+    """
+    height, width = image.shape[:2]
+    if stats is not None:
+        stats.setdefault('megapixels', width * height / 1e6)
+
+    rect, scale = locate_with_hint(image, 1.0, width, height, max_edge, hint, debug_images, stats, concurrent,
+                                   engine, multi, deadline)
+    if rect is None:
+        return None
+    if multi:
+        return finish_pages(image, rect, scale, stats)
+    return finish_corners(image, rect, scale, stats)
+
+
+# Hinted search: the window is the hint's bounding box grown by this
+# fraction of its long side on every side, so a preview overlay or the
+# previous page of a scan may be off by that much
+HINT_PADDING = 0.1
+# Windows covering more of the frame than this search the whole frame directly
+HINT_MAX_FRACTION = 0.8
+
+
+def hint_window(hint, width, height):
+    """
+    Search window (x0, y0, x1, y1) around hint corners, clipped to the frame
+
+    Returns None when the window would cover most of the frame anyway or
+    the hint lies outside it.
+    """
+    pts = np.asarray(hint, dtype="float32").reshape(4, 2)
+    lo, hi = pts.min(axis=0), pts.max(axis=0)
+    pad = HINT_PADDING * float(max(hi - lo))
+    x0, y0 = (int(v) for v in np.maximum(np.floor(lo - pad), 0))
+    x1, y1 = (int(v) for v in np.minimum(np.ceil(hi + pad), (width, height)))
+    if x1 - x0 < 16 or y1 - y0 < 16:
+        return None
+    if (x1 - x0) * (y1 - y0) > HINT_MAX_FRACTION * width * height:
+        return None
+    return x0, y0, x1, y1
+
+
+def locate_with_hint(source, source_scale, width, height, max_edge=DETECT_MAX_EDGE, hint=None, debug_images=None,
+                     stats=None, concurrent=DETECT_CONCURRENT, engine=DETECT_ENGINE, multi=False, deadline=None):
+    """
+    Search the window around hint first and the whole frame only when that finds nothing
+
+    Detection in the window runs at no less than the proxy resolution of a
+    whole frame search, so the pixels processed shrink with the window area
+    while the corners stay as accurate. stats['hint'] records the outcome:
+    'hit', 'miss' (fell back to the whole frame) or 'ignored' (the window
+    would not have been smaller than the frame).
+
+    Args:
+        source: Image detection reads, the decoded image or a reduced decode
+        source_scale: Source size / original size
+        width, height: Original image size
+        hint: Approximate page corners in original image coordinates, or None
+
+    Returns:
+        (rect, scale) as from search_window, (None, None) when nothing was found
+    """
+    frame = (0, 0, width, height)
+    if hint is not None:
+        window = hint_window(hint, width, height)
+        if window is None:
+            if stats is not None:
+                stats['hint'] = 'ignored'
         else:
-            print("❌ No document detected")
-        
-        # Save debug images
-        save_debug_images(debug_info, "test")
-        print("Check debug_output/ folder for intermediate steps")
+            rect, scale = search_window(source, source_scale, window, width, height, max_edge, debug_images,
+                                        stats, concurrent, engine, multi, deadline)
+            if stats is not None:
+                stats['hint'] = 'hit' if rect is not None else 'miss'
+            if rect is not None:
+                return rect, scale
+            if deadline_passed(deadline):
+                # No time left for the whole frame
+                if stats is not None:
+                    stats['truncated'] = True
+                return None, None
+
+    return search_window(source, source_scale, frame, width, height, max_edge, debug_images, stats, concurrent,
+                         engine, multi, deadline)
+
+
+def search_window(source, source_scale, window, width, height, max_edge=DETECT_MAX_EDGE, debug_images=None,
+                  stats=None, concurrent=DETECT_CONCURRENT, engine=DETECT_ENGINE, multi=False, deadline=None):
+    """
+    Detect inside window (x0, y0, x1, y1, original coordinates) of source
+
+    Returns:
+        (rect, scale): unrefined corners in original image coordinates (a
+        list of them with multi) and the proxy scale relative to the
+        original, or (None, None)
+    """
+    x0, y0, x1, y1 = window
+    offset = None
+    window_edge = max_edge
+    if window != (0, 0, width, height):
+        # Reduce the window by a whole factor no coarser than the whole
+        # frame proxy, with its size a multiple of it: INTER_AREA then takes
+        # its fast integer path and the window costs less than the frame
+        factor = max(1, int(max(source.shape[:2]) / max_edge)) if max_edge else 1
+        sx0, sy0 = int(x0 * source_scale) // factor * factor, int(y0 * source_scale) // factor * factor
+        sx1 = sx0 + (int(np.ceil(x1 * source_scale)) - sx0) // factor * factor
+        sy1 = sy0 + (int(np.ceil(y1 * source_scale)) - sy0) // factor * factor
+        source = source[sy0:sy1, sx0:sx1]
+        offset = np.array([sx0, sy0], dtype="float32") / source_scale
+        window_width, window_height = source.shape[1] / source_scale, source.shape[0] / source_scale
+        window_edge = max(source.shape[:2]) // factor if max_edge else 0
     else:
-        print("Could not load image")
+        window_width, window_height = width, height
 
-@app.route('/health', methods=['GET'])
-def health():
-    return jsonify({'status': 'healthy'}), 200
+    start = time.perf_counter()
+    proxy, proxy_scale = resize_for_detection(source, window_edge, detection_buffers(concurrent))
+    if proxy_scale != 1.0:
+        record_stage(stats, 'resize' if offset is None else 'resize_window', start)
+    scale = proxy_scale * source_scale
+
+    rect = locate_on_proxy(proxy, scale, window_width, window_height, debug_images, stats, concurrent, engine,
+                           multi, deadline)
+    if rect is None:
+        return None, None
+    if offset is not None:
+        rect = [page + offset for page in rect] if multi else rect + offset
+    return rect, scale
+
+
+def locate_on_proxy(proxy, scale, width, height, debug_images=None, stats=None,
+                    concurrent=DETECT_CONCURRENT, engine=DETECT_ENGINE, multi=False, deadline=None):
+    """
+    Run detection on a proxy and map the result to original image coordinates
+
+    Args:
+        proxy: BGR or grayscale detection proxy
+        scale: Proxy size / original size
+        width: Original image width
+        height: Original image height
+        debug_images: Optional dict that collects intermediate images
+        stats: Optional dict that collects the stages run and the strategy used
+        concurrent: Run the strategies on the detection thread pool
+        engine: Name of the detection engine (see DETECTION_ENGINES)
+        multi: Find every page (see find_documents), engine and concurrent
+            do not apply
+        deadline: Optional time.perf_counter() value to stop searching at
+
+    Returns:
+        Ordered, unrefined corners in original image coordinates, or None;
+        with multi a non-empty list of them, or None
+    """
+    def to_original(pts):
+        # Map proxy pixel centres back onto the original pixel grid
+        rect = order_points(pts.astype("float32"))
+        if scale != 1.0:
+            rect = (rect + 0.5) / scale - 0.5
+        return rect
+
+    def accept(pts):
+        # Validate candidates at full resolution
+        return is_valid_document_shape(to_original(pts), width, height)
+
+    if multi:
+        pages = find_documents(proxy, debug_images, accept=accept, stats=stats, deadline=deadline)
+        return [to_original(pts) for pts in pages] or None
+
+    pts = find_document_corners(proxy, debug_images, accept=accept, stats=stats, concurrent=concurrent,
+                                engine=engine, deadline=deadline)
+    if pts is None:
+        return None
+    return to_original(pts)
+
+
+def finish_corners(image, rect, scale, stats=None, decode_factor=1):
+    """
+    Refine proxy corners on the full resolution image and report them in stats
+
+    image may be a reduced decode (1 / decode_factor of the original size),
+    rect and scale are then relative to it; stats always gets corners in
+    original image coordinates.
+    """
+    if scale < 1.0:
+        start = time.perf_counter()
+        rect = refine_corners(image, rect, scale)
+        record_stage(stats, 'refine', start)
+
+    rect = rect.astype("float32")
+    if stats is not None:
+        original = (rect + 0.5) * decode_factor - 0.5 if decode_factor != 1 else rect
+        stats['corners'] = [[round(float(x), 2), round(float(y), 2)] for x, y in original]
+    return rect
+
+
+def finish_pages(image, rects, scale, stats=None, decode_factor=1):
+    """finish_corners for every page of a multi-document result, stats['corners'] gets one list per page"""
+    pages, corners = [], []
+    for rect in rects:
+        pages.append(finish_corners(image, rect, scale, stats, decode_factor))
+        if stats is not None:
+            corners.append(stats['corners'])
+    if stats is not None:
+        stats['corners'] = corners
+    return pages
+
+
+# JPEG start-of-frame markers (baseline, progressive, lossless, ...)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def read_image_size(data):
+    """
+    Read image dimensions from a JPEG or PNG header without decoding
+
+    Args:
+        data: Encoded image bytes
+
+    Returns:
+        (width, height, format) with format 'jpeg' or 'png', or None when
+        the header is not recognised
+    """
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) >= 24:
+        width, height = struct.unpack_from('>II', data, 16)
+        return width, height, 'png'
+
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            # Markers without a length field
+            i += 2
+            continue
+
+        length = struct.unpack_from('>H', data, i + 2)[0]
+        if marker in JPEG_SOF_MARKERS and i + 9 <= len(data):
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return width, height, 'jpeg'
+        i += 2 + length
+
+    return None
+
+
+# IMREAD flag for each JPEG decode reduction
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
+
+# IMREAD flag for each JPEG colour decode reduction
+REDUCED_COLOR_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+
+def warp_decode_factor(rect, max_edge=0, paper=None, dpi=OUTPUT_DPI):
+    """
+    Largest JPEG reduction whose pixels still cover the requested output
+
+    Args:
+        rect: Ordered page corners in original image coordinates
+        max_edge, paper, dpi: The output options (see output_size)
+
+    Returns:
+        1, 2, 4 or 8; the warp then downsamples by less than 2x, so the
+        libjpeg reduction also acts as the anti-aliasing filter
+    """
+    width, height = page_size(rect)
+    target = max(output_size(width, height, max_edge, paper, dpi))
+    for factor in (8, 4, 2):
+        if max(width, height) / factor >= target:
+            return factor
+    return 1
+
+
+def reduced_decode_factor(width, height, max_edge):
+    """Largest JPEG reduction that still leaves at least max_edge pixels on the long edge"""
+    if not max_edge:
+        return 1
+    long_edge = max(width, height)
+    for factor in (8, 4, 2):
+        if long_edge // factor >= max_edge:
+            return factor
+    return 1
+
+
+def decode_and_detect(image_data, stats=None, max_edge=DETECT_MAX_EDGE, concurrent=DETECT_CONCURRENT,
+                      engine=DETECT_ENGINE, output_max_edge=0, output_paper=None, output_dpi=OUTPUT_DPI,
+                      encode=False, multi=False, hint=None, deadline=None, output_quality=0):
+    """
+    Decode an uploaded image and detect the document in it
+
+    Large JPEGs are first decoded at a reduced scale straight to grayscale
+    (libjpeg skips most of the IDCT work), detection runs on that, and the
+    colour decode only happens when a page was found and has to be refined
+    and warped. That second decode is itself reduced when a smaller output
+    was requested and the page has pixels to spare (see warp_decode_factor).
+    Other formats are decoded once at full size.
+
+    Args:
+        image_data: Encoded image bytes
+        stats: Optional dict that collects stage timings and 'megapixels'
+        max_edge: Long edge of the detection proxy (0 detects at full size)
+        concurrent: Run the strategies on the detection thread pool
+        engine: Name of the detection engine (see DETECTION_ENGINES)
+        output_max_edge: Largest long edge of the warped page, 0 for no limit
+        output_paper: Warp to this PAPER_SIZES paper at output_dpi instead
+            of the measured page size
+        output_dpi: Resolution for output_paper
+        encode: Return the page JPEG encoded (see warp_and_encode) instead
+            of as an image
+        multi: Return every page found in the image (see find_documents)
+        hint: Approximate page corners to search around first (see
+            locate_with_hint)
+        deadline: Optional time.perf_counter() value after which detection
+            gives up on strategies it has not started (see
+            find_document_corners); stats['truncated'] is then set
+        output_quality: JPEG quality of an encoded page, 0 for OpenCV's default
+
+    Returns:
+        (result, detected, image_shape); result is the warped page, or with
+        encode (jpeg buffer, width, height), None when nothing was found.
+        With multi, result is a list of those, one per page in reading
+        order. image_shape is None when the data could not be decoded.
+    """
+    nparr = np.frombuffer(image_data, np.uint8)
+    output = (output_max_edge, output_paper, output_dpi)
+    size = read_image_size(image_data) if REDUCED_DECODE else None
+    factor = reduced_decode_factor(size[0], size[1], max_edge) if size and size[2] == 'jpeg' else 1
+
+    if factor == 1:
+        start = time.perf_counter()
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        record_stage(stats, 'imdecode', start)
+        if image is None:
+            return None, False, None
+
+        if stats is not None:
+            stats['megapixels'] = image.shape[0] * image.shape[1] / 1e6
+        if deadline_expired(deadline, stats):
+            return None, False, image.shape
+        rect = locate_document(image, max_edge, stats=stats, concurrent=concurrent, engine=engine, multi=multi,
+                               hint=hint, deadline=deadline)
+        if rect is None:
+            return None, False, image.shape
+        if multi:
+            pages = [render_page(image, page, stats, encode, output, output_quality) for page in rect]
+            return pages, True, image.shape
+        return render_page(image, rect, stats, encode, output, output_quality), True, image.shape
+
+    start = time.perf_counter()
+    reduced = cv2.imdecode(nparr, REDUCED_GRAYSCALE_FLAGS[factor])
+    record_stage(stats, 'imdecode_reduced', start)
+    if reduced is None:
+        return None, False, None
+
+    # EXIF orientation is applied on decode, match the header size to it
+    width, height = size[0], size[1]
+    if (reduced.shape[1] > reduced.shape[0]) != (width > height):
+        width, height = height, width
+    if stats is not None:
+        stats['megapixels'] = width * height / 1e6
+    if deadline_expired(deadline, stats):
+        return None, False, (height, width, 3)
+
+    reduced_scale = max(reduced.shape[:2]) / float(max(width, height))
+    rect, scale = locate_with_hint(reduced, reduced_scale, width, height, max_edge, hint, stats=stats,
+                                   concurrent=concurrent, engine=engine, multi=multi, deadline=deadline)
+    del reduced
+    if rect is None:
+        return None, False, (height, width, 3)
+
+    rects = rect if multi else [rect]
+    decode_factor = 1
+    if output_max_edge or output_paper:
+        decode_factor = min(warp_decode_factor(page, *output) for page in rects)
+
+    start = time.perf_counter()
+    if decode_factor == 1:
+        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        record_stage(stats, 'imdecode', start)
+    else:
+        image = cv2.imdecode(nparr, REDUCED_COLOR_FLAGS[decode_factor])
+        record_stage(stats, 'imdecode_warp', start)
+    if image is None:
+        return None, False, None
+
+    if decode_factor != 1:
+        rects = [(page + 0.5) / decode_factor - 0.5 for page in rects]
+        scale *= decode_factor
+    if multi:
+        rects = finish_pages(image, rects, scale, stats, decode_factor)
+        pages = [render_page(image, page, stats, encode, output, output_quality) for page in rects]
+        return pages, True, (height, width, 3)
+    rect = finish_corners(image, rects[0], scale, stats, decode_factor)
+    return render_page(image, rect, stats, encode, output, output_quality), True, (height, width, 3)
+
+
+def render_page(image, rect, stats, encode, output, quality=0):
+    """Warped page, or (jpeg buffer, width, height) when encode is set"""
+    if encode:
+        return warp_and_encode(image, rect, stats, *output, quality=quality)
+
+    start = time.perf_counter()
+    warped = four_point_transform(image, rect, *output)
+    record_stage(stats, 'warp', start)
+    return warped
+
+
+def detect_document(image, debug=False, max_edge=DETECT_MAX_EDGE, stats=None,
+                    concurrent=DETECT_CONCURRENT, engine=DETECT_ENGINE, output_max_edge=0, output_paper=None,
+                    output_dpi=OUTPUT_DPI, multi=False, hint=None, deadline_ms=0):
+    """
+    Improved document detection with multiple strategies
+
+    Corners are found on a proxy whose long edge is at most max_edge pixels,
+    then scaled back up so the perspective warp samples the original pixels.
+    
+    Args:
+        image: Input BGR image
+        debug: If True, return debug images
+        max_edge: Long edge of the detection proxy (0 detects at full size)
+        stats: Optional dict, filled with the stages run and the strategy used
+        concurrent: Run the strategies on the detection thread pool
+        engine: Name of the detection engine (see DETECTION_ENGINES)
+        output_max_edge: Largest long edge of the warped page, 0 for no limit
+        output_paper: Warp to this PAPER_SIZES paper at output_dpi instead
+            of the measured page size
+        output_dpi: Resolution for output_paper
+        multi: Find every page in the image, result_image is then a list
+            of pages in reading order (see find_documents)
+        hint: Approximate page corners to search around first (see
+            locate_with_hint)
+        deadline_ms: Detection time budget, 0 for none. When it runs out the
+            best candidate found so far is used, or nothing, and
+            stats['truncated'] is set
+    
+    Returns:
+        (result_image, detected) or (result_image, detected, debug_info) if debug=True
+    """
+    debug_images = {} if debug else None
+    deadline = time.perf_counter() + deadline_ms / 1000.0 if deadline_ms > 0 else None
+
+    rect = locate_document(image, max_edge, debug_images, stats, concurrent, engine, multi, hint, deadline)
+
+    if rect is not None:
+        output = (output_max_edge, output_paper, output_dpi)
+        if multi:
+            warped = [render_page(image, page, stats, False, output) for page in rect]
+        else:
+            warped = render_page(image, rect, stats, False, output)
+
+        if debug:
+            return warped, True, debug_images
+        return warped, True
+
+    # No valid document found
+    if debug:
+        return None, False, debug_images
+    return None, False
+
+
+def detection_buffers(concurrent):
+    """The request thread's BufferPool for detection intermediates, or None when not pooling"""
+    return local_pool() if BUFFER_POOL and not concurrent else None
+
+
+class DeadlineExceeded(Exception):
+    """A request's detection deadline passed before the next stage or strategy"""
+
+
+def deadline_passed(deadline):
+    """Whether a perf_counter deadline has passed, never for None"""
+    return deadline is not None and time.perf_counter() >= deadline
+
+
+def deadline_expired(deadline, stats=None):
+    """deadline_passed, marking stats as truncated when it has"""
+    if not deadline_passed(deadline):
+        return False
+    if stats is not None:
+        stats['truncated'] = True
+    return True
+
+
+def wait_result(future, deadline):
+    """future.result(), raising DeadlineExceeded instead of waiting past deadline"""
+    if deadline is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(0.0, deadline - time.perf_counter()))
+    except FutureTimeoutError:
+        raise DeadlineExceeded('waiting for a strategy') from None
+
+
+def record_stage(stats, name, start, nested=0.0):
+    """
+    Append a stage and its wall time since start (perf_counter) to stats
+
+    nested is time (seconds) spent in other recorded stages during this one,
+    it is subtracted so every stage reports its own cost only.
+    """
+    if stats is not None:
+        elapsed = (time.perf_counter() - start - nested) * 1000.0
+        stats.setdefault('stages', []).append({'name': name, 'ms': round(elapsed, 2)})
+
+
+# Canny variants tried by strategy 1, cheapest first: (blur, low, high)
+EDGE_VARIANTS = [
+    ('gaussian', 50, 150),
+    ('gaussian', 75, 200),
+    ('bilateral', 30, 100),
+]
+
+# Single pass edge map of the 'auto' engine: Gaussian blur and Canny with the
+# high threshold at the Otsu level of the enhanced image, the low one below it
+AUTO_CANNY_LOW_RATIO = 0.5
+
+
+class DetectionStages:
+    """
+    Intermediate images shared by the detection strategies
+
+    Every stage (gray, enhanced, each blur, each edge map, each contour list)
+    is computed on first use and cached, so a stage runs at most once per
+    image no matter how many strategies read it. Stages are safe to request
+    from several threads, later callers wait for the first one to finish.
+    A stage that would start after deadline (perf_counter) raises
+    DeadlineExceeded instead. Stages are recorded in stats, or in the dict a
+    thread passed to record_into.
+    """
+
+    def __init__(self, image, stats=None, debug_images=None, buffers=None, deadline=None):
+        self.image = image
+        self.stats = stats
+        self.debug_images = debug_images
+        self.buffers = buffers
+        self.deadline = deadline
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stage(self, name, compute):
+        # Stages call their inputs lazily, keep a per-thread stack of time
+        # spent in those inputs so each stage only reports its own cost
+        nested = getattr(self._local, 'nested', None)
+        if nested is None:
+            nested = self._local.nested = []
+
+        start = time.perf_counter()
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self._cache:
+                if deadline_passed(self.deadline):
+                    raise DeadlineExceeded(name)
+                nested.append(0.0)
+                compute_start = time.perf_counter()
+                try:
+                    self._cache[name] = compute()
+                finally:
+                    child = nested.pop()
+                own = getattr(self._local, 'stats', None)
+                record_stage(self.stats if own is None else own, name, compute_start, child)
+        if nested:
+            nested[-1] += time.perf_counter() - start
+        return self._cache[name]
+
+    def record_into(self, stats):
+        """Record the stages this thread computes in stats instead, None to go back"""
+        self._local.stats = stats
+
+    def computed(self, name):
+        """Whether stage name has already run for this image"""
+        return name in self._cache
+
+    def _dst(self, name):
+        """Pooled single channel output array of the image size for a stage, or None"""
+        if self.buffers is None:
+            return None
+        return self.buffers.get(name, self.image.shape[:2])
+
+    def _debug(self, name, img):
+        if self.debug_images is not None:
+            self.debug_images[name] = img.copy()
+
+    def gray(self):
+        def compute():
+            if self.image.ndim == 2:
+                # Proxy was decoded straight to grayscale
+                gray = self.image
+            else:
+                gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY, dst=self._dst('gray'))
+            self._debug('01_grayscale', gray)
+            return gray
+        return self._stage('gray', compute)
+
+    def enhanced(self):
+        def compute():
+            # Enhance contrast
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            enhanced = clahe.apply(self.gray(), dst=self._dst('enhanced'))
+            self._debug('02_enhanced', enhanced)
+            return enhanced
+        return self._stage('enhanced', compute)
+
+    def blurred(self, kind):
+        def compute():
+            if kind == 'bilateral':
+                return cv2.bilateralFilter(self.enhanced(), 9, 75, 75, dst=self._dst('blur_bilateral'))
+            return cv2.GaussianBlur(self.enhanced(), (5, 5), 0, dst=self._dst(f'blur_{kind}'))
+        return self._stage(f'blur_{kind}', compute)
+
+    def canny(self, index):
+        """Canny edge map for EDGE_VARIANTS[index], or Otsu calibrated for index 'auto'"""
+        def compute():
+            if index == 'auto':
+                kind, high = 'gaussian', self.otsu()[0]
+                low = AUTO_CANNY_LOW_RATIO * high
+            else:
+                kind, low, high = EDGE_VARIANTS[index]
+            edges = cv2.Canny(self.blurred(kind), low, high, edges=self._dst(f'canny_{index}'))
+            self._debug(f'03_edges_{index}', edges)
+            return edges
+        return self._stage(f'canny_{index}', compute)
+
+    def edges(self, index):
+        """Dilated Canny edge map for EDGE_VARIANTS[index]"""
+        def compute():
+            # Dilate edges to connect gaps
+            kernel = np.ones((3, 3), np.uint8)
+            edges = cv2.dilate(self.canny(index), kernel, dst=self._dst(f'edges_{index}'), iterations=1)
+            if index == 0:
+                self._debug('04_dilated', edges)
+            return edges
+        return self._stage(f'edges_{index}', compute)
+
+    def edge_contours(self, index, mode=cv2.RETR_LIST):
+        def compute():
+            contours, _ = cv2.findContours(self.edges(index), mode, cv2.CHAIN_APPROX_SIMPLE)
+            return contours
+        suffix = 'external' if mode == cv2.RETR_EXTERNAL else 'list'
+        return self._stage(f'contours_{index}_{suffix}', compute)
+
+    def contour_areas(self, index):
+        """cv2.contourArea of every RETR_LIST contour of edge map index, as an array"""
+        return self._stage(f'areas_{index}', lambda: contour_area_array(self.edge_contours(index)))
+
+    def line_segments(self):
+        """Probabilistic Hough segments on the first Canny map as (N, 4) float32 x1, y1, x2, y2"""
+        def compute():
+            height, width = self.image.shape[:2]
+            min_length = LINE_MIN_LENGTH * min(width, height)
+            segments = cv2.HoughLinesP(self.canny(0), 1, np.pi / 180, threshold=max(10, int(min_length / 2)),
+                                       minLineLength=min_length, maxLineGap=min_length / 4)
+            if segments is None:
+                return np.zeros((0, 4), dtype="float32")
+            return segments.reshape(-1, 4).astype("float32")
+        return self._stage('line_segments', compute)
+
+    def otsu(self):
+        """(level, binary image) of Otsu's threshold on the enhanced image"""
+        def compute():
+            return cv2.threshold(self.enhanced(), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                                 dst=self._dst('otsu'))
+        return self._stage('otsu', compute)
+
+    def threshold(self):
+        def compute():
+            # Threshold to find bright regions
+            thresh = self.otsu()[1]
+            self._debug('05_threshold', thresh)
+
+            # Morphological operations to clean up
+            kernel = np.ones((5, 5), np.uint8)
+            thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel, dst=self._dst('closed'))
+            thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel, dst=self._dst('threshold'))
+            self._debug('06_morphology', thresh)
+            return thresh
+        return self._stage('threshold', compute)
+
+    def threshold_contours(self):
+        def compute():
+            contours, _ = cv2.findContours(self.threshold(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            return contours
+        return self._stage('contours_threshold', compute)
+
+
+def contour_area_array(contours):
+    """cv2.contourArea of every contour, as one array"""
+    return np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+
+
+def quad_candidates(areas, min_area, max_area):
+    """Indices of contours whose area passes strategy 1's area filter, in order"""
+    return np.flatnonzero((areas >= min_area) & (areas <= max_area))
+
+
+def sized_contours(contours, min_area, max_area):
+    """(index, area) of the contours within the area limits, one cv2.contourArea at a time"""
+    for i, contour in enumerate(contours):
+        area = cv2.contourArea(contour)
+        if min_area <= area <= max_area:
+            yield i, area
+
+
+def strategy_edge_quad(stages, index, min_area, max_area):
+    """Strategy 1: largest 4-sided contour on one Canny edge map"""
+    best_contour = None
+    best_score = 0
+
+    contours = stages.edge_contours(index)
+    if CONTOUR_PREFILTER:
+        areas = stages.contour_areas(index)
+        candidates = ((i, areas[i]) for i in quad_candidates(areas, min_area, max_area))
+    else:
+        candidates = sized_contours(contours, min_area, max_area)
+
+    for i, area in candidates:
+        contour = contours[i]
+
+        # Approximate contour
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
+        
+        # Look for quadrilaterals (4 corners)
+        if len(approx) == 4:
+            # Calculate score based on area and aspect ratio
+            x, y, w, h = cv2.boundingRect(approx)
+            aspect_ratio = float(w) / h if h > 0 else 0
+            
+            # Prefer rectangles with reasonable aspect ratios (0.3 to 3.0)
+            if 0.3 <= aspect_ratio <= 3.0:
+                score = area
+                
+                if score > best_score:
+                    best_score = score
+                    best_contour = approx
+
+    return best_contour
+
+
+def strategy_approx_largest(stages, min_area, max_area):
+    """Strategy 2: approximate the largest contours with looser tolerances"""
+    # Use the first edge detection result
+    contours = stages.edge_contours(0)
+    if CONTOUR_PREFILTER:
+        # Stable sort, ties keep their order exactly like sorted() does
+        areas = stages.contour_areas(0)
+        order = np.argsort(-areas, kind='stable')[:10]
+        largest = [(contours[i], areas[i]) for i in order]
+    else:
+        largest = sorted(((c, cv2.contourArea(c)) for c in contours), key=lambda item: item[1], reverse=True)[:10]
+
+    for contour, area in largest:
+        if area < min_area or area > max_area:
+            continue
+        
+        # Try different approximation accuracies
+        peri = cv2.arcLength(contour, True)
+        
+        for epsilon_factor in [0.02, 0.03, 0.04, 0.05]:
+            approx = cv2.approxPolyDP(contour, epsilon_factor * peri, True)
+            
+            if len(approx) == 4:
+                return approx
+
+    return None
+
+
+def strategy_white_region(stages, min_area, max_area):
+    """Strategy 3: white region detection (for white paper on dark background)"""
+    contours = sorted(stages.threshold_contours(), key=cv2.contourArea, reverse=True)[:5]
+    
+    for contour in contours:
+        area = cv2.contourArea(contour)
+        
+        if area < min_area or area > max_area:
+            continue
+        
+        peri = cv2.arcLength(contour, True)
+        approx = cv2.approxPolyDP(contour, 0.02 * peri, True)
+        
+        if len(approx) == 4:
+            return approx
+
+    return None
+
+
+def strategy_convex_hull(stages, min_area, max_area):
+    """Strategy 4: convex hull of largest contour"""
+    contours = stages.edge_contours(0, cv2.RETR_EXTERNAL)
+    
+    if not contours:
+        return None
+
+    largest_contour = max(contours, key=cv2.contourArea)
+    area = cv2.contourArea(largest_contour)
+    
+    if min_area <= area <= max_area:
+        hull = cv2.convexHull(largest_contour)
+        peri = cv2.arcLength(hull, True)
+        approx = cv2.approxPolyDP(hull, 0.02 * peri, True)
+        
+        if len(approx) > 4:
+            # If we have more than 4 points, use the bounding rectangle corners
+            rect = cv2.minAreaRect(largest_contour)
+            box = cv2.boxPoints(rect)
+            return box.astype(np.int32).reshape(-1, 1, 2)
+        if len(approx) == 4:
+            return approx
+
+    return None
+
+
+# Line segment engine tuning, lengths relative to the proxy
+LINE_MIN_LENGTH = 0.08                 # shortest Hough segment, fraction of the short edge
+LINE_MERGE_ANGLE = np.deg2rad(4.0)     # segments closer than this in angle ...
+LINE_MERGE_DISTANCE = 0.006            # ... and in offset (fraction of the diagonal) form one line
+LINE_CANDIDATES = 16                   # strongest lines per orientation combined into quads
+LINE_SIDE_SAMPLES = 32                 # points checked along each quad side
+LINE_MIN_SUPPORT = 0.6                 # fraction of every side that must lie on an edge
+
+
+def merge_segments(segments, diagonal):
+    """
+    Group Hough segments that lie on the same line and fit one line per group
+
+    Args:
+        segments: (N, 4) array of x1, y1, x2, y2, all of one orientation
+        diagonal: Image diagonal in pixels
+
+    Returns:
+        Up to LINE_CANDIDATES lines as an (M, 3) array of a, b, c with
+        a * x + b * y = c and (a, b) a unit normal, strongest first
+    """
+    if len(segments) == 0:
+        return np.zeros((0, 3), dtype="float64")
+
+    d = segments[:, 2:] - segments[:, :2]
+    lengths = np.hypot(d[:, 0], d[:, 1])
+    normals = np.stack([-d[:, 1], d[:, 0]], axis=1) / lengths[:, np.newaxis]
+    # One orientation per group, so the normal can point to the larger axis
+    flip = normals[np.arange(len(normals)), np.argmax(np.abs(normals), axis=1)] < 0
+    normals[flip] *= -1
+    angles = np.arctan2(normals[:, 1], normals[:, 0])
+    offsets = np.einsum('ij,ij->i', normals, segments[:, :2])
+
+    # close[i, j]: segment i runs along the line of segment j
+    ends = segments.reshape(-1, 2, 2)
+    distances = np.abs(np.einsum('ipk,jk->ijp', ends, normals) - offsets[np.newaxis, :, np.newaxis])
+    close = ((np.abs(angles[:, np.newaxis] - angles[np.newaxis, :]) < LINE_MERGE_ANGLE) &
+             (distances.max(axis=-1) < LINE_MERGE_DISTANCE * diagonal))
+
+    # Longest segments first, each one joins the first group whose line
+    # (that of its longest segment) it runs along
+    groups = []
+    refs = []
+    for i in np.argsort(-lengths, kind='stable'):
+        matches = np.flatnonzero(close[i, refs]) if refs else ()
+        if len(matches):
+            groups[matches[0]].append(i)
+        else:
+            groups.append([i])
+            refs.append(i)
+
+    # Rank by how far a line reaches rather than by how much of it was
+    # detected: page edges are often broken into pieces by noise and shading,
+    # while lines of text are solid but shorter than the page
+    spans = []
+    for group in groups:
+        along = segments[group].reshape(-1, 2) @ np.array([normals[group[0], 1], -normals[group[0], 0]])
+        spans.append(along.max() - along.min())
+
+    lines = []
+    for k in np.argsort(-np.array(spans), kind='stable')[:LINE_CANDIDATES]:
+        points = segments[groups[k]].reshape(-1, 2)
+        vx, vy, x0, y0 = cv2.fitLine(points, cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+        a, b = -vy, vx
+        if (abs(a) > abs(b) and a < 0) or (abs(b) >= abs(a) and b < 0):
+            a, b = -a, -b
+        lines.append((a, b, a * x0 + b * y0))
+    return np.array(lines, dtype="float64")
+
+
+def intersect_lines(first, second):
+    """(len(first), len(second), 2) intersections of two sets of a, b, c lines, NaN when parallel"""
+    a1, b1, c1 = (first[:, k][:, np.newaxis] for k in range(3))
+    a2, b2, c2 = (second[:, k][np.newaxis, :] for k in range(3))
+    det = a1 * b2 - a2 * b1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(np.abs(det) > 1e-6, (c1 * b2 - c2 * b1) / det, np.nan)
+        y = np.where(np.abs(det) > 1e-6, (a1 * c2 - a2 * c1) / det, np.nan)
+    return np.stack([x, y], axis=-1)
+
+
+def side_support(edges, corners):
+    """
+    Fraction of each side between every pair of corners on one line that lies on an edge
+
+    Args:
+        edges: Dilated binary edge map
+        corners: (L, K, 2) intersections of L lines with K crossing lines
+
+    Returns:
+        (L, K, K) array, [l, j, k] is the support of line l between crossings j and k
+    """
+    height, width = edges.shape[:2]
+    t = np.linspace(0.0, 1.0, LINE_SIDE_SAMPLES)[:, np.newaxis]
+    start = corners[:, :, np.newaxis, np.newaxis, :]
+    end = corners[:, np.newaxis, :, np.newaxis, :]
+    points = np.nan_to_num(start + (end - start) * t, nan=-1.0)
+    xs = np.rint(points[..., 0]).astype(np.int64)
+    ys = np.rint(points[..., 1]).astype(np.int64)
+    inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    hits = np.zeros(xs.shape, dtype=bool)
+    hits[inside] = edges[ys[inside], xs[inside]] > 0
+    return hits.mean(axis=-1)
+
+
+def strategy_line_quad(stages, min_area, max_area):
+    """
+    Line engine: fit the four dominant page edges and intersect them
+
+    Hough segments are split into roughly horizontal and vertical sets and
+    merged into lines. Every pair of horizontal lines is combined with every
+    pair of vertical lines; the largest quad whose four corners are inside
+    the frame and whose four sides mostly lie on edges wins. Corners come
+    from line intersections, so a corner hidden under a thumb or off a torn
+    edge is still placed where the page edges meet.
+    """
+    height, width = stages.image.shape[:2]
+    segments = stages.line_segments()
+    if len(segments) < 4:
+        return None
+
+    d = segments[:, 2:] - segments[:, :2]
+    horizontal = np.abs(d[:, 0]) >= np.abs(d[:, 1])
+    diagonal = float(np.hypot(width, height))
+    rows = merge_segments(segments[horizontal], diagonal)
+    cols = merge_segments(segments[~horizontal], diagonal)
+    if len(rows) < 2 or len(cols) < 2:
+        return None
+
+    # Top to bottom and left to right, so i < j means above / left of
+    rows = rows[np.argsort((rows[:, 2] - rows[:, 0] * width / 2) / rows[:, 1])]
+    cols = cols[np.argsort((cols[:, 2] - cols[:, 1] * height / 2) / cols[:, 0])]
+
+    corners = intersect_lines(rows, cols)                 # [row, col]
+    edges = stages.edges(0)
+    row_support = side_support(edges, corners)            # [row, col, col]
+    col_support = side_support(edges, corners.transpose(1, 0, 2))  # [col, row, row]
+
+    r1, r2 = np.triu_indices(len(rows), 1)
+    c1, c2 = np.triu_indices(len(cols), 1)
+    r1, r2 = r1[:, np.newaxis], r2[:, np.newaxis]
+    c1, c2 = c1[np.newaxis, :], c2[np.newaxis, :]
+
+    quads = np.stack([corners[r1, c1], corners[r1, c2], corners[r2, c2], corners[r2, c1]], axis=-2)
+    support = np.minimum.reduce([row_support[r1, c1, c2], row_support[r2, c1, c2],
+                                 col_support[c1, r1, r2], col_support[c2, r1, r2]])
+
+    x, y = quads[..., 0], quads[..., 1]
+    area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1))
+    with np.errstate(invalid='ignore'):
+        inside = np.all((x >= -1) & (x <= width) & (y >= -1) & (y <= height), axis=-1)
+        valid = inside & (support >= LINE_MIN_SUPPORT) & (area >= min_area) & (area <= max_area)
+    if not valid.any():
+        return None
+
+    best = np.unravel_index(np.argmax(np.where(valid, area, -1.0)), area.shape)
+    return quads[best].reshape(4, 1, 2).astype("float32")
+
+
+def detection_strategies():
+    """Contour engine strategies in preference order as (name, fn(stages, min_area, max_area))"""
+    strategies = []
+    for index in range(len(EDGE_VARIANTS)):
+        strategies.append((f'edge_quad_{index}',
+                           lambda stages, lo, hi, index=index: strategy_edge_quad(stages, index, lo, hi)))
+    strategies.append(('approx_largest', strategy_approx_largest))
+    strategies.append(('white_region', strategy_white_region))
+    strategies.append(('convex_hull', strategy_convex_hull))
+    return strategies
+
+
+# Permissive last resorts of the contour engine: they accept some quad on
+# nearly every image, so the adaptive order never promotes them
+FALLBACK_STRATEGIES = ('approx_largest', 'white_region', 'convex_hull')
+
+
+def line_strategies():
+    """Line engine strategies"""
+    return [('line_quad', strategy_line_quad)]
+
+
+def auto_strategies():
+    """Auto engine: one Otsu calibrated edge pass, the contour cascade only when it finds nothing"""
+    return ([('edge_quad_auto', lambda stages, lo, hi: strategy_edge_quad(stages, 'auto', lo, hi))] +
+            detection_strategies())
+
+
+# Detection engines: name -> function returning the engine's strategies in
+# preference order. Strategies of every engine share one DetectionStages, so
+# an engine that combines others never computes an edge map twice.
+DETECTION_ENGINES = {
+    'contour': detection_strategies,
+    'lines': line_strategies,
+    'hybrid': lambda: line_strategies() + detection_strategies(),
+    'auto': auto_strategies,
+    # A single edge pass, the degraded profile under load (see DEGRADED_ENGINE)
+    'fast': lambda: detection_strategies()[:1],
+}
+
+
+def register_engine(name, strategies):
+    """Make a detection engine available to requests as detect_engine=name"""
+    DETECTION_ENGINES[name] = strategies
+
+
+def known_engine(engine):
+    """engine if it names a registered detection engine, BadRequest otherwise"""
+    if engine not in DETECTION_ENGINES:
+        raise BadRequest(f"Unknown detection engine '{engine}', expected one of {', '.join(DETECTION_ENGINES)}")
+    return engine
+
+
+def engine_strategies(engine):
+    """Strategies of a registered detection engine"""
+    return DETECTION_ENGINES[known_engine(engine)]()
+
+
+# Capture quality: the page is shrunk by this fraction towards its centre
+# before measuring, so its own border does not count as sharp detail
+QUALITY_INSET = 0.06
+QUALITY_CLIP_LOW = 5        # gray levels at or below count as crushed shadows
+QUALITY_CLIP_HIGH = 250     # ... at or above as blown highlights
+
+
+def capture_quality(stages, pts=None):
+    """
+    Confidence, sharpness and exposure of a capture from the detection stages
+
+    Everything is measured on the grayscale detection proxy that detection
+    already computed, inside the page (or over the whole frame when no page
+    was found), so it costs a Laplacian and a histogram of at most
+    DETECT_MAX_EDGE sized pixels. Sharpness depends on that scale: compare
+    values between requests with the same detect_max_edge.
+
+    Args:
+        stages: DetectionStages of the image
+        pts: Page corners in proxy coordinates, None for the whole frame
+
+    Returns:
+        Dict with
+            confidence: fraction of the page outline on a dilated edge
+                map, 0 when no page was found
+            sharpness: variance of the Laplacian, low means blurred
+            brightness: mean gray level, 0..255
+            contrast: spread between the 2nd and 98th gray percentiles, 0..1
+            clipped: fraction of pixels crushed to black or blown to white
+    """
+    gray = stages.gray()
+    height, width = gray.shape[:2]
+    mask = None
+    confidence = 0.0
+
+    if pts is not None:
+        rect = order_points(pts.astype("float32"))
+        # Each side as a line between its two corners, see side_support
+        sides = np.stack([rect, np.roll(rect, -1, axis=0)], axis=1)
+        # The auto engine's edge map when it found the page, no extra Canny pass
+        edges = stages.edges('auto' if stages.computed('edges_auto') else 0)
+        confidence = float(side_support(edges, sides)[:, 0, 1].mean())
+
+        centre = rect.mean(axis=0)
+        inner = centre + (rect - centre) * (1.0 - QUALITY_INSET)
+        x0, y0 = np.maximum(np.floor(inner.min(axis=0)).astype(int), 0)
+        x1, y1 = np.minimum(np.ceil(inner.max(axis=0)).astype(int) + 1, (width, height))
+        if x1 - x0 > 2 and y1 - y0 > 2:
+            gray = gray[y0:y1, x0:x1]
+            mask = np.zeros(gray.shape, dtype=np.uint8)
+            cv2.fillConvexPoly(mask, np.rint(inner - (x0, y0)).astype(np.int32), 255)
+
+    laplacian = cv2.Laplacian(gray, cv2.CV_16S)
+    _, deviation = cv2.meanStdDev(laplacian, mask=mask)
+
+    histogram = cv2.calcHist([gray], [0], mask, [256], [0, 256]).ravel()
+    total = max(float(histogram.sum()), 1.0)
+    cumulative = np.cumsum(histogram) / total
+    low, high = np.searchsorted(cumulative, (0.02, 0.98))
+    clipped = (histogram[:QUALITY_CLIP_LOW + 1].sum() + histogram[QUALITY_CLIP_HIGH:].sum()) / total
+
+    return {
+        'confidence': round(confidence, 3),
+        'sharpness': round(float(deviation[0, 0]) ** 2, 1),
+        'brightness': round(float(np.dot(histogram, np.arange(256))) / total, 1),
+        'contrast': round(float(high - low) / 255.0, 3),
+        'clipped': round(float(clipped), 4),
+    }
+
+
+def record_quality(stats, stages, pts=None):
+    """Measure capture_quality into stats['quality'] as its own stage, nothing without stats"""
+    if stats is None:
+        return None
+    start = time.perf_counter()
+    quality = stats['quality'] = capture_quality(stages, pts)
+    record_stage(stats, 'quality', start)
+    return quality
+
+
+# Brightness buckets of the adaptive order by mean gray level of the proxy,
+# brighter images fall in 'bright'
+BRIGHTNESS_BUCKETS = ((60, 'dark'), (120, 'dim'))
+
+strategy_scheduler = StrategyScheduler(ADAPTIVE_STATS_PATH, ADAPTIVE_EXPLORE, fixed=FALLBACK_STRATEGIES)
+if ADAPTIVE_STATS_PATH:
+    atexit.register(strategy_scheduler.save)
+
+
+def strategy_bucket(engine, stages, stats=None):
+    """Adaptive order bucket of an image: engine, megapixel bucket and brightness"""
+    brightness = cv2.mean(stages.gray())[0]
+    label = next((name for bound, name in BRIGHTNESS_BUCKETS if brightness < bound), 'bright')
+    megapixels = stats.get('megapixels') if stats is not None else None
+    return f"{engine}/{metrics.megapixel_bucket(megapixels)}/{label}"
+
+
+def adaptive_order(strategies, engine, stages, stats=None):
+    """
+    strategies in strategy_scheduler's order for the image's bucket
+
+    Returns:
+        (strategies, bucket, order): order is 'adaptive', 'explore' or, when
+        the deadline left no time to measure the image, 'fixed' with the
+        engine's own order and bucket None
+    """
+    try:
+        bucket = strategy_bucket(engine, stages, stats)
+    except DeadlineExceeded:
+        return strategies, None, 'fixed'
+    by_name = dict(strategies)
+    names, explored = strategy_scheduler.order(bucket, [name for name, _ in strategies])
+    return [(name, by_name[name]) for name in names], bucket, 'explore' if explored else 'adaptive'
+
+
+def find_document_corners(image, debug_images=None, accept=None, stats=None, concurrent=False,
+                          engine=DETECT_ENGINE, deadline=None):
+    """
+    Run the detection strategies and return the first acceptable quadrilateral
+
+    Strategies run in preference order and only escalate when the cheaper
+    ones found nothing, so most images never pay for the bilateral filter or
+    the threshold pass.
+
+    In concurrent mode every strategy is submitted to the detection pool up
+    front, but results are still consumed in preference order: the answer is
+    the same as the sequential one, it just arrives sooner when the early
+    strategies fail. Work that can no longer change the result is cancelled.
+
+    With ADAPTIVE_ORDER the preference order is the engine's strategies
+    ranked by strategy_scheduler for the image's bucket (see adaptive_order),
+    and every complete cascade is counted there.
+
+    Past deadline no further stage or strategy starts. The answer is then the
+    most preferred acceptable result among the strategies that did finish
+    (concurrent mode may have later ones ready), or None, and
+    stats['truncated'] is set.
+
+    Args:
+        image: Input BGR image (usually the detection proxy)
+        debug_images: Optional dict that collects intermediate images
+        accept: Optional callable(pts) -> bool, rejected candidates escalate
+        stats: Optional dict that collects the stages run, the engine, the
+            strategy used, 'fallback': whether the engine had to go past
+            its first strategy (in its own order, whatever the adaptive
+            one), 'order': 'fixed', 'adaptive' or 'explore',
+            'cascade_ms': time spent in the strategies, and 'quality' (see
+            capture_quality)
+        concurrent: Run the strategies on the detection thread pool
+        engine: Name of the detection engine whose strategies run
+        deadline: Optional time.perf_counter() value to stop searching at
+
+    Returns:
+        Unordered 4x2 array of corner points in image coordinates, or None
+    """
+    height, width = image.shape[:2]
+    min_area = (width * height) * 0.1  # Document must be at least 10% of image
+    max_area = (width * height) * 0.95  # But not more than 95%
+
+    stages = DetectionStages(image, stats, debug_images, detection_buffers(concurrent), deadline)
+    strategies = engine_strategies(engine)
+    # Fallback is measured against the engine's own order, not the adaptive one
+    first = strategies[0][0]
+    bucket, order = None, 'fixed'
+    if ADAPTIVE_ORDER:
+        strategies, bucket, order = adaptive_order(strategies, engine, stages, stats)
+    if stats is not None:
+        stats['engine'] = engine
+        stats['order'] = order
+
+    timings = {}
+    # Concurrent strategies record into stats of their own: those still running
+    # once the answer is chosen must not write to the request's, only the ones
+    # the answer was taken from are merged into it below
+    own_stats = {name: {} for name, _ in strategies} if concurrent and stats is not None else {}
+
+    def run(name, strategy):
+        if deadline_passed(deadline):
+            raise DeadlineExceeded(name)
+        target = own_stats.get(name, stats)
+        # Strategy time includes the stages it had to compute first
+        start = time.perf_counter()
+        stages.record_into(own_stats.get(name))
+        try:
+            best_contour = strategy(stages, min_area, max_area)
+        finally:
+            stages.record_into(None)
+        timings[name] = round((time.perf_counter() - start) * 1000.0, 2)
+        if target is not None:
+            target.setdefault('strategies', []).append({'name': name, 'ms': timings[name]})
+        return best_contour
+
+    def acceptable(best_contour):
+        if best_contour is None or len(best_contour) != 4:
+            return None
+        pts = best_contour.reshape(4, 2)
+        if accept is not None and not accept(pts):
+            return None
+        return pts
+
+    cascade_start = time.perf_counter()
+    if concurrent:
+        pool = detection_pool()
+        futures = [(name, pool.submit(run, name, strategy)) for name, strategy in strategies]
+        candidates = ((name, wait_result(future, deadline)) for name, future in futures)
+    else:
+        futures = []
+        candidates = ((name, run(name, strategy)) for name, strategy in strategies)
+
+    found = None
+    tried = []
+    truncated = False
+    try:
+        for name, best_contour in candidates:
+            tried.append(name)
+            pts = acceptable(best_contour)
+            if pts is not None:
+                found = name, best_contour, pts
+                break
+    except DeadlineExceeded:
+        truncated = True
+        # Best answer so far: a later strategy may already have finished
+        for name, future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                pts = acceptable(future.result())
+                if pts is not None:
+                    found = name, future.result(), pts
+                    break
+    finally:
+        # Drop queued strategies that can no longer change the result
+        for _, future in futures:
+            future.cancel()
+
+    if own_stats:
+        # The strategies consumed in order, and a later one picked past the deadline
+        kept = tried + [found[0]] if found is not None and found[0] not in tried else tried
+        for name in kept:
+            for key in ('stages', 'strategies'):
+                stats.setdefault(key, []).extend(own_stats[name].get(key, ()))
+
+    if stats is not None:
+        # A hinted search may run a window and then the whole frame
+        elapsed = (time.perf_counter() - cascade_start) * 1000.0
+        stats['cascade_ms'] = round(stats.get('cascade_ms', 0.0) + elapsed, 2)
+    # Quality is still measured past the deadline, it is cheap
+    stages.deadline = None
+    if stats is not None and truncated:
+        stats['truncated'] = True
+    quality = record_quality(stats, stages, found[2] if found else None)
+
+    if bucket is not None and not truncated:
+        # A truncated cascade says nothing about the strategies it skipped.
+        # Wins are scored by how much of the page outline lies on edges, so
+        # a loose quad that was merely accepted does not count in full
+        score = 0.0
+        if found is not None:
+            score = (quality or capture_quality(stages, found[2]))['confidence']
+        strategy_scheduler.record(bucket, [(name, timings[name]) for name in tried],
+                                  found[0] if found else None, order == 'explore', score)
+
+    if found is not None:
+        name, best_contour, pts = found
+        if stats is not None:
+            stats['strategy'] = name
+            stats['fallback'] = name != first
+        if debug_images is not None:
+            # Draw the detected contour
+            debug_img = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+            cv2.drawContours(debug_img, [best_contour.astype(np.int32)], -1, (0, 255, 0), 3)
+            debug_images['07_detected_contour'] = debug_img
+        return pts
+
+    if stats is not None:
+        stats['strategy'] = None
+        stats['fallback'] = True
+    return None
+
+
+# Multi-document mode tuning, areas relative to the proxy
+MULTI_MIN_AREA = 0.02       # smallest page, fraction of the frame
+MULTI_MAX_OVERLAP = 0.1     # fraction of a quad that may lie inside a larger page already taken
+
+
+def multi_sources(stages):
+    """Contour sources of multi-document mode in preference order as (name, fn() -> (contours, areas))"""
+    def edge_source(index):
+        return lambda: (stages.edge_contours(index), stages.contour_areas(index))
+
+    def threshold_source():
+        contours = stages.threshold_contours()
+        return contours, contour_area_array(contours)
+
+    sources = [(f'multi_edge_{index}', edge_source(index)) for index in range(len(EDGE_VARIANTS))]
+    sources.append(('multi_threshold', threshold_source))
+    return sources
+
+
+def contour_quads(contours, areas, min_area, max_area, accept=None):
+    """
+    Convex 4-sided approximations of the contours within the area limits
+
+    Same shape rules as strategy 1 (approxPolyDP at 2% of the perimeter,
+    bounding box aspect between 0.3 and 3), plus convexity, which pages have
+    and the text blocks printed on them often do not.
+
+    Returns:
+        List of (area, float32 4x2 corners)
+    """
+    quads = []
+    for i in quad_candidates(areas, min_area, max_area):
+        contour = contours[i]
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) != 4 or not cv2.isContourConvex(approx):
+            continue
+        x, y, w, h = cv2.boundingRect(approx)
+        if not 0.3 <= (float(w) / h if h > 0 else 0) <= 3.0:
+            continue
+        pts = approx.reshape(4, 2).astype("float32")
+        if accept is not None and not accept(pts):
+            continue
+        quads.append((cv2.contourArea(pts), pts))
+    return quads
+
+
+def select_documents(quads, limit):
+    """
+    Largest quads first, skipping any that overlap a page already taken
+
+    The inner and outer contour of one page edge, and blocks printed on a
+    page, all overlap the page itself, so each page is taken once.
+
+    Returns:
+        Corners of the selected quads, at most limit
+    """
+    taken = []
+    for area, pts in sorted(quads, key=lambda quad: -quad[0]):
+        if area <= 0:
+            continue
+        if any(cv2.intersectConvexConvex(pts, other)[0] > MULTI_MAX_OVERLAP * area for other in taken):
+            continue
+        taken.append(pts)
+        if len(taken) == limit:
+            break
+    return taken
+
+
+def reading_order(pages):
+    """Pages top to bottom, pages side by side (centre above the row's first page bottom) left to right"""
+    rows = []
+    for pts in sorted(pages, key=lambda pts: pts[:, 1].mean()):
+        if rows and pts[:, 1].mean() < rows[-1][0][:, 1].max():
+            rows[-1].append(pts)
+        else:
+            rows.append([pts])
+    return [pts for row in rows for pts in sorted(row, key=lambda pts: pts[:, 0].mean())]
+
+
+def find_documents(image, debug_images=None, accept=None, stats=None, limit=None, deadline=None):
+    """
+    Find every page in an image, for photos of several receipts or pages
+
+    Works on the contour lists the contour engine already computes: every
+    convex quadrilateral of the first edge map is a candidate, and the
+    largest ones that do not overlap are the pages. Only when an edge map
+    yields no page at all does the search escalate to the next edge map
+    and finally to the bright region threshold, like the single page
+    cascade. Pages may be as small as MULTI_MIN_AREA of the frame.
+
+    Args:
+        image: Input BGR image (usually the detection proxy)
+        debug_images: Optional dict that collects intermediate images
+        accept: Optional callable(pts) -> bool, rejected quads are dropped
+            before the overlap test
+        stats: Optional dict that collects the stages run and, as in
+            find_document_corners, 'engine', 'strategy', 'fallback' and
+            'quality', a list with one entry per page when pages were found
+        limit: Most pages to return, MULTI_MAX_DOCUMENTS when None
+        deadline: Optional time.perf_counter() value, past it no further
+            source is tried and stats['truncated'] is set
+
+    Returns:
+        List of unordered 4x2 corner arrays in image coordinates in reading
+        order (see reading_order), empty when nothing was found
+    """
+    height, width = image.shape[:2]
+    min_area = (width * height) * MULTI_MIN_AREA
+    max_area = (width * height) * 0.95
+
+    stages = DetectionStages(image, stats, debug_images, detection_buffers(False), deadline)
+    sources = multi_sources(stages)
+    if stats is not None:
+        stats['engine'] = 'multi'
+
+    pages = []
+    for name, source in sources:
+        start = time.perf_counter()
+        try:
+            contours, areas = source()
+        except DeadlineExceeded:
+            if stats is not None:
+                stats.update(truncated=True, strategy=None, fallback=True)
+            break
+        pages = select_documents(contour_quads(contours, areas, min_area, max_area, accept),
+                                 limit or MULTI_MAX_DOCUMENTS)
+        if stats is not None:
+            elapsed = (time.perf_counter() - start) * 1000.0
+            stats.setdefault('strategies', []).append({'name': name, 'ms': round(elapsed, 2)})
+        if pages:
+            if stats is not None:
+                stats['strategy'] = name
+                stats['fallback'] = name != sources[0][0]
+            break
+    else:
+        if stats is not None:
+            stats['strategy'] = None
+            stats['fallback'] = True
+
+    pages = reading_order(pages)
+    stages.deadline = None
+    if stats is not None and pages:
+        stats['quality'] = [record_quality(stats, stages, pts) for pts in pages]
+    elif stats is not None:
+        record_quality(stats, stages)
+    if debug_images is not None and pages:
+        debug_img = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if image.ndim == 2 else image.copy()
+        cv2.drawContours(debug_img, [pts.astype(np.int32) for pts in pages], -1, (0, 255, 0), 3)
+        debug_images['07_detected_contour'] = debug_img
+    return pages
+
+
+def is_valid_document_shape(rect, img_width, img_height):
+    """
+    Validate that the detected rectangle is a reasonable document shape
+    
+    Args:
+        rect: Ordered points of rectangle
+        img_width: Original image width
+        img_height: Original image height
+    
+    Returns:
+        bool: True if valid document shape
+    """
+    (tl, tr, br, bl) = rect
+    
+    # Calculate width and height
+    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
+    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
+    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
+    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
+    
+    maxWidth = max(int(widthA), int(widthB))
+    maxHeight = max(int(heightA), int(heightB))
+    
+    # Check if dimensions are reasonable
+    if maxWidth < 50 or maxHeight < 50:
+        return False
+    
+    # Check aspect ratio (typical document ratios: A4 is ~1.414, Letter is ~1.294)
+    aspect_ratio = maxWidth / maxHeight if maxHeight > 0 else 0
+    
+    # Allow aspect ratios between 1:3 and 3:1
+    if aspect_ratio < 0.33 or aspect_ratio > 3.0:
+        return False
+    
+    # Check that it's not too close to image boundaries (likely the image itself)
+    min_margin = 10
+    if (tl[0] < min_margin and tr[0] > img_width - min_margin and
+        tl[1] < min_margin and bl[1] > img_height - min_margin):
+        return False
+    
+    return True
+
+
+def order_points(pts):
+    """Order points in top-left, top-right, bottom-right, bottom-left order"""
+    rect = np.zeros((4, 2), dtype="float32")
+    
+    # Sum and diff to find corners
+    s = pts.sum(axis=1)
+    diff = np.diff(pts, axis=1)
+    
+    rect[0] = pts[np.argmin(s)]      # top-left (smallest sum)
+    rect[2] = pts[np.argmax(s)]      # bottom-right (largest sum)
+    rect[1] = pts[np.argmin(diff)]   # top-right (smallest difference)
+    rect[3] = pts[np.argmax(diff)]   # bottom-left (largest difference)
+    
+    return rect
+
+
+def page_size(rect):
+    """Measured (width, height) in pixels of the page with ordered corners rect"""
+    (tl, tr, br, bl) = rect
+    
+    # Calculate width
+    widthA = np.sqrt(((br[0] - bl[0]) ** 2) + ((br[1] - bl[1]) ** 2))
+    widthB = np.sqrt(((tr[0] - tl[0]) ** 2) + ((tr[1] - tl[1]) ** 2))
+    maxWidth = max(int(widthA), int(widthB))
+    
+    # Calculate height
+    heightA = np.sqrt(((tr[0] - br[0]) ** 2) + ((tr[1] - br[1]) ** 2))
+    heightB = np.sqrt(((tl[0] - bl[0]) ** 2) + ((tl[1] - bl[1]) ** 2))
+    maxHeight = max(int(heightA), int(heightB))
+    
+    # Ensure minimum dimensions
+    return max(maxWidth, 100), max(maxHeight, 100)
+
+
+def output_size(width, height, max_edge=0, paper=None, dpi=OUTPUT_DPI):
+    """
+    Size of the warped page for the requested output
+
+    Args:
+        width: Measured page width in source pixels
+        height: Measured page height in source pixels
+        max_edge: Largest long edge of the output, 0 for no limit. Only
+            ever shrinks the page.
+        paper: Name from PAPER_SIZES: the output gets that paper's size at
+            dpi, in the orientation of the measured page
+        dpi: Resolution for paper
+
+    Returns:
+        (width, height) of the output in pixels
+    """
+    if paper:
+        short_mm, long_mm = PAPER_SIZES[paper]
+        short_px, long_px = (int(round(mm / 25.4 * dpi)) for mm in (short_mm, long_mm))
+        width, height = (long_px, short_px) if width > height else (short_px, long_px)
+
+    if max_edge and max(width, height) > max_edge:
+        shrink = max_edge / float(max(width, height))
+        width, height = max(1, int(round(width * shrink))), max(1, int(round(height * shrink)))
+    return width, height
+
+
+def page_transform(pts, max_edge=0, paper=None, dpi=OUTPUT_DPI):
+    """
+    Perspective matrix and output size that map the page onto an upright rectangle
+
+    The output size (see output_size) is part of the destination points, so
+    a scaled output comes out of the single warpPerspective call instead of
+    a full size warp followed by a resize.
+
+    Returns:
+        (M, (width, height))
+    """
+    rect = order_points(pts)
+    maxWidth, maxHeight = output_size(*page_size(rect), max_edge=max_edge, paper=paper, dpi=dpi)
+    
+    # Destination points
+    dst = np.array([
+        [0, 0],
+        [maxWidth - 1, 0],
+        [maxWidth - 1, maxHeight - 1],
+        [0, maxHeight - 1]
+    ], dtype="float32")
+    
+    M = cv2.getPerspectiveTransform(rect, dst)
+    return M, (maxWidth, maxHeight)
+
+
+def four_point_transform(image, pts, max_edge=0, paper=None, dpi=OUTPUT_DPI):
+    """Apply perspective transform to get bird's eye view"""
+    M, size = page_transform(pts, max_edge, paper, dpi)
+    return cv2.warpPerspective(image, M, size)
+
+
+def warp_and_encode(image, pts, stats=None, max_edge=0, paper=None, dpi=OUTPUT_DPI, quality=0):
+    """
+    Warp the page out of image and encode it as JPEG
+
+    Outputs larger than WARP_STRIP_BYTES are rendered in horizontal strips,
+    each from the same homography shifted to the strip's first row, and
+    every strip goes straight into a StripEncoder. Peak memory is then the
+    source image plus one strip plus the compressed page.
+
+    Args:
+        image: Source image
+        pts: Page corners in image coordinates
+        stats: Optional dict that collects stage timings
+        max_edge, paper, dpi: Output options (see output_size)
+        quality: JPEG quality 1-100, 0 for OpenCV's default (95)
+
+    Returns:
+        (jpeg buffer as a uint8 array, width, height)
+    """
+    M, (width, height) = page_transform(pts, max_edge, paper, dpi)
+    channels = image.shape[2] if image.ndim == 3 else 1
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality] if quality else []
+
+    if not WARP_STRIP_BYTES or width * height * channels <= WARP_STRIP_BYTES:
+        start = time.perf_counter()
+        warped = cv2.warpPerspective(image, M, (width, height))
+        record_stage(stats, 'warp', start)
+
+        start = time.perf_counter()
+        _, buffer = cv2.imencode('.jpg', warped, params)
+        record_stage(stats, 'imencode', start)
+        return buffer, width, height
+
+    start = time.perf_counter()
+    rows = strip_rows(width, channels, WARP_STRIP_BYTES)
+    strip = np.empty((rows,) + (width,) + image.shape[2:], dtype=image.dtype)
+    encoder = StripEncoder(width, height, params)
+    for top in range(0, height, rows):
+        count = min(rows, height - top)
+        shift = np.array([[1, 0, 0], [0, 1, -top], [0, 0, 1]], dtype=np.float64)
+        cv2.warpPerspective(image, shift @ M, (width, count), dst=strip[:count])
+        encoder.write(strip[:count])
+    record_stage(stats, 'warp_encode_strips', start)
+    return np.frombuffer(encoder.finish(), np.uint8), width, height
+
+
+def save_debug_images(debug_images, prefix="debug", directory="debug_output"):
+    """Save debug images to disk for inspection"""
+    os.makedirs(directory, exist_ok=True)
+    
+    for name, img in debug_images.items():
+        cv2.imwrite(os.path.join(directory, f"{prefix}_{name}.jpg"), img)
+    
+    print(f"Saved {len(debug_images)} debug images to {directory}/")
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'healthy'}), 200
+
+def parse_flag(value):
+    """Boolean from a JSON value or a query string / header value"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def parse_hint(value):
+    """Hint corners as a tuple of 8 numbers from [[x, y], ...], a flat list or "x1,y1,...,x4,y4", None when absent"""
+    if value is None or value == '':
+        return None
+    try:
+        if isinstance(value, str):
+            values = value.split(',')
+        else:
+            values = [v for point in value for v in (point if isinstance(point, (list, tuple)) else [point])]
+        corners = tuple(float(v) for v in values)
+    except (TypeError, ValueError):
+        corners = ()
+    if len(corners) != 8 or not np.all(np.isfinite(corners)):
+        raise BadRequest('detect_hint must be four x, y corner pairs')
+    return corners
+
+
+def int_option(data, name, default):
+    """Integer request option, BadRequest when it is not one"""
+    value = data.get(name, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f'{name} must be an integer, got {value!r}') from None
+
+
+def detection_options(data):
+    """Keyword arguments for decode_and_detect from a request body or query string"""
+    paper = data.get('output_paper') or None
+    if paper is not None:
+        paper = str(paper).lower()
+        if paper not in PAPER_SIZES:
+            raise BadRequest(f"Unknown output paper '{paper}', expected one of {', '.join(PAPER_SIZES)}")
+    dpi = int_option(data, 'output_dpi', OUTPUT_DPI)
+    if not 0 < dpi <= MAX_OUTPUT_DPI:
+        raise BadRequest(f'output_dpi must be between 1 and {MAX_OUTPUT_DPI}')
+    output_max_edge = max(0, int_option(data, 'output_max_edge', 0))
+    if paper is not None and MAX_OUTPUT_PIXELS:
+        # The paper fixes the output size, only output_max_edge can shrink it
+        width, height = output_size(1, 2, output_max_edge, paper, dpi)
+        if width * height > MAX_OUTPUT_PIXELS:
+            raise BadRequest(f'{paper} at {dpi} dpi is {width}x{height} pixels, '
+                             f'more than {MAX_OUTPUT_PIXELS}; lower output_dpi or set output_max_edge')
+    quality = int_option(data, 'output_quality', 0)
+    if not 0 <= quality <= 100:
+        raise BadRequest('output_quality must be between 1 and 100, or 0 for the default')
+
+    max_edge = int_option(data, 'detect_max_edge', DETECT_MAX_EDGE)
+    if max_edge < 0:
+        raise BadRequest('detect_max_edge must be 0 (full size) or more')
+
+    return {
+        'max_edge': max_edge,
+        'concurrent': parse_flag(data.get('detect_concurrent', DETECT_CONCURRENT)),
+        'engine': known_engine(str(data.get('detect_engine', DETECT_ENGINE))),
+        'output_max_edge': output_max_edge,
+        'output_paper': paper,
+        'output_dpi': dpi,
+        'output_quality': quality,
+        'multi': parse_flag(data.get('detect_multi', False)),
+        'hint': parse_hint(data.get('detect_hint')),
+    }
+
+
+# Results of recent uploads, keyed by image bytes and options (0 disables)
+RESULT_CACHE_BYTES = int(os.environ.get('RESULT_CACHE_BYTES', str(64 * 1024 * 1024)))
+result_cache = ResultCache(RESULT_CACHE_BYTES)
+
+
+def isolate_image(image_data, options, stats=None, deadline=None):
+    """
+    Decode, detect, warp and encode a single image, answering repeat uploads
+    of the same bytes with the same options from result_cache
+
+    Args:
+        image_data: Encoded image bytes (JPEG, PNG, ...)
+        options: Keyword arguments for detect_document
+        stats: Optional dict that collects stage timings (see detect_document)
+        deadline: Optional time.perf_counter() detection deadline, not part
+            of the cache key; truncated results are not cached
+
+    Returns:
+        (result, status) as returned by isolate_image_uncached, cache hits
+        carry 'cached': True and an empty stage list
+    """
+    if stats is None:
+        stats = {}
+
+    if not result_cache.max_bytes:
+        return isolate_image_uncached(image_data, options, stats, deadline)
+
+    key = cache_key(image_data, options)
+    cached = cached_result(key, stats)
+    if cached is not None:
+        return cached
+
+    result, status = isolate_image_uncached(image_data, options, stats, deadline)
+    cache_result(key, result, status, stats.get('megapixels'))
+    return result, status
+
+
+def cached_result(key, stats):
+    """(result, status) of result_cache entry key marked as a hit, None on a miss"""
+    cached = result_cache.get(key)
+    if cached is None:
+        return None
+    result, status, megapixels = cached
+    app.logger.info(f"Result cache hit: {key}")
+    stats['cached'] = True
+    stats['megapixels'] = megapixels
+    return dict(result, cached=True, stages=[]), status
+
+
+def cache_result(key, result, status, megapixels):
+    """Keep an isolate_image_uncached result in result_cache if it is worth keeping"""
+    # Invalid input is cheap to reject again, only cache real detections, and
+    # a truncated search may well succeed for a request with time to spare
+    if status in (200, 404) and not result['truncated']:
+        pages = result.get('documents', [result])
+        size = sum(page['encoded'].nbytes for page in pages if 'encoded' in page)
+        result_cache.put(key, (result, status, megapixels), size)
+
+
+def oversized_image(image_data):
+    """Error body when the JPEG / PNG header declares more than MAX_IMAGE_PIXELS, None otherwise"""
+    size = read_image_size(image_data)
+    if size and MAX_IMAGE_PIXELS and size[0] * size[1] > MAX_IMAGE_PIXELS:
+        return {
+            'error': f'Image of {size[0]}x{size[1]} pixels exceeds {MAX_IMAGE_PIXELS} pixels',
+            'document_detected': False
+        }
+    return None
+
+
+def isolate_image_uncached(image_data, options, stats=None, deadline=None):
+    """
+    Decode, detect, warp and encode a single image
+
+    Args:
+        image_data: Encoded image bytes (JPEG, PNG, ...)
+        options: Keyword arguments for detect_document
+        stats: Optional dict that collects stage timings (see detect_document)
+        deadline: Optional time.perf_counter() detection deadline (see
+            decode_and_detect)
+
+    Returns:
+        (result, status) following the /paper-isolate JSON contract, except
+        that a detected page is returned as the encoded JPEG buffer in
+        result['encoded'] (see json_payload). With options['multi'] the
+        pages are in result['documents'], each with its own 'encoded',
+        'width', 'height', 'corners' and 'quality'. 'quality' (see
+        capture_quality) is also reported when no page was found, for the
+        whole frame, so clients can tell a bad capture from an empty one.
+        'hint' is the outcome of a detect_hint search (see
+        locate_with_hint), None without one. 'truncated' is True when the
+        deadline cut detection short: a page found then is the best
+        candidate so far, and 404 means none was found in time. JPEGs and
+        PNGs whose header declares more than MAX_IMAGE_PIXELS are refused
+        with 413 without being decoded.
+    """
+    if stats is None:
+        stats = {}
+
+    # Refuse decompression bombs from the header, before decoding anything
+    too_large = oversized_image(image_data)
+    if too_large:
+        return too_large, 413
+
+    # Decode image, detect document, warp and encode it
+    page, detected, shape = decode_and_detect(image_data, stats=stats, encode=True, deadline=deadline, **options)
+    
+    if shape is None:
+        return {
+            'error': 'Invalid image data',
+            'document_detected': False
+        }, 400
+    
+    app.logger.info(f"Image decoded: {shape}")
+    app.logger.info(f"Detection stats: {stats}")
+    
+    if detected and page is not None and options.get('multi'):
+        app.logger.info(f"{len(page)} documents detected")
+
+        return {
+            'message': f'{len(page)} documents detected',
+            'document_detected': True,
+            'documents': [{
+                'encoded': buffer,
+                'width': int(width),
+                'height': int(height),
+                'corners': corners,
+                'quality': quality,
+            } for (buffer, width, height), corners, quality in zip(page, stats.get('corners'),
+                                                                   stats.get('quality'))],
+            'count': len(page),
+            'strategy': stats.get('strategy'),
+            'hint': stats.get('hint'),
+            'truncated': stats.get('truncated', False),
+            'degraded': stats.get('degraded', False),
+            'stages': stats.get('stages', [])
+        }, 200
+    elif detected and page is not None:
+        buffer, width, height = page
+        app.logger.info("Document detected successfully")
+        
+        return {
+            'message': 'Document detected successfully',
+            'document_detected': True,
+            'encoded': buffer,
+            'width': int(width),
+            'height': int(height),
+            'strategy': stats.get('strategy'),
+            'corners': stats.get('corners'),
+            'quality': stats.get('quality'),
+            'hint': stats.get('hint'),
+            'truncated': stats.get('truncated', False),
+            'degraded': stats.get('degraded', False),
+            'stages': stats.get('stages', [])
+        }, 200
+    else:
+        truncated = stats.get('truncated', False)
+        message = 'No document detected within the deadline' if truncated else 'No document detected'
+        app.logger.info(message)
+        return {
+            'message': message,
+            'document_detected': False,
+            'quality': stats.get('quality'),
+            'hint': stats.get('hint'),
+            'truncated': truncated,
+            'degraded': stats.get('degraded', False),
+            'stages': stats.get('stages', [])
+        }, 404
+
+
+def json_payload(result):
+    """Replace the encoded JPEG buffers of an isolate_image result with base64"""
+    if 'documents' in result:
+        result = dict(result, documents=[json_payload(page) for page in result['documents']])
+    if 'encoded' in result:
+        result = dict(result)
+        result['image'] = base64.b64encode(result.pop('encoded')).decode('utf-8')
+    return result
+
+
+# Content types accepted as a raw image body instead of base64-in-JSON
+RAW_MIMETYPES = ('image/jpeg', 'image/png', 'application/octet-stream')
+
+
+def read_body(req):
+    """
+    Read the request body into a single preallocated buffer
+
+    Returns a bytearray that np.frombuffer can wrap without copying, raises
+    BodyTooLarge past MAX_BODY_BYTES.
+    """
+    return read_stream(req.stream, req.content_length, MAX_BODY_BYTES)
+
+
+def request_deadline(req):
+    """
+    Detection deadline of a request as a time.perf_counter() value, or None
+
+    The tighter of DETECT_DEADLINE_MS and the request's X-Deadline-Ms
+    header, counted from the start of the request so the upload is part of
+    the budget.
+    """
+    budgets = [DETECT_DEADLINE_MS]
+    header = req.headers.get('X-Deadline-Ms')
+    if header:
+        try:
+            budgets.append(int(header))
+        except ValueError:
+            raise BadRequest(f'Invalid X-Deadline-Ms {header!r}') from None
+    budgets = [ms for ms in budgets if ms > 0]
+    if not budgets:
+        return None
+    return g.request_start + min(budgets) / 1000.0
+
+
+def paper_isolate_raw(stats):
+    """
+    Raw bytes variant of /paper-isolate
+
+    The body is the image itself, options come from the query string and the
+    detected page is returned as image/jpeg with its metadata in X- headers.
+    Errors, "no document" and multi-document results (several pages do not
+    fit one image/jpeg body) keep the JSON bodies of the JSON contract.
+    """
+    start = time.perf_counter()
+    image_data = read_body(request)
+    record_stage(stats, 'read', start)
+    if not image_data:
+        return jsonify({
+            'error': 'Empty request body',
+            'document_detected': False
+        }), 400
+
+    app.logger.info("Processing raw image request")
+
+    result, status = isolate_image(image_data, request_options(request.args, image_data, stats), stats,
+                                   request_deadline(request))
+    if 'encoded' not in result:
+        return jsonify(json_payload(result)), status
+
+    start = time.perf_counter()
+    response = Response(result['encoded'].tobytes(), status=status, mimetype='image/jpeg')
+    record_stage(stats, 'serialize', start)
+    response.headers['X-Document-Detected'] = 'true'
+    response.headers['X-Image-Width'] = str(result['width'])
+    response.headers['X-Image-Height'] = str(result['height'])
+    response.headers['X-Detection-Strategy'] = str(result['strategy'])
+    if result['hint']:
+        response.headers['X-Detection-Hint'] = result['hint']
+    if result['truncated']:
+        response.headers['X-Detection-Truncated'] = 'true'
+    if result['degraded']:
+        response.headers['X-Degraded'] = 'true'
+    for name, value in (result['quality'] or {}).items():
+        response.headers[f'X-Quality-{name.title()}'] = str(value)
+    return response
+
+
+# Directory where every worker process writes its metric series, so /metrics
+# reports all the workers whichever one answers the scrape (see metrics.py;
+# set by gunicorn.conf.py). Empty keeps the series per process.
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+metrics.configure(METRICS_DIR)
+
+STAGE_SECONDS = metrics.Histogram(
+    'paper_isolate_stage_seconds',
+    'Time spent in each stage of /paper-isolate',
+    ('stage', 'megapixels', 'strategy'),
+)
+STRATEGY_SECONDS = metrics.Histogram(
+    'paper_isolate_strategy_seconds',
+    'Time spent in each detection strategy, including the stages it computed',
+    ('name', 'megapixels', 'strategy'),
+)
+REQUEST_SECONDS = metrics.Histogram(
+    'paper_isolate_request_seconds',
+    'End to end time of /paper-isolate requests',
+    ('status', 'megapixels', 'strategy'),
+)
+DETECTIONS = metrics.Counter(
+    'paper_isolate_detections_total',
+    'Detections by engine and outcome: first (the first strategy sufficed), fallback, miss or '
+    'truncated (the deadline cut the search short)',
+    ('engine', 'outcome'),
+)
+CASCADE_SECONDS = metrics.Histogram(
+    'paper_isolate_cascade_seconds',
+    'Time spent in the detection strategies by engine and strategy order: fixed, adaptive or explore',
+    ('engine', 'order'),
+)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.stage_stats = None
+    # Synchronous detections count towards the load (see request_options)
+    g.load_tracked = request.endpoint == 'paper_isolate'
+    if g.load_tracked:
+        load_monitor.enter()
+
+
+@app.teardown_request
+def end_request_load(error=None):
+    if g.get('load_tracked'):
+        load_monitor.exit()
+
+
+@app.after_request
+def observe_request(response):
+    """Record per-stage metrics and add a Server-Timing header"""
+    stats = g.get('stage_stats')
+    if stats is None:
+        return response
+
+    total = time.perf_counter() - g.request_start
+    megapixels = metrics.megapixel_bucket(stats.get('megapixels'))
+    strategy = 'cached' if stats.get('cached') else (stats.get('strategy') or 'none')
+
+    timings = []
+    for stage in stats.get('stages', []):
+        STAGE_SECONDS.observe(stage['ms'] / 1000.0, stage=stage['name'], megapixels=megapixels, strategy=strategy)
+        timings.append(f"{stage['name']};dur={stage['ms']}")
+    for run in stats.get('strategies', []):
+        STRATEGY_SECONDS.observe(run['ms'] / 1000.0, name=run['name'], megapixels=megapixels, strategy=strategy)
+        timings.append(f"strategy_{run['name']};dur={run['ms']}")
+    REQUEST_SECONDS.observe(total, status=response.status_code, megapixels=megapixels, strategy=strategy)
+    if 'engine' in stats and not stats.get('cached'):
+        if stats.get('truncated'):
+            outcome = 'truncated'
+        elif stats.get('strategy') is None:
+            outcome = 'miss'
+        else:
+            outcome = 'fallback' if stats.get('fallback') else 'first'
+        DETECTIONS.inc(engine=stats['engine'], outcome=outcome)
+    if 'cascade_ms' in stats and not stats.get('cached'):
+        CASCADE_SECONDS.observe(stats['cascade_ms'] / 1000.0, engine=stats['engine'], order=stats['order'])
+    timings.append(f"total;dur={total * 1000.0:.2f}")
+
+    response.headers['Server-Timing'] = ', '.join(timings)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    cache_stats = result_cache.stats()
+    samples = [
+        ('paper_isolate_cache_hits_total', 'counter', 'Result cache hits', cache_stats['hits']),
+        ('paper_isolate_cache_misses_total', 'counter', 'Result cache misses', cache_stats['misses']),
+        ('paper_isolate_cache_evictions_total', 'counter', 'Result cache evictions', cache_stats['evictions']),
+        ('paper_isolate_cache_bytes', 'gauge', 'Bytes held by the result cache', cache_stats['bytes']),
+    ]
+    job_stats = job_queue.stats()
+    samples += [
+        ('paper_isolate_inflight', 'gauge', 'Images being processed by all workers', load_monitor.inflight()),
+        ('paper_isolate_degraded', 'gauge', 'New requests get the degraded profile',
+         int(load_monitor.is_degraded())),
+        ('paper_isolate_jobs_queued', 'gauge', 'Jobs waiting for a job thread in all workers',
+         queued_jobs.inflight()),
+        ('paper_isolate_jobs_running', 'gauge', 'Jobs being processed', job_stats['running']),
+        ('paper_isolate_jobs_completed_total', 'counter', 'Jobs finished', job_stats['completed']),
+        ('paper_isolate_jobs_rejected_total', 'counter', 'Jobs refused with a full queue', job_stats['rejected']),
+    ]
+    return Response(metrics.render(samples), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/paper-isolate', methods=['POST'])
+def paper_isolate():
+    stats = g.stage_stats = {}
+    try:
+        if request.mimetype in RAW_MIMETYPES:
+            return paper_isolate_raw(stats)
+
+        # Base64 is decoded while the body streams in (see uploads.py)
+        start = time.perf_counter()
+        data = read_json_image(request.stream, request.content_length, MAX_BODY_BYTES)
+        record_stage(stats, 'read', start)
+        
+        if not data or 'image' not in data:
+            return jsonify({
+                'error': 'Missing "image" field',
+                'document_detected': False
+            }), 400
+        
+        app.logger.info("Processing image request")
+        
+        image_data = data['image']
+        if not isinstance(image_data, memoryview):
+            raise BadRequest('"image" must be a base64 string')
+
+        options = request_options(data, image_data, stats)
+        result, status = isolate_image(image_data, options, stats, request_deadline(request))
+
+        start = time.perf_counter()
+        response = jsonify(json_payload(result))
+        record_stage(stats, 'serialize', start)
+        return response, status
+
+    except BodyTooLarge as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 413
+    except BadRequest as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 400
+    except Exception as e:
+        app.logger.error(f"Error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 500
+
+
+@app.route('/paper-isolate/cache', methods=['GET'])
+def paper_isolate_cache():
+    return jsonify(result_cache.stats()), 200
+
+
+@app.route('/paper-isolate/strategies', methods=['GET'])
+def paper_isolate_strategies():
+    """Adaptive strategy order: per bucket the current order, success rates and cascade time"""
+    return jsonify(dict(strategy_scheduler.stats(), enabled=ADAPTIVE_ORDER)), 200
+
+
+# Pages of /paper-isolate/batch processed at once by the whole service, one
+# per core by default. Every gunicorn worker has a pool of up to
+# BATCH_WORKERS processes (spawned on demand), so a single batch on an idle
+# host uses every core; batch_slots, shared by the workers, keeps concurrent
+# batches from starting more than BATCH_WORKERS pages at once. The price is
+# memory: under sustained batch traffic on several workers each pool grows
+# to BATCH_WORKERS idle processes.
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', '32'))
+
+# Seconds between checks for a free batch slot
+BATCH_SLOT_POLL = 0.01
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+batch_slots = LoadMonitor()
+
+
+def init_batch_worker():
+    """Batch workers already run one page per core, keep OpenCV single threaded"""
+    cv2.setNumThreads(1)
+
+
+def batch_pool():
+    """Process pool for batch requests, created on first use"""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            # spawn rather than fork: the parent may already be running
+            # detection or Flask threads that a forked child would inherit
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'),
+                                              initializer=init_batch_worker)
+        return _batch_pool
+
+
+def discard_batch_pool(pool):
+    """Forget a broken batch pool so the next batch starts a fresh one"""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is pool:
+            _batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def batch_image(entry):
+    """
+    Decoded image of a batch entry, checked in the request process so that
+    invalid and oversized images never reach the pool
+
+    Returns:
+        (image_data, None), or (None, (payload, status)) for a refused entry
+    """
+    if not isinstance(entry, str):
+        return None, ({'error': 'Batch entries must be base64 strings', 'document_detected': False}, 400)
+    try:
+        image_data = base64.b64decode(entry)
+    except ValueError:
+        image_data = None
+    if not image_data:
+        return None, ({'error': 'Invalid base64 image', 'document_detected': False}, 400)
+    too_large = oversized_image(image_data)
+    if too_large:
+        return None, (too_large, 413)
+    return image_data, None
+
+
+def isolate_batch_item(image_data, options):
+    """
+    Process one batch entry in a worker process, errors become the item's result
+
+    The request process looks the entry up in result_cache before and stores
+    the result after (see paper_isolate_batch): a cache in the worker would
+    be one more copy that no request ever hits.
+
+    Returns:
+        (result, status, megapixels) as for cache_result
+    """
+    try:
+        stats = {}
+        result, status = isolate_image_uncached(image_data, options, stats)
+        return result, status, stats.get('megapixels')
+    except Exception as e:
+        app.logger.error(f"Batch item error: {str(e)}")
+        return {
+            'error': str(e),
+            'document_detected': False
+        }, 500, None
+
+
+def submit_batch_item(pool, image_data, options):
+    """Submit a batch entry once one of the service's BATCH_WORKERS slots is free"""
+    while not batch_slots.try_enter(BATCH_WORKERS):
+        time.sleep(BATCH_SLOT_POLL)
+    try:
+        future = pool.submit(isolate_batch_item, image_data, options)
+    except BaseException:
+        batch_slots.exit()
+        raise
+    future.add_done_callback(lambda _: batch_slots.exit())
+    return future
+
+
+def batch_result(future, key):
+    """(payload, status) of a submitted batch entry, cached by the request process"""
+    result, status, megapixels = future.result()
+    if key is not None and status != 500:
+        cache_result(key, result, status, megapixels)
+    return json_payload(result), status
+
+
+@app.route('/paper-isolate/batch', methods=['POST'])
+def paper_isolate_batch():
+    try:
+        # Same body limit as /paper-isolate, enforced while reading
+        body = read_body(request)
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            raise BadRequest(f'Invalid JSON body: {e}') from None
+        if not isinstance(data, dict):
+            raise BadRequest('Request body must be a JSON object')
+
+        if not data or not isinstance(data.get('images'), list) or not data['images']:
+            return jsonify({
+                'error': 'Missing "images" list',
+                'document_detected': False
+            }), 400
+
+        images = data['images']
+        if len(images) > BATCH_MAX_IMAGES:
+            return jsonify({
+                'error': f'At most {BATCH_MAX_IMAGES} images per batch',
+                'document_detected': False
+            }), 413
+        
+        app.logger.info(f"Processing batch of {len(images)} images")
+
+        # Pages already run in parallel, keep each one single threaded
+        options = detection_options(data)
+        options['concurrent'] = False
+
+        pool = batch_pool()
+        answers = [None] * len(images)     # (payload, status) per entry
+        submitted = []                     # (index, future, cache key)
+        with load_monitor.track(len(images)):
+            for index, entry in enumerate(images):
+                image_data, answers[index] = batch_image(entry)
+                if answers[index] is not None:
+                    continue
+                # Repeat pages are answered here, from the cache requests share
+                key = cache_key(image_data, options) if result_cache.max_bytes else None
+                cached = cached_result(key, {}) if key is not None else None
+                if cached is not None:
+                    answers[index] = json_payload(cached[0]), cached[1]
+                    continue
+                submitted.append((index, submit_batch_item(pool, image_data, options), key))
+
+            for index, future, key in submitted:
+                try:
+                    answers[index] = batch_result(future, key)
+                except Exception as e:
+                    # The worker itself died (e.g. out of memory), not just the image
+                    app.logger.error(f"Batch worker error: {str(e)}")
+                    if isinstance(e, BrokenProcessPool):
+                        discard_batch_pool(pool)
+                    answers[index] = {'error': str(e), 'document_detected': False}, 500
+
+        results = []
+        for index, (payload, status) in enumerate(answers):
+            payload['index'] = index
+            payload['status'] = status
+            results.append(payload)
+
+        return jsonify({
+            'results': results,
+            'count': len(results),
+            'detected': sum(1 for result in results if result['document_detected'])
+        }), 200
+
+    except BodyTooLarge as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 413
+    except BadRequest as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 400
+    except Exception as e:
+        app.logger.error(f"Error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 500
+
+# Asynchronous jobs (/paper-isolate/jobs) for images that may outlast a
+# gateway timeout: JOB_WORKERS threads per worker process work through at
+# most JOB_MAX_QUEUED waiting jobs, and results are kept for JOB_TTL
+# seconds, at most JOB_MAX_FINISHED of them holding at most
+# JOB_MAX_RESULT_BYTES of results (0: no limit) per worker process. Under
+# several gunicorn workers JOB_DIR, a directory they all share (set by
+# gunicorn.conf.py), lets any of them answer for any job; without it a poll
+# would only find its job on the worker that took the submission, so jobs
+# are refused instead. A long poll waits at most JOB_MAX_WAIT seconds and
+# holds a request thread meanwhile, serve long polls with WEB_THREADS > 1.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '1'))
+JOB_MAX_QUEUED = int(os.environ.get('JOB_MAX_QUEUED', '16'))
+JOB_TTL = float(os.environ.get('JOB_TTL', '300'))
+JOB_MAX_FINISHED = int(os.environ.get('JOB_MAX_FINISHED', '256'))
+JOB_MAX_RESULT_BYTES = int(os.environ.get('JOB_MAX_RESULT_BYTES', str(256 * 1024 * 1024)))
+JOB_DIR = os.environ.get('JOB_DIR', '')
+JOB_MAX_WAIT = float(os.environ.get('JOB_MAX_WAIT', '25'))
+# Worker processes serving the app, exported by gunicorn.conf.py
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', '1'))
+
+job_queue = JobQueue(JOB_WORKERS, JOB_MAX_QUEUED, JOB_TTL, JOB_MAX_FINISHED, JOB_MAX_RESULT_BYTES,
+                     directory=JOB_DIR)
+# Jobs waiting for a job thread in every worker process (job_queue only
+# knows this process's): entered on submit, left when the job starts
+queued_jobs = LoadMonitor()
+
+# Load-aware degradation: while more than DEGRADE_INFLIGHT images are being
+# processed by all the workers together (requests, batch images and running
+# jobs), or more than DEGRADE_QUEUED jobs wait in all of them (queued_jobs),
+# new /paper-isolate requests get a cheap profile: a DEGRADED_MAX_EDGE proxy,
+# the DEGRADED_ENGINE and a DEGRADED_QUALITY JPEG, and their responses say
+# 'degraded'. Decode and warp still run at full size and dominate at 12 MP;
+# DEGRADED_OUTPUT_MAX_EDGE also caps the page size, off by default as it
+# changes the output dimensions.
+# Full quality resumes once the load is back to DEGRADE_RECOVER of the
+# watermarks. 0 disables a watermark, both are off by default.
+DEGRADE_INFLIGHT = int(os.environ.get('DEGRADE_INFLIGHT', '0'))
+DEGRADE_QUEUED = int(os.environ.get('DEGRADE_QUEUED', '0'))
+DEGRADE_RECOVER = float(os.environ.get('DEGRADE_RECOVER', '0.5'))
+DEGRADED_MAX_EDGE = int(os.environ.get('DEGRADED_MAX_EDGE', '640'))
+DEGRADED_ENGINE = known_engine(os.environ.get('DEGRADED_ENGINE', 'fast'))
+DEGRADED_QUALITY = int(os.environ.get('DEGRADED_QUALITY', '70'))
+DEGRADED_OUTPUT_MAX_EDGE = int(os.environ.get('DEGRADED_OUTPUT_MAX_EDGE', '0'))
+
+# Created at import, before gunicorn forks, so the workers share the counts
+load_monitor = LoadMonitor(DEGRADE_INFLIGHT, DEGRADE_QUEUED, DEGRADE_RECOVER)
+
+
+def degraded_max_edge(image_data):
+    """
+    Proxy edge of the degraded profile: at most DEGRADED_MAX_EDGE, and a
+    whole reduction of both image sides where one is near, so INTER_AREA
+    takes its fast integer path (at 12 MP a third of the time of an
+    arbitrary ratio)
+    """
+    size = read_image_size(image_data)
+    if not size:
+        return DEGRADED_MAX_EDGE
+    width, height = size[0], size[1]
+    first = -(-max(width, height) // DEGRADED_MAX_EDGE)
+    for factor in range(first, first + 4):
+        if width % factor == 0 and height % factor == 0:
+            return max(width, height) // factor
+    return DEGRADED_MAX_EDGE
+
+
+def request_options(fields, image_data, stats):
+    """
+    detection_options for a synchronous request, the degraded profile while
+    load_monitor reports overload (stats['degraded'] is then set)
+    """
+    options = detection_options(fields)
+    if load_monitor.degraded(queued_jobs.inflight()):
+        stats['degraded'] = True
+        max_edge = degraded_max_edge(image_data)
+        options.update(
+            max_edge=min(options['max_edge'] or max_edge, max_edge),
+            engine=DEGRADED_ENGINE,
+            concurrent=False,
+            output_quality=min(options['output_quality'] or DEGRADED_QUALITY, DEGRADED_QUALITY),
+        )
+        if DEGRADED_OUTPUT_MAX_EDGE:
+            options['output_max_edge'] = min(options['output_max_edge'] or DEGRADED_OUTPUT_MAX_EDGE,
+                                             DEGRADED_OUTPUT_MAX_EDGE)
+    return options
+
+
+def read_upload(req, stats):
+    """
+    Image and option fields of a body in either /paper-isolate format
+
+    Returns:
+        (image_data, fields): fields are the query arguments of a raw body or
+        the JSON fields, image_data is None when the body holds no image
+    """
+    start = time.perf_counter()
+    if req.mimetype in RAW_MIMETYPES:
+        image_data, fields = read_body(req), req.args
+    else:
+        fields = read_json_image(req.stream, req.content_length, MAX_BODY_BYTES)
+        image_data = fields.get('image')
+        if image_data is not None and not isinstance(image_data, memoryview):
+            raise BadRequest('"image" must be a base64 string')
+    record_stage(stats, 'read', start)
+    return image_data or None, fields
+
+
+def run_job(image_data, options):
+    """Process a job's image on a job thread, the result is the /paper-isolate JSON body"""
+    queued_jobs.exit()
+    stats = {}
+    with load_monitor.track():
+        result, status = isolate_image(image_data, options, stats)
+    app.logger.info(f"Job finished with {status}: {stats.get('strategy')}")
+    return json_payload(result), status
+
+
+def job_response(record):
+    """Job status body: result (or error) and its HTTP status once finished"""
+    body = {key: record.get(key) for key in ('status', 'submitted', 'started', 'finished')}
+    body['job_id'] = record['id']
+    for key in ('status_code', 'result', 'error'):
+        if key in record:
+            body[key] = record[key]
+    return body
+
+
+@app.route('/paper-isolate/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue an image in either /paper-isolate format and return at once
+
+    The 202 response carries the job id and a Location to poll, see
+    job_status. A full queue, or several worker processes without a shared
+    JOB_DIR, is refused with 503.
+    """
+    if WEB_WORKERS > 1 and not JOB_DIR:
+        return jsonify({
+            'error': f'Jobs need a JOB_DIR shared by the {WEB_WORKERS} worker processes',
+            'document_detected': False
+        }), 503
+
+    try:
+        image_data, fields = read_upload(request, {})
+        if image_data is None:
+            return jsonify({
+                'error': 'Missing image',
+                'document_detected': False
+            }), 400
+
+        options = detection_options(fields)
+        queued_jobs.enter()
+        try:
+            job_id = job_queue.submit(run_job, image_data, options)
+        except QueueFull:
+            queued_jobs.exit()
+            raise
+        app.logger.info(f"Job {job_id} queued")
+        response = jsonify({'job_id': job_id, 'status': 'queued', 'queued': queued_jobs.inflight()})
+        response.headers['Location'] = url_for('job_status', job_id=job_id)
+        return response, 202
+
+    except QueueFull as e:
+        response = jsonify({
+            'error': f'Job queue full: {e}',
+            'document_detected': False
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    except BodyTooLarge as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 413
+    except BadRequest as e:
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 400
+    except Exception as e:
+        app.logger.error(f"Error: {str(e)}")
+        app.logger.error(traceback.format_exc())
+        return jsonify({
+            'error': str(e),
+            'document_detected': False
+        }), 500
+
+
+@app.route('/paper-isolate/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Status of a job, 200 with its result once finished, 202 while queued or running
+
+    ?wait=<seconds> long-polls: the response is held until the job finishes
+    or the wait (at most JOB_MAX_WAIT) runs out.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), JOB_MAX_WAIT)
+    except ValueError:
+        return jsonify({'error': f"Invalid wait {request.args['wait']!r}"}), 400
+    record = job_queue.get(job_id, wait=max(0.0, wait))
+    if record is None:
+        return jsonify({'error': f'Unknown or expired job {job_id}'}), 404
+    return jsonify(job_response(record)), 200 if record['status'] in ('done', 'failed') else 202
+
+
+@app.route('/paper-isolate/jobs', methods=['GET'])
+def job_queue_stats():
+    """Queue depth, running and finished jobs of this worker process"""
+    return jsonify(job_queue.stats()), 200
+
+
+@app.route('/paper-isolate/load', methods=['GET'])
+def paper_isolate_load():
+    """Images in flight, queued jobs (both of all workers) and whether new requests are degraded"""
+    return jsonify(load_monitor.stats(queued_jobs.inflight())), 200
 
-@app.route('/paper-isolate', methods=['POST'])
-def paper_isolate():
-    try:
-        data = request.get_json()
-        
-        if not data or 'image' not in data:
-            return jsonify({
-                'error': 'Missing "image" field',
-                'document_detected': False
-            }), 400
-        
-        app.logger.info("Processing image request")
-        
-        # Decode image
-        image_data = base64.b64decode(data['image'])
-        nparr = np.frombuffer(image_data, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if image is None:
-            return jsonify({
-                'error': 'Invalid image data',
-                'document_detected': False
-            }), 400
-        
-        app.logger.info(f"Image decoded: {image.shape}")
-        
-        # Detect document
-        result_image, detected = detect_document(image)
-        
-        if detected and result_image is not None:
-            _, buffer = cv2.imencode('.jpg', result_image)
-            result_base64 = base64.b64encode(buffer).decode('utf-8')
-            
-            app.logger.info("Document detected successfully")
-            
-            return jsonify({
-                'message': 'Document detected successfully',
-                'document_detected': True,
-                'image': result_base64,
-                'width': int(result_image.shape[1]),
-                'height': int(result_image.shape[0])
-            }), 200
-        else:
-            app.logger.info("No document detected")
-            return jsonify({
-                'message': 'No document detected',
-                'document_detected': False
-            }), 404
-            
-    except Exception as e:
-        app.logger.error(f"Error: {str(e)}")
-        app.logger.error(traceback.format_exc())
-        return jsonify({
-            'error': str(e),
-            'document_detected': False
-        }), 500
 
 if __name__ == '__main__':
-    # Use gunicorn in production
+    # Development server only, production runs: gunicorn -c gunicorn.conf.py app:app
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,264 @@
+"""
+Offline paper isolation for directories of scans
+
+Walks an input directory, runs detection and warping on a process pool and
+writes every isolated page as a JPEG under the output directory, mirroring
+the input layout. One JSON line per image goes to a manifest (corners,
+strategy, quality, stage timings), written as each image finishes, so an
+interrupted run picks up where it stopped: images already in the manifest
+are skipped, images that failed with an error are tried again.
+
+    python backfill.py scans/ isolated/
+    python backfill.py scans/ isolated/ --workers 8 --output-max-edge 2000
+    python backfill.py scans/ isolated/ --multi --manifest receipts.jsonl
+    python backfill.py scans/ isolated/ --debug
+
+Detection settings come from the same environment variables as the
+service (DETECT_MAX_EDGE, REDUCED_DECODE, ...), the flags below override
+the per-request options. Every worker keeps OpenCV single threaded, the
+pool already runs one image per core.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+import numpy as np
+
+import app
+
+# File types picked up from the input directory (anything cv2.imdecode reads)
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp')
+
+# Manifest statuses; 'error' entries are retried on the next run
+DONE_STATUSES = ('detected', 'not_found')
+
+# Images submitted to the pool ahead of the ones being processed, per worker
+QUEUE_PER_WORKER = 4
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+
+def find_images(root, skip=None):
+    """Paths of images under root relative to it, sorted, never descending into skip"""
+    skip = os.path.realpath(skip) if skip else None
+    found = []
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(directory, d)) != skip)
+        for name in files:
+            if name.lower().endswith(EXTENSIONS):
+                found.append(os.path.relpath(os.path.join(directory, name), root))
+    return sorted(found)
+
+
+def read_manifest(path):
+    """Sources already finished according to the manifest at path"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted run
+                continue
+            if record.get('status') in DONE_STATUSES:
+                done.add(record['source'])
+    return done
+
+
+def output_paths(source, count):
+    """Output JPEG path(s) relative to the output directory for a source image"""
+    stem = os.path.splitext(source)[0]
+    if count is None:
+        return [stem + '.jpg']
+    return [f'{stem}_{index + 1}.jpg' for index in range(count)]
+
+
+def write_output(path, buffer):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(buffer)
+
+
+def init_worker():
+    """Single threaded OpenCV like the service's batch workers, and no per-image INFO logging"""
+    app.init_batch_worker()
+    app.app.logger.setLevel(logging.WARNING)
+    # Ctrl-C reaches the whole process group, only the parent handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_pool(workers):
+    # spawn like the service's batch pool: no inherited OpenCV or thread state
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker)
+
+
+def process_image(input_dir, output_dir, source, options, debug=False):
+    """
+    Isolate one image in a worker process
+
+    Returns:
+        Manifest record for source, errors included
+    """
+    start = time.perf_counter()
+    stats = {}
+    record = {'source': source}
+    try:
+        with open(os.path.join(input_dir, source), 'rb') as f:
+            image_data = f.read()
+        result, status = app.isolate_image_uncached(image_data, options, stats)
+
+        if status == 200:
+            pages = result['documents'] if 'documents' in result else [result]
+            names = output_paths(source, len(pages) if 'documents' in result else None)
+            for name, page in zip(names, pages):
+                write_output(os.path.join(output_dir, name), page['encoded'].tobytes())
+            record.update(status='detected', outputs=names,
+                          pages=[{'width': page['width'], 'height': page['height'], 'corners': page['corners'],
+                                  'quality': page['quality']} for page in pages])
+        elif status == 404:
+            record.update(status='not_found', quality=result.get('quality'))
+        else:
+            record.update(status='error', error=result.get('error'))
+
+        if debug and status in (200, 404):
+            save_debug(image_data, os.path.join(output_dir, 'debug'), source, options)
+    except Exception as e:
+        record.update(status='error', error=str(e))
+
+    record.update(strategy=stats.get('strategy'), megapixels=stats.get('megapixels'),
+                  stages=stats.get('stages', []), ms=round((time.perf_counter() - start) * 1000.0, 2))
+    return record
+
+
+def save_debug(image_data, directory, source, options):
+    """Detection intermediates of one image, named after its source path"""
+    image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    debug_options = {key: options[key] for key in ('max_edge', 'engine', 'multi')}
+    _, _, debug_images = app.detect_document(image, debug=True, **debug_options)
+    app.save_debug_images(debug_images, os.path.splitext(source)[0].replace(os.sep, '_'), directory)
+
+
+def report(done, total, detected, errors, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"{done}/{total} images, {detected} detected, {errors} errors, "
+          f"{elapsed:.1f} s, {rate:.2f} images/s", flush=True)
+
+
+def run(input_dir, output_dir, manifest, options, workers, debug=False):
+    """
+    Process every image under input_dir not yet finished in manifest
+
+    Returns:
+        Number of images that failed with an error
+    """
+    done = read_manifest(manifest)
+    sources = [source for source in find_images(input_dir, skip=output_dir) if source not in done]
+    print(f"{len(sources)} images to process, {len(done)} already in {manifest}, {workers} workers", flush=True)
+    if not sources:
+        return 0
+
+    detected = errors = finished = 0
+    start = last_report = time.perf_counter()
+    pool = start_pool(workers)
+    pending = {}
+    queue = iter(sources)
+    try:
+        with open(manifest, 'a') as out:
+            while True:
+                # Keep a bounded number of images in flight, not all of them
+                for source in queue:
+                    future = pool.submit(process_image, input_dir, output_dir, source, options, debug)
+                    pending[future] = source, pool
+                    if len(pending) >= workers * QUEUE_PER_WORKER:
+                        break
+                if not pending:
+                    break
+
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    source, owner = pending.pop(future)
+                    try:
+                        record = future.result()
+                    except BrokenProcessPool as e:
+                        # A worker died (e.g. out of memory): every image queued
+                        # on its pool fails with it and is retried on the next run
+                        record = {'source': source, 'status': 'error', 'error': str(e) or 'Worker died'}
+                        if owner is pool:
+                            pool.shutdown(wait=False, cancel_futures=True)
+                            pool = start_pool(workers)
+                    out.write(json.dumps(record) + '\n')
+                    out.flush()
+                    finished += 1
+                    detected += record['status'] == 'detected'
+                    errors += record['status'] == 'error'
+                    if record['status'] == 'error':
+                        print(f"{record['source']}: {record['error']}", file=sys.stderr)
+
+                now = time.perf_counter()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    report(finished, len(sources), detected, errors, now - start)
+                    last_report = now
+    except KeyboardInterrupt:
+        print(f"Interrupted, finishing the images in progress. Run again with the same arguments to resume "
+              f"from {manifest}", file=sys.stderr)
+        raise
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    report(finished, len(sources), detected, errors, time.perf_counter() - start)
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_dir', help='directory searched recursively for images')
+    parser.add_argument('output_dir', help='directory the isolated pages are written to')
+    parser.add_argument('--manifest', help='JSONL manifest (default: OUTPUT_DIR/manifest.jsonl)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes')
+    parser.add_argument('--max-edge', type=int, default=app.DETECT_MAX_EDGE, help='long edge of the detection proxy')
+    parser.add_argument('--engine', default=app.DETECT_ENGINE,
+                        help=f"detection engine ({', '.join(app.DETECTION_ENGINES)})")
+    parser.add_argument('--multi', action='store_true', help='write every page found in an image')
+    parser.add_argument('--output-max-edge', type=int, default=0, help='largest long edge of the written pages')
+    parser.add_argument('--output-paper', help=f"warp to this paper size ({', '.join(app.PAPER_SIZES)})")
+    parser.add_argument('--output-dpi', type=int, default=app.OUTPUT_DPI, help='resolution for --output-paper')
+    parser.add_argument('--debug', action='store_true', help='also save detection intermediates to OUTPUT_DIR/debug')
+    args = parser.parse_args()
+
+    try:
+        options = app.detection_options({
+            'detect_max_edge': args.max_edge,
+            'detect_engine': args.engine,
+            'detect_multi': args.multi,
+            'output_max_edge': args.output_max_edge,
+            'output_paper': args.output_paper,
+            'output_dpi': args.output_dpi,
+        })
+    except ValueError as e:
+        parser.error(str(e))
+    # Images already run in parallel, keep each one single threaded
+    options['concurrent'] = False
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = args.manifest or os.path.join(args.output_dir, 'manifest.jsonl')
+    try:
+        errors = run(args.input_dir, args.output_dir, manifest, options, max(1, args.workers), args.debug)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
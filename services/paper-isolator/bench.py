@@ -0,0 +1,395 @@
+"""
+Benchmark suite for the paper isolator
+
+Renders synthetic scenes with known page corners (see synthetic.py) at
+several resolutions and measures, per megapixel bucket:
+
+    detect  detect_document (corner search + warp)
+    warp    four_point_transform on the ground truth corners
+    http    POST /paper-isolate through Flask's test client
+    contours    the contour scan of strategies 1 and 2 with the NumPy area
+            prefilter (variant 'prefilter') and without it ('loop')
+
+Each case reports throughput, p50/p95/p99 latency and peak traced memory;
+detect also reports how often the corners were found correctly and how
+often the engine had to fall back past its first strategy. Detection
+variants (proxy size, concurrency, detection engine, ...) are listed in
+VARIANTS.
+
+    python bench.py
+    python bench.py --buckets 2,12 --scenes 10 --variants proxy,full
+    python bench.py --cases detect --variants proxy,lines,hybrid
+    python bench.py --save-baseline baseline.json
+    python bench.py --baseline baseline.json --fail-on-regression
+    python bench.py --batch 16 --buckets 12
+    python bench.py --cases contours --clutter 1500
+    python bench.py --cases detect --variants proxy,auto --contrast 0.25
+    python bench.py --cases detect,http --variants proxy,out1600,a4
+
+Results depend on the machine, keep baselines per host. baselines/ holds
+the committed ones, named <machine>-<cores>cpu.json after the host class
+they were recorded on and made with the default arguments in the pinned
+environment of requirements.txt (the dockerfile's); check against the one
+matching the host the check runs on (CI included), and refresh it there
+with --save-baseline when a change is meant to move the numbers. A baseline
+recorded with another Python, OpenCV, NumPy or architecture measures the
+libraries rather than the code, so --baseline refuses it unless
+--ignore-versions is given:
+
+    python bench.py --baseline baselines/x86_64-1cpu.json --fail-on-regression
+    python bench.py --save-baseline baselines/x86_64-1cpu.json
+
+--batch N compares N sequential POST /paper-isolate calls with one POST
+/paper-isolate/batch.
+"""
+import argparse
+import base64
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import app
+from synthetic import RESOLUTIONS, make_dataset, make_scene
+
+# Detection variants: name -> keyword arguments for detect_document
+VARIANTS = {
+    'default': {},
+    'full': {'max_edge': 0},
+    'proxy': {'max_edge': 1000},
+    'threads': {'max_edge': 1000, 'concurrent': True},
+    'lines': {'max_edge': 1000, 'engine': 'lines'},
+    'hybrid': {'max_edge': 1000, 'engine': 'hybrid'},
+    'auto': {'max_edge': 1000, 'engine': 'auto'},
+    'out1600': {'max_edge': 1000, 'output_max_edge': 1600},
+    'a4': {'max_edge': 1000, 'output_paper': 'a4', 'output_dpi': 150},
+}
+
+CASES = ('detect', 'warp', 'http', 'contours')
+
+# Contour scan variants: name -> app.CONTOUR_PREFILTER
+CONTOUR_VARIANTS = {'prefilter': True, 'loop': False}
+
+# A detection counts as correct when every corner is within this fraction
+# of the image's long edge from the ground truth
+CORRECT_CORNER_FRACTION = 0.01
+
+
+def corner_error(found, expected):
+    """Largest distance in pixels between matching corners"""
+    if found is None:
+        return None
+    found = app.order_points(np.asarray(found, dtype="float32"))
+    expected = app.order_points(np.asarray(expected, dtype="float32"))
+    return float(np.max(np.linalg.norm(found - expected, axis=1)))
+
+
+def request_fields(options):
+    """JSON request fields for detect_document keyword arguments"""
+    return {name if name.startswith('output_') else f'detect_{name}': value for name, value in options.items()}
+
+
+def locate_options(options):
+    """The detection options of a variant, without the output ones"""
+    return {name: value for name, value in options.items() if not name.startswith('output_')}
+
+
+def encode_scene(image):
+    """Base64 JPEG payload for a scene, as a client would upload it"""
+    _, buffer = cv2.imencode('.jpg', image)
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+def summarize(samples_ms, elapsed):
+    p50, p95, p99 = np.percentile(samples_ms, [50, 95, 99])
+    return {
+        'count': len(samples_ms),
+        'throughput': round(len(samples_ms) / elapsed, 3) if elapsed > 0 else 0.0,
+        'p50_ms': round(float(p50), 2),
+        'p95_ms': round(float(p95), 2),
+        'p99_ms': round(float(p99), 2),
+        'mean_ms': round(float(np.mean(samples_ms)), 2),
+    }
+
+
+def peak_memory(fn):
+    """Peak traced allocation in MB while fn runs once (NumPy/OpenCV arrays included)"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        return round((tracemalloc.get_traced_memory()[1] - base) / 1e6, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def contour_scan(image, prefilter):
+    """Strategies 1 and 2 on a proxy whose edge maps and contours are already built"""
+    proxy, _ = app.resize_for_detection(image, app.DETECT_MAX_EDGE)
+    height, width = proxy.shape[:2]
+    min_area, max_area = width * height * 0.1, width * height * 0.95
+    stages = app.DetectionStages(proxy, None)
+    for index in range(len(app.EDGE_VARIANTS)):
+        stages.edge_contours(index)
+
+    def scan():
+        app.CONTOUR_PREFILTER = prefilter
+        # Fresh stages per run so the area arrays are paid for every time
+        fresh = app.DetectionStages(proxy, None)
+        fresh._cache = {key: value for key, value in stages._cache.items() if not key.startswith('areas_')}
+        for index in range(len(app.EDGE_VARIANTS)):
+            app.strategy_edge_quad(fresh, index, min_area, max_area)
+        app.strategy_approx_largest(fresh, min_area, max_area)
+    return scan
+
+
+def case_fn(case, scene, options, client):
+    """The call a case times for one (image, corners, payload) scene"""
+    image, corners, payload = scene
+    if case == 'contours':
+        return contour_scan(image, options)
+    if case == 'detect':
+        return lambda: app.detect_document(image, **options)
+    if case == 'warp':
+        return lambda: app.four_point_transform(image, corners)
+    body = dict(request_fields(options), image=payload)
+    return lambda: client.post('/paper-isolate', json=body)
+
+
+def run_case(case, scenes, options, repeat, client):
+    """Measure one case over a list of (image, corners, payload) scenes"""
+    samples = []
+    start = time.perf_counter()
+    for scene in scenes:
+        fn = case_fn(case, scene, options, client)
+        for _ in range(repeat):
+            call_start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - call_start) * 1000.0)
+    elapsed = time.perf_counter() - start
+
+    # Memory is traced in a separate pass, tracing slows the timed runs down
+    result = summarize(samples, elapsed)
+    result['peak_mb'] = max(peak_memory(case_fn(case, scene, options, client)) for scene in scenes)
+
+    if case == 'detect':
+        errors = []
+        fallbacks = 0
+        for image, corners, _ in scenes:
+            stats = {}
+            error = corner_error(app.locate_document(image, stats=stats, **locate_options(options)), corners)
+            fallbacks += bool(stats.get('fallback'))
+            if error is not None:
+                errors.append(error / max(image.shape[:2]))
+        correct = sum(1 for error in errors if error <= CORRECT_CORNER_FRACTION)
+        result['detection_rate'] = round(len(errors) / len(scenes), 3)
+        result['correct_rate'] = round(correct / len(scenes), 3)
+        result['fallback_rate'] = round(fallbacks / len(scenes), 3)
+        result['corner_error_pct'] = round(100.0 * float(np.median(errors)), 3) if errors else None
+    if case == 'http':
+        sizes = [len(case_fn(case, scene, options, client)().data) for scene in scenes]
+        result['response_kb'] = round(float(np.mean(sizes)) / 1024.0, 1)
+    return result
+
+
+def case_variants(case, variants):
+    """(variant name, options) pairs a case runs"""
+    if case == 'warp':
+        # The warp does not depend on the detection options
+        return [('default', VARIANTS['default'])]
+    if case == 'contours':
+        return list(CONTOUR_VARIANTS.items())
+    return [(variant, VARIANTS[variant]) for variant in variants]
+
+
+def run_suite(buckets, scene_count, repeat, cases, variants, clutter=0, contrast=1.0):
+    # Every request must pay for detection
+    app.result_cache.max_bytes = 0
+    client = app.app.test_client()
+    prefilter = app.CONTOUR_PREFILTER
+    results = {}
+
+    try:
+        for mp in buckets:
+            scenes = []
+            for _, _, image, corners in make_dataset([mp], scene_count, clutter=clutter, contrast=contrast):
+                scenes.append((image, corners, encode_scene(image) if 'http' in cases else None))
+
+            for case in cases:
+                for variant, options in case_variants(case, variants):
+                    key = f'{case}/{variant}/{mp}MP'
+                    results[key] = run_case(case, scenes, options, repeat, client)
+                    print_row(key, results[key])
+                    sys.stdout.flush()
+    finally:
+        app.CONTOUR_PREFILTER = prefilter
+    return results
+
+
+def print_header():
+    print(f"{'case':<26} {'img/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8} {'correct':>8} "
+          f"{'fallback':>8}")
+
+
+def print_row(key, result):
+    correct = result.get('correct_rate')
+    correct_text = f"{correct:.0%}" if correct is not None else ''
+    fallback = result.get('fallback_rate')
+    fallback_text = f"{fallback:.0%}" if fallback is not None else ''
+    print(f"{key:<26} {result['throughput']:>8.2f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+          f"{result['p99_ms']:>9.1f} {result['peak_mb']:>8.1f} {correct_text:>8} {fallback_text:>8}")
+
+
+# Baseline meta fields that must match the running environment; Python is
+# compared on major.minor only, patch releases don't move these numbers
+ENVIRONMENT_FIELDS = ('python', 'opencv', 'numpy', 'machine')
+
+
+def environment():
+    """The environment fields of this run's meta"""
+    return {
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+    }
+
+
+def environment_mismatch(meta, current):
+    """'field: baseline != current' for every environment field that differs"""
+    def significant(field, value):
+        return '.'.join(str(value).split('.')[:2]) if field == 'python' else value
+    return [f"{field}: {meta.get(field)} != {current[field]}" for field in ENVIRONMENT_FIELDS
+            if significant(field, meta.get(field)) != significant(field, current[field])]
+
+
+def compare(results, baseline, threshold):
+    """Print the change against a baseline, return the keys that regressed"""
+    regressions = []
+    print(f"\nAgainst baseline (regression threshold {threshold:.0%}):")
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            print(f"{key:<26} no baseline")
+            continue
+
+        p50_change = result['p50_ms'] / base['p50_ms'] - 1.0 if base['p50_ms'] else 0.0
+        p95_change = result['p95_ms'] / base['p95_ms'] - 1.0 if base['p95_ms'] else 0.0
+        memory_change = result['peak_mb'] / base['peak_mb'] - 1.0 if base['peak_mb'] else 0.0
+
+        flags = []
+        if p50_change > threshold or p95_change > threshold:
+            flags.append('SLOWER')
+        if memory_change > threshold:
+            flags.append('MORE MEMORY')
+        if (result.get('correct_rate') or 0) < (base.get('correct_rate') or 0):
+            flags.append('LESS ACCURATE')
+        if flags:
+            regressions.append(key)
+        print(f"{key:<26} p50 {p50_change:+7.1%}  p95 {p95_change:+7.1%}  "
+              f"peak {memory_change:+7.1%}  {' '.join(flags)}")
+    return regressions
+
+
+def run_batch_comparison(pages, mp):
+    """Throughput of sequential single calls versus one batch call"""
+    app.result_cache.max_bytes = 0
+    width, height = RESOLUTIONS[mp]
+    images = [encode_scene(make_scene(width, height, seed=seed)[0]) for seed in range(pages)]
+    client = app.app.test_client()
+
+    # Warm the batch pool so worker start-up is not part of the measurement
+    client.post('/paper-isolate/batch', json={'images': images[:1]})
+
+    start = time.perf_counter()
+    for image in images:
+        client.post('/paper-isolate', json={'image': image})
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.post('/paper-isolate/batch', json={'images': images})
+    batch = time.perf_counter() - start
+    detected = response.get_json()['detected']
+
+    print(f"{pages} pages at {mp}MP, {app.BATCH_WORKERS} batch workers")
+    print(f"{'sequential':>12} {sequential:>8.2f} s {pages / sequential:>8.2f} pages/s")
+    print(f"{'batch':>12} {batch:>8.2f} s {pages / batch:>8.2f} pages/s ({detected}/{pages} detected)")
+    print(f"{'speedup':>12} {sequential / batch:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buckets', default=','.join(str(mp) for mp in RESOLUTIONS),
+                        help='comma separated megapixel buckets to run')
+    parser.add_argument('--scenes', type=int, default=5, help='scenes per bucket')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scene')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma separated cases to run')
+    parser.add_argument('--variants', default='proxy,full',
+                        help=f"comma separated detection variants ({', '.join(VARIANTS)})")
+    parser.add_argument('--clutter', type=int, default=0,
+                        help='small objects scattered around each page (thousands of extra contours)')
+    parser.add_argument('--contrast', type=float, default=1.0,
+                        help='exposure scale of the scenes, below 1 for dim low contrast captures')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--save-baseline', help='write results as a baseline to this file')
+    parser.add_argument('--baseline', help='compare against this baseline file')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown counted as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exit 1 when the baseline comparison regresses')
+    parser.add_argument('--ignore-versions', action='store_true',
+                        help='compare against a baseline recorded with other library versions')
+    parser.add_argument('--batch', type=int, default=0,
+                        help='compare N single calls with one batch call instead')
+    args = parser.parse_args()
+
+    buckets = [int(b) for b in args.buckets.split(',')]
+    if args.batch:
+        run_batch_comparison(args.batch, buckets[0])
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatch = environment_mismatch(baseline.get('meta', {}), environment())
+        if mismatch:
+            print(f"WARNING: {args.baseline} was recorded in another environment ({'; '.join(mismatch)}), "
+                  f"its numbers are not comparable with this run", file=sys.stderr)
+            if not args.ignore_versions:
+                print("refusing to compare; record a baseline here or pass --ignore-versions", file=sys.stderr)
+                sys.exit(2)
+
+    print(f"python {platform.python_version()}, opencv {cv2.__version__}, numpy {np.__version__}, "
+          f"{args.scenes} scenes x {args.repeat} runs per bucket, clutter {args.clutter}, contrast {args.contrast}")
+    print_header()
+    results = run_suite(buckets, args.scenes, args.repeat, args.cases.split(','), args.variants.split(','),
+                        args.clutter, args.contrast)
+
+    document = {
+        'meta': {
+            **environment(),
+            'scenes': args.scenes,
+            'repeat': args.repeat,
+            'clutter': args.clutter,
+            'contrast': args.contrast,
+        },
+        'results': results,
+    }
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(document, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
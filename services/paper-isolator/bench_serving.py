@@ -0,0 +1,177 @@
+"""
+Serving benchmark for the paper isolator under gunicorn
+
+Starts gunicorn with gunicorn.conf.py once per worker layout, fires
+concurrent raw JPEG uploads at it and reports images/s, latency
+percentiles and worker memory, so the layouts recommended in
+gunicorn.conf.py can be checked on the machine at hand.
+
+    python bench_serving.py
+    python bench_serving.py --layouts 8x1x1,4x1x2,2x1x4 --requests 200 --concurrency 16
+    python bench_serving.py --env BUFFER_POOL=0
+
+Worker memory is read from /proc after the timed run (Linux only): RSS is
+the mean resident size of the workers at that point (steady state), peak
+the largest high-water mark of any worker.
+
+A layout is WORKERSxTHREADSxOPENCV_THREADS. The result cache is disabled so
+every request pays for detection.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from synthetic import RESOLUTIONS, make_scene
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def default_layouts(cores):
+    """Throughput, latency and single-process layouts for this core count"""
+    layouts = [(cores, 1, 1)]
+    if cores >= 2:
+        layouts.append((cores // 2, 1, 2))
+    if cores > 1:
+        layouts.append((1, 1, cores))
+    return layouts
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, threads, opencv_threads, port, extra_env=None):
+    env = dict(os.environ,
+               WEB_WORKERS=str(workers),
+               WEB_THREADS=str(threads),
+               OPENCV_THREADS=str(opencv_threads),
+               PORT=str(port),
+               RESULT_CACHE_BYTES='0',
+               **(extra_env or {}))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.terminate()
+    raise RuntimeError('gunicorn did not become healthy within 60 s')
+
+
+def child_pids(pid):
+    """Direct children of a process, from /proc"""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the fields after it do not
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def worker_memory(master_pid):
+    """(mean VmRSS, max VmHWM) of gunicorn's workers in MB, None off Linux"""
+    rss, peak = [], []
+    for pid in child_pids(master_pid) if os.path.isdir('/proc') else ():
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except OSError:
+            continue
+        rss.append(int(status['VmRSS'].split()[0]) / 1024.0)
+        peak.append(int(status['VmHWM'].split()[0]) / 1024.0)
+    if not rss:
+        return None
+    return sum(rss) / len(rss), max(peak)
+
+
+def post_image(url, body):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'image/jpeg'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=120) as response:
+        response.read()
+    return (time.perf_counter() - start) * 1000.0
+
+
+def run_layout(layout, bodies, total, concurrency, extra_env=None):
+    workers, threads, opencv_threads = layout
+    port = free_port()
+    server = start_server(workers, threads, opencv_threads, port, extra_env)
+    url = f'http://127.0.0.1:{port}/paper-isolate'
+
+    try:
+        # Warm every worker before timing
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda body: post_image(url, body), bodies[:workers]))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(lambda i: post_image(url, bodies[i % len(bodies)]), range(total)))
+        elapsed = time.perf_counter() - start
+        memory = worker_memory(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    label = f'{workers}x{threads}x{opencv_threads}'
+    memory_text = f"{memory[0]:>8.1f} {memory[1]:>8.1f}" if memory else f"{'':>8} {'':>8}"
+    print(f"{label:>10} {total / elapsed:>10.2f} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {memory_text}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layouts', help='comma separated WORKERSxTHREADSxOPENCV_THREADS layouts')
+    parser.add_argument('--requests', type=int, default=100, help='timed requests per layout')
+    parser.add_argument('--concurrency', type=int, default=0, help='client connections (default: 2 x cores)')
+    parser.add_argument('--bucket', type=int, default=12, help='megapixel bucket of the uploads')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment for the server, e.g. BUFFER_POOL=0 (repeatable)')
+    args = parser.parse_args()
+    extra_env = dict(item.split('=', 1) for item in args.env)
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    if args.layouts:
+        layouts = [tuple(int(n) for n in layout.split('x')) for layout in args.layouts.split(',')]
+    else:
+        layouts = default_layouts(cores)
+    concurrency = args.concurrency or 2 * cores
+
+    width, height = RESOLUTIONS[args.bucket]
+    bodies = []
+    for seed in range(8):
+        image, _ = make_scene(width, height, seed=seed)
+        bodies.append(cv2.imencode('.jpg', image)[1].tobytes())
+
+    settings = ' '.join(args.env)
+    print(f"{cores} cores, {args.requests} requests at {args.bucket}MP, {concurrency} connections {settings}")
+    print(f"{'layout':>10} {'images/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>8} {'peak MB':>8}")
+    for layout in layouts:
+        run_layout(layout, bodies, args.requests, concurrency, extra_env)
+
+
+if __name__ == "__main__":
+    main()
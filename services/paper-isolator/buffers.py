@@ -0,0 +1,59 @@
+"""
+Reusable output arrays for OpenCV calls
+
+OpenCV's Python bindings allocate a new NumPy array for every result, and
+detection produces a dozen proxy sized intermediates per request, so under
+steady load the same sizes are allocated and freed again and again. A
+BufferPool hands out one array per name and gives the same array back on
+the next request when shape and dtype still match, so OpenCV can write into
+it via dst=.
+
+A pool is not thread safe and its arrays are overwritten by the next
+request, so every request thread uses its own (see local_pool) and nothing
+taken from it may outlive the request.
+"""
+import threading
+
+import numpy as np
+
+_local = threading.local()
+
+
+class BufferPool:
+    """Named, shape-keyed arrays reused across requests"""
+
+    def __init__(self):
+        self._buffers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        """
+        Array for name with the given shape and dtype, contents undefined
+
+        The previous array for name is reused when it matches and replaced
+        otherwise, so a pool holds at most one array per name.
+        """
+        shape = tuple(int(n) for n in shape)
+        dtype = np.dtype(dtype)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype)
+            self.misses += 1
+        else:
+            self.hits += 1
+        return buffer
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def clear(self):
+        self._buffers.clear()
+
+
+def local_pool():
+    """The calling thread's pool, created on first use"""
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = _local.pool = BufferPool()
+    return pool
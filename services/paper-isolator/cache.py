@@ -0,0 +1,88 @@
+"""
+In-process LRU cache for paper isolation results
+
+Entries are keyed by a hash of the uploaded image bytes plus the detection
+options, and the cache is bounded by the total size of the stored results
+rather than by entry count, since one cached 48 MP page can outweigh a
+hundred receipts.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Rough per-entry cost of the key, dict and metadata on top of the payload
+ENTRY_OVERHEAD = 1024
+
+
+def cache_key(image_data, options):
+    """Content address for an uploaded image and the options it was run with"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(memoryview(image_data))
+    digest.update(repr(sorted(options.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache bounded by bytes
+
+    Values are stored as given together with their size; callers are
+    expected not to mutate them after put() or get().
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        size += ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
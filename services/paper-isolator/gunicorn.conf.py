@@ -0,0 +1,121 @@
+"""
+Gunicorn configuration for the paper isolator
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Detection is CPU bound and OpenCV parallelises most filters internally, so
+the cores are split between three knobs:
+
+    WEB_WORKERS     worker processes             (default: cores)
+    WEB_THREADS     request threads per worker   (default: 1)
+    OPENCV_THREADS  OpenCV threads per worker    (default: cores // (workers * threads))
+
+Keeping WEB_WORKERS * WEB_THREADS * OPENCV_THREADS close to the core count
+avoids oversubscription: with the OpenCV default every worker would start one
+thread per core and N workers would fight over the same cores. Strategy
+threads are split the same way:
+
+    DETECT_THREADS  strategy threads per worker  (default: cores // workers)
+
+Batch pages are budgeted separately: BATCH_WORKERS (default: cores) is the
+number of pages the whole service processes at once, whichever workers the
+batches arrived on, so one batch on an idle host still uses every core (see
+batch_slots in app.py).
+
+Recommended layouts for C cores (see bench_serving.py to measure them):
+
+    throughput  C workers x 1 thread x 1 OpenCV thread. Requests never share
+                a core, best images/s under sustained load.
+    latency     C/2 workers x 1 thread x 2 OpenCV threads. Each request
+                finishes sooner when traffic is light, at some cost in peak
+                throughput.
+
+WEB_THREADS > 1 only helps when requests spend time waiting on slow clients;
+detection itself holds a core for the whole request.
+
+The app is preloaded so OpenCV and NumPy are imported once in the master and
+shared copy-on-write by the workers. Thread and process pools inside the app
+are created lazily, after the fork.
+"""
+import os
+import sys
+import tempfile
+
+
+def available_cores():
+    """Cores this process may run on (respects CPU affinity / cpusets)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+cores = available_cores()
+
+workers = int(os.environ.get('WEB_WORKERS', str(cores)))
+threads = int(os.environ.get('WEB_THREADS', '1'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+# Read by app.py at import time, before the workers are forked
+opencv_threads = max(1, cores // max(1, workers * threads))
+os.environ.setdefault('OPENCV_THREADS', str(opencv_threads))
+os.environ.setdefault('DETECT_THREADS', str(max(1, cores // max(1, workers))))
+os.environ.setdefault('BATCH_WORKERS', str(cores))
+os.environ['WEB_WORKERS'] = str(workers)
+
+# Job records shared by the workers, so any of them can answer a poll for a
+# job another one runs (see jobs.py)
+os.environ.setdefault('JOB_DIR', os.path.join(tempfile.gettempdir(), 'paper-isolator-jobs'))
+
+# Metric series of every worker, summed by whichever one answers /metrics
+# (see metrics.py)
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'paper-isolator-metrics'))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so allocator fragmentation cannot grow RSS forever
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    # Counters start from zero with the service, drop the previous run's series
+    app = sys.modules.get('app')
+    if app is not None:
+        app.metrics.clear()
+
+
+def post_fork(server, worker):
+    # OpenCV's thread pool is not inherited across fork, apply the limit again
+    import cv2
+    cv2.setNumThreads(int(os.environ['OPENCV_THREADS']))
+
+
+def worker_exit(server, worker):
+    # Write the metrics recorded since the last flush before the worker goes
+    app = sys.modules.get('app')
+    if app is not None:
+        app.metrics.flush()
+
+
+def child_exit(server, worker):
+    # A worker killed mid-request never lowered its in-flight count, drop it
+    # from the load shared by the workers (see load.py), and keep its metric
+    # series counting in the service totals
+    app = sys.modules.get('app')
+    if app is not None:
+        app.load_monitor.release(worker.pid)
+        app.batch_slots.release(worker.pid)
+        app.queued_jobs.release(worker.pid)
+        app.metrics.retire(worker.pid)
+
+
+def when_ready(server):
+    server.log.info(
+        f"paper-isolator: {workers} workers x {threads} threads x "
+        f"{os.environ['OPENCV_THREADS']} OpenCV threads on {cores} cores, "
+        f"{os.environ['DETECT_THREADS']} detect threads per worker, {os.environ['BATCH_WORKERS']} batch pages at once"
+    )
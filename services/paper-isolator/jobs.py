@@ -0,0 +1,225 @@
+"""
+In-process job queue for asynchronous paper isolation
+
+A job is a function run on a small thread pool after the request that
+submitted it has returned; its (payload, status) result is kept for ttl
+seconds for the client to fetch, optionally waiting for it (long-poll).
+The number of jobs waiting for a worker is bounded, submit() raises
+QueueFull beyond it, so a burst cannot queue unbounded image bytes.
+
+Finished jobs are kept until their TTL runs out, and at most max_finished
+of them taking at most max_result_bytes of serialized results, oldest
+dropped first, so a burst of large results cannot pin the worker's memory.
+
+Every gunicorn worker process has its own queue. With a directory, job
+records (status and result) are also written there as <id>.json, so a
+status request answered by another worker process still finds the job;
+the directory is the only shared state, no broker is involved.
+"""
+import collections
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds between checks of a job file owned by another process while long-polling
+POLL_INTERVAL = 0.1
+
+FINISHED = ('done', 'failed')
+
+
+class QueueFull(Exception):
+    """No room for another queued job"""
+
+
+class JobQueue:
+    """
+    Bounded worker pool with results kept for a while
+
+        job_id = jobs.submit(fn, *args)      # fn(*args) -> (payload, status)
+        record = jobs.get(job_id, wait=10)   # None when unknown or expired
+    """
+
+    def __init__(self, workers=1, max_queued=16, ttl=300.0, max_finished=256, max_result_bytes=0,
+                 directory=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.max_result_bytes = max_result_bytes    # 0: no limit
+        self.directory = directory or None
+        self._jobs = {}
+        self._finished = collections.deque()     # (expires, id, bytes) in finishing order
+        self._finished_bytes = 0
+        self._cond = threading.Condition()
+        self._pool = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._sweep()
+
+    def _executor(self):
+        # Created on first use, after gunicorn forked the worker
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        return self._pool
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) and return the job id, raises QueueFull when max_queued jobs are waiting"""
+        job_id = uuid.uuid4().hex
+        with self._cond:
+            self._expire()
+            if self.queued >= self.max_queued:
+                self.rejected += 1
+                raise QueueFull(f'{self.queued} jobs already queued')
+            self.queued += 1
+            record = self._jobs[job_id] = {'id': job_id, 'status': 'queued', 'submitted': time.time()}
+            self._write(record)
+            self._executor().submit(self._run, job_id, fn, args)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        with self._cond:
+            self.queued -= 1
+            self.running += 1
+            record = self._jobs[job_id] = dict(self._jobs[job_id], status='running', started=time.time())
+        # Only this thread writes the job file after submit, so writes stay in order
+        self._write_quietly(record)
+
+        try:
+            payload, status = fn(*args)
+            update = {'status': 'done', 'result': payload, 'status_code': status}
+        except Exception as e:
+            update = {'status': 'failed', 'error': str(e), 'status_code': 500}
+
+        # Records are replaced, never changed in place, so readers see whole ones
+        record = dict(record, finished=time.time(), **update)
+        # A result can be megabytes of base64, serialize and write it outside the lock
+        text = json.dumps(record)
+        self._write_quietly(record, text)
+        with self._cond:
+            self._jobs[job_id] = record
+            self.running -= 1
+            self.completed += 1
+            self._finished.append((time.monotonic() + self.ttl, job_id, len(text)))
+            self._finished_bytes += len(text)
+            self._expire()
+            self._cond.notify_all()
+
+    def get(self, job_id, wait=0.0):
+        """
+        Job record, waiting up to wait seconds for it to finish
+
+        Returns:
+            Dict with 'id', 'status' (queued, running, done or failed) and,
+            once finished, 'status_code' and 'result' or 'error'; None when
+            the job is unknown or expired
+        """
+        end = time.monotonic() + wait
+        with self._cond:
+            self._expire()
+            if job_id in self._jobs:
+                record = self._jobs[job_id]
+                while record is not None and record['status'] not in FINISHED:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                    record = self._jobs.get(job_id)
+                return record
+
+        # Submitted to another worker process
+        while True:
+            record = self._read(job_id)
+            if record is None or record['status'] in FINISHED or time.monotonic() >= end:
+                return record
+            time.sleep(min(POLL_INTERVAL, max(0.0, end - time.monotonic())))
+
+    def stats(self):
+        with self._cond:
+            self._expire()
+            return {
+                'workers': self.workers,
+                'queued': self.queued,
+                'running': self.running,
+                'finished': len(self._finished),
+                'finished_bytes': self._finished_bytes,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'max_queued': self.max_queued,
+                'max_finished': self.max_finished,
+                'max_result_bytes': self.max_result_bytes,
+                'ttl': self.ttl,
+            }
+
+    def _over_limit(self):
+        if len(self._finished) > self.max_finished:
+            return True
+        # The newest result is kept whatever its size, its client is about to fetch it
+        return bool(self.max_result_bytes and len(self._finished) > 1 and
+                    self._finished_bytes > self.max_result_bytes)
+
+    def _expire(self):
+        """Drop finished jobs past their TTL, or beyond the count and size limits; caller holds the lock"""
+        now = time.monotonic()
+        while self._finished and (self._finished[0][0] <= now or self._over_limit()):
+            _, job_id, size = self._finished.popleft()
+            self._finished_bytes -= size
+            self._jobs.pop(job_id, None)
+            self._remove(job_id)
+
+    def _sweep(self):
+        """Remove job files a previous run left behind once their TTL has run out"""
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(('.json', '.tmp')) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f'{job_id}.json')
+
+    def _write(self, record, text=None):
+        if not self.directory:
+            return
+        tmp = self._path(record['id']) + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(record) if text is None else text)
+        os.replace(tmp, self._path(record['id']))
+
+    def _write_quietly(self, record, text=None):
+        # The job itself goes on without the file, this process can still answer for it
+        try:
+            self._write(record, text)
+        except OSError:
+            pass
+
+    def _read(self, job_id):
+        if not self.directory or len(job_id) != 32 or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if record['status'] in FINISHED and time.time() - record['finished'] > self.ttl:
+            # The owning process exited before expiring it
+            self._remove(job_id)
+            return None
+        return record
+
+    def _remove(self, job_id):
+        if not self.directory:
+            return
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
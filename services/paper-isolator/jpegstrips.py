@@ -0,0 +1,132 @@
+"""
+Baseline JPEG assembled from horizontal strips
+
+OpenCV can only encode a whole image, so a 48 MP page has to exist in full
+before its JPEG can be written. StripEncoder lifts that: every strip is
+encoded on its own with the same settings (and so the same quantisation and
+Huffman tables), and the entropy coded data of the strips is joined with
+restart markers under one header. A restart interval of exactly one strip
+makes the decoder reset its DC predictors at every strip boundary, which is
+what lets independently encoded strips form one valid image.
+
+Strip heights must be a multiple of the MCU height (16 rows covers every
+subsampling OpenCV writes); only the last strip may be shorter.
+"""
+import struct
+
+import cv2
+
+MCU_ROWS = 16
+
+# Markers that stand alone, without a length field
+_STANDALONE = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+
+def _split(data):
+    """(header up to and including the SOS segment, entropy coded data, SOF offset, SOS offset) of one JPEG"""
+    i = 2
+    sof = None
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            raise ValueError('Malformed JPEG header')
+        marker = data[i + 1]
+        if marker in _STANDALONE:
+            i += 2
+            continue
+        length = struct.unpack_from('>H', data, i + 2)[0]
+        if marker in (0xC0, 0xC1):
+            sof = i
+        elif marker in (0xC2, 0xDD):
+            raise ValueError('Strips must be baseline JPEGs without restart markers')
+        if marker == 0xDA:
+            end = i + 2 + length
+            if sof is None or data[-2:] != b'\xff\xd9':
+                raise ValueError('Malformed JPEG')
+            return data[:end], data[end:-2], sof, i
+        i += 2 + length
+    raise ValueError('No scan in JPEG')
+
+
+def _mcu_size(header, sof):
+    """MCU width and height in pixels from the SOF component sampling factors"""
+    count = header[sof + 9]
+    factors = [header[sof + 11 + 3 * c] for c in range(count)]
+    if count == 1:
+        return 8, 8
+    return 8 * max(f >> 4 for f in factors), 8 * max(f & 0x0F for f in factors)
+
+
+class StripEncoder:
+    """
+    Encode an image strip by strip into one baseline JPEG
+
+        encoder = StripEncoder(width, height, params)
+        for strip in strips:          # strip_rows(...) rows each, last may be shorter
+            encoder.write(strip)
+        data = encoder.finish()       # bytes
+
+    Only the compressed output is kept, so memory stays at one strip plus
+    the JPEG itself.
+    """
+
+    def __init__(self, width, height, params=()):
+        self.width = width
+        self.height = height
+        self.params = list(params)
+        self._header = None
+        self._tables = None
+        self._chunks = []
+        self._rows = 0
+        self._strip_rows = None
+
+    def write(self, strip):
+        rows = strip.shape[0]
+        if strip.shape[1] != self.width or self._rows + rows > self.height:
+            raise ValueError('Strip does not fit the image')
+        if self._strip_rows is not None and self._rows % self._strip_rows:
+            raise ValueError('Only the last strip may be shorter')
+
+        ok, encoded = cv2.imencode('.jpg', strip, self.params)
+        if not ok:
+            raise ValueError('Could not encode strip')
+        header, scan, sof, sos = _split(encoded.tobytes())
+
+        # Everything but the frame height must match the first strip
+        tables = header[:sof + 5] + header[sof + 7:]
+        if self._header is None:
+            mcu_width, mcu_height = _mcu_size(header, sof)
+            if rows % mcu_height and rows != self.height:
+                raise ValueError(f'Strip height must be a multiple of {mcu_height} rows')
+            # A single strip may end inside an MCU row, which still counts as one
+            interval = -(-self.width // mcu_width) * -(-rows // mcu_height)
+            if interval > 0xFFFF:
+                raise ValueError('Strip too large for one restart interval')
+            self._header = self._finish_header(header, sof, sos, interval)
+            self._tables = tables
+            self._strip_rows = rows
+        else:
+            if tables != self._tables:
+                raise ValueError('Strips were encoded with different tables')
+            # Restart marker between strips, RST0..RST7 in turn
+            self._chunks.append(bytes((0xFF, 0xD0 + (len(self._chunks) // 2) % 8)))
+
+        self._chunks.append(scan)
+        self._rows += rows
+
+    def _finish_header(self, header, sof, sos, interval):
+        """First strip header with the full image height and a DRI segment before the scan"""
+        header = bytearray(header)
+        struct.pack_into('>H', header, sof + 5, self.height)
+        header[sos:sos] = b'\xff\xdd' + struct.pack('>HH', 4, interval)
+        return bytes(header)
+
+    def finish(self):
+        if self._rows != self.height:
+            raise ValueError(f'Got {self._rows} of {self.height} rows')
+        return b''.join([self._header] + self._chunks + [b'\xff\xd9'])
+
+
+def strip_rows(width, channels, max_bytes):
+    """Rows per strip so that one strip stays within max_bytes, a multiple of MCU_ROWS"""
+    rows = max_bytes // max(1, width * channels)
+    return max(MCU_ROWS, rows // MCU_ROWS * MCU_ROWS)
@@ -0,0 +1,148 @@
+"""
+Load tracking for graceful degradation
+
+LoadMonitor counts the requests being processed by every worker process of
+the service and says when the service is overloaded, with hysteresis: it
+turns degraded once the load goes over a high watermark and only recovers
+when the load has fallen to a lower one, so a service sitting at the
+watermark does not flip profile on every request.
+
+Counts live in shared memory created before gunicorn forks its workers
+(the app is preloaded), one slot per worker process. A worker killed in the
+middle of a request cannot decrement its count, so the master releases its
+slot when it exits (see gunicorn.conf.py).
+"""
+import multiprocessing
+import os
+from contextlib import contextmanager
+
+# Worker processes that can hold a slot at the same time
+MAX_SLOTS = 256
+
+
+class LoadMonitor:
+    """
+    In-flight requests across processes and the degraded state derived from them
+
+        with monitor.track():
+            if monitor.degraded(queued):
+                ...
+
+    Only the request path calls degraded(), which moves the hysteresis
+    state; observers (metrics, status endpoints) read it with is_degraded().
+    """
+
+    def __init__(self, high_inflight=0, high_queued=0, recover=0.5):
+        self.high_inflight = high_inflight
+        self.high_queued = high_queued
+        self.recover = recover
+        self._pids = multiprocessing.Array('i', MAX_SLOTS)
+        self._counts = multiprocessing.Array('i', MAX_SLOTS, lock=False)
+        self._degraded = multiprocessing.Value('b', 0, lock=False)
+        self._slot = None
+        self._slot_pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.high_inflight or self.high_queued)
+
+    def _own_slot(self):
+        pid = os.getpid()
+        if self._slot_pid != pid:
+            # First use in this process: claim a free slot, or this pid's own
+            with self._pids.get_lock():
+                free = None
+                for index, owner in enumerate(self._pids):
+                    if owner == pid:
+                        free = index
+                        break
+                    if owner == 0 and free is None:
+                        free = index
+                if free is None:
+                    raise RuntimeError(f'More than {MAX_SLOTS} processes tracking load')
+                self._pids[free] = pid
+                self._counts[free] = 0
+            self._slot, self._slot_pid = free, pid
+        return self._slot
+
+    def enter(self, weight=1):
+        """Count weight more requests in flight in this process"""
+        slot = self._own_slot()
+        with self._pids.get_lock():
+            self._counts[slot] += weight
+
+    def exit(self, weight=1):
+        """Count weight requests less, once for every enter"""
+        with self._pids.get_lock():
+            self._counts[self._own_slot()] -= weight
+
+    def try_enter(self, limit, weight=1):
+        """
+        enter(weight) only if that keeps the requests in flight in every
+        process within limit, atomically across processes
+
+        Returns:
+            True when counted, the caller must exit(weight) later
+        """
+        slot = self._own_slot()
+        with self._pids.get_lock():
+            if sum(self._counts[:]) + weight > limit:
+                return False
+            self._counts[slot] += weight
+        return True
+
+    @contextmanager
+    def track(self, weight=1):
+        """Count weight requests in flight for the duration of the block"""
+        self.enter(weight)
+        try:
+            yield
+        finally:
+            self.exit(weight)
+
+    def inflight(self):
+        """Requests in flight in every process"""
+        return sum(self._counts[:])
+
+    def release(self, pid):
+        """Forget a process that exited, with whatever it still counted"""
+        with self._pids.get_lock():
+            for index, owner in enumerate(self._pids):
+                if owner == pid:
+                    self._pids[index] = 0
+                    self._counts[index] = 0
+
+    def degraded(self, queued=0):
+        """
+        Whether new requests should get the degraded profile, entering or
+        leaving the degraded state when the load crossed a watermark
+
+        Args:
+            queued: Work waiting on top of the requests in flight, e.g. queued jobs
+        """
+        if not self.enabled:
+            return False
+        inflight = self.inflight()
+        if self._degraded.value:
+            calm = ((not self.high_inflight or inflight <= self.high_inflight * self.recover) and
+                    (not self.high_queued or queued <= self.high_queued * self.recover))
+            if calm:
+                self._degraded.value = 0
+        elif ((self.high_inflight and inflight > self.high_inflight) or
+              (self.high_queued and queued > self.high_queued)):
+            self._degraded.value = 1
+        return bool(self._degraded.value)
+
+    def is_degraded(self):
+        """The degraded state as the last request left it, without changing it"""
+        return self.enabled and bool(self._degraded.value)
+
+    def stats(self, queued=0):
+        return {
+            'inflight': self.inflight(),
+            'queued': queued,
+            'degraded': self.is_degraded(),
+            'high_inflight': self.high_inflight,
+            'high_queued': self.high_queued,
+            'recover': self.recover,
+        }
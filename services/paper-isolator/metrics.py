@@ -0,0 +1,282 @@
+"""
+Minimal Prometheus-style metrics for the paper isolator
+
+Only what the service needs: labelled histograms and counters rendered in
+the Prometheus text exposition format, without pulling in a client library.
+
+Metrics live in the process that recorded them. Under gunicorn every worker
+keeps its own series; with a spool directory (see configure) each process
+also writes its series there as <pid>.json, at most every FLUSH_INTERVAL
+seconds after a change, and render() sums the files of every worker, so a
+scrape answered by any worker reports the whole service. Series of workers
+that exited are folded into retired.json (see retire) and keep counting, so
+counters never go backwards while the service runs.
+"""
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Upper bounds in seconds, from a single OpenCV call to a 48 MP worst case
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Seconds a process may hold changes before writing them to the spool
+FLUSH_INTERVAL = 1.0
+
+RETIRED = 'retired.json'
+
+_registry = []
+_spool = None
+_dirty = threading.Event()
+_flusher_lock = threading.Lock()
+_flusher_pid = None
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (f'{name}="{_escape(value)}"' for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Histogram:
+    """Cumulative histogram with a fixed label set"""
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+        _changed()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {'counts': list(series['counts']), 'sum': series['sum'], 'count': series['count']}
+                    for key, series in self._series.items()}
+
+    @staticmethod
+    def combine(total, key, series):
+        mine = total.get(key)
+        if mine is None:
+            total[key] = {'counts': list(series['counts']), 'sum': series['sum'], 'count': series['count']}
+        elif len(mine['counts']) == len(series['counts']):
+            mine['counts'] = [a + b for a, b in zip(mine['counts'], series['counts'])]
+            mine['sum'] += series['sum']
+            mine['count'] += series['count']
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        if values is None:
+            values = self.snapshot()
+        for key, series in sorted(values.items()):
+            for bound, count in zip(self.buckets, series['counts']):
+                labels = _format_labels(self.label_names, key, ('le', _format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.label_names, key, ('le', '+Inf'))
+            lines.append(f'{self.name}_bucket{labels} {series["count"]}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(series["sum"])}')
+            lines.append(f'{self.name}_count{labels} {series["count"]}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter with a fixed label set"""
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(total, key, value):
+        total[key] = total.get(key, 0) + value
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        if values is None:
+            values = self.snapshot()
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}')
+        return lines
+
+
+def configure(directory):
+    """Share the series of every process through files in directory, None keeps them per process"""
+    global _spool
+    _spool = directory or None
+    if _spool:
+        os.makedirs(_spool, exist_ok=True)
+
+
+def _changed():
+    """Note new data, and start this process's flusher on its first change"""
+    global _flusher_pid
+    if _spool is None:
+        return
+    _dirty.set()
+    if _flusher_pid != os.getpid():
+        with _flusher_lock:
+            if _flusher_pid != os.getpid():
+                # Threads do not survive fork, every worker starts its own
+                _flusher_pid = os.getpid()
+                threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+
+def _flush_loop():
+    while True:
+        _dirty.wait()
+        time.sleep(FLUSH_INTERVAL)
+        _dirty.clear()
+        try:
+            flush()
+        except OSError:
+            # Retried with the next change; the series stay in memory
+            pass
+
+
+def _snapshot():
+    return {metric.name: [[list(key), value] for key, value in metric.snapshot().items()] for metric in _registry}
+
+
+def _write(path, document):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(document, f)
+    os.replace(tmp, path)
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _locked(mode):
+    lock = open(os.path.join(_spool, '.lock'), 'w')
+    fcntl.flock(lock, mode)
+    return lock
+
+
+def flush():
+    """Write this process's series to the spool"""
+    if _spool is None:
+        return
+    with _locked(fcntl.LOCK_SH):
+        _write(os.path.join(_spool, f'{os.getpid()}.json'), _snapshot())
+
+
+def retire(pid):
+    """Fold the series of a process that exited into retired.json (run by the gunicorn master)"""
+    if _spool is None:
+        return
+    path = os.path.join(_spool, f'{pid}.json')
+    with _locked(fcntl.LOCK_EX):
+        document = _load(path)
+        if not document:
+            return
+        _write(os.path.join(_spool, RETIRED), _merge([_load(os.path.join(_spool, RETIRED)), document]))
+        os.remove(path)
+
+
+def clear():
+    """Forget every process's series, when the service (re)starts"""
+    if _spool is None:
+        return
+    with _locked(fcntl.LOCK_EX):
+        for name in os.listdir(_spool):
+            if name.endswith('.json'):
+                os.remove(os.path.join(_spool, name))
+
+
+def _merge(documents):
+    """Sum spool documents into one, series as [key, value] pairs"""
+    by_name = {metric.name: metric for metric in _registry}
+    totals = {}
+    for document in documents:
+        for name, pairs in document.items():
+            metric = by_name.get(name)
+            if metric is None:
+                continue
+            total = totals.setdefault(name, {})
+            for key, value in pairs:
+                metric.combine(total, tuple(key), value)
+    return {name: [[list(key), value] for key, value in total.items()] for name, total in totals.items()}
+
+
+def _collect():
+    """Series of every process: name -> {key: value}"""
+    flush()
+    with _locked(fcntl.LOCK_SH):
+        documents = [_load(os.path.join(_spool, name)) for name in sorted(os.listdir(_spool))
+                     if name.endswith('.json')]
+    return {name: {tuple(key): value for key, value in pairs} for name, pairs in _merge(documents).items()}
+
+
+def render(samples=None):
+    """
+    Text exposition of every registered metric
+
+    Args:
+        samples: Optional (name, type, documentation, value) tuples sampled at
+            scrape time, for values other components already count
+    """
+    lines = []
+    collected = _collect() if _spool is not None else None
+    for metric in _registry:
+        lines.extend(metric.render(collected.get(metric.name, {}) if collected is not None else None))
+    for name, kind, documentation, value in samples or ():
+        lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {_format_value(value)}'])
+    return '\n'.join(lines) + '\n'
+
+
+def megapixel_bucket(megapixels):
+    """Coarse input size label, matching the buckets used by bench.py"""
+    if megapixels is None:
+        return 'unknown'
+    for bound, label in ((3, '0-3'), (8, '3-8'), (16, '8-16'), (32, '16-32')):
+        if megapixels < bound:
+            return label
+    return '32+'
@@ -0,0 +1,210 @@
+"""
+Adaptive detection strategy order
+
+Engines list their strategies in one fixed preference order, but which
+strategy ends up finding the page depends heavily on the traffic: one Canny
+threshold set may accept nine pages in ten for dim phone photos while the
+first one in the list keeps failing on them. StrategyScheduler counts, per
+bucket of similar images, how often each strategy was tried, how often its
+quad was accepted and a score for those quads, and orders the strategies by
+their mean score. Acceptance alone would favour the permissive fallbacks,
+which accept something on nearly every image: the caller scores each win by
+how good the quad is (see record), and strategies named in fixed are kept
+out of the ranking altogether: they always run last, in engine order.
+
+Every strategy starts from the same prior, so without data (or for an
+unseen bucket) the engine's own order is kept. A small share of requests
+explore: one strategy other than the current favourite is moved to the
+front, so strategies that only ever run after a winner still get measured.
+
+Counts are kept as deltas on top of the last snapshot read from path and
+merged into the file under a lock when saved, so several worker processes
+can share one file without overwriting each other's counts. A background
+thread saves save_interval seconds after the first record since the last
+save, so no request waits on the file lock.
+"""
+import copy
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+
+
+def _add(total, delta):
+    """Add the numeric leaves of nested dict delta into total"""
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            _add(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+class StrategyScheduler:
+    """
+    Thread-safe per-bucket strategy success rates
+
+        names, explored = scheduler.order(bucket, names)
+        ...run them in that order...
+        scheduler.record(bucket, tried, winner, explored)
+    """
+
+    def __init__(self, path=None, explore=0.05, save_interval=30.0, rng=None, fixed=()):
+        self.path = path or None
+        self.explore = explore
+        self.fixed = frozenset(fixed)
+        self.save_interval = save_interval
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._base = {}
+        self._pending = {}
+        self._dirty = threading.Event()
+        self._saver_pid = None
+        if self.path:
+            self._base = self._read()
+
+    def _counts(self, bucket=None):
+        """Saved plus pending counts, of every bucket or of one"""
+        if bucket is not None:
+            counts = copy.deepcopy(self._base.get(bucket, {}))
+            _add(counts, self._pending.get(bucket, {}))
+            return counts
+        counts = copy.deepcopy(self._base)
+        _add(counts, self._pending)
+        return counts
+
+    @staticmethod
+    def _rate(entry):
+        # Laplace prior: untried strategies start at 0.5, ties keep the engine order
+        return (entry.get('score', 0) + 1.0) / (entry.get('tries', 0) + 2.0)
+
+    def _ranked(self, names, counts):
+        """names best first, the fixed ones last in their given order"""
+        ranked = sorted((name for name in names if name not in self.fixed),
+                        key=lambda name: -self._rate(counts.get(name, {})))
+        return ranked, [name for name in names if name in self.fixed]
+
+    def order(self, bucket, names):
+        """
+        Strategy names for an image in bucket, best first
+
+        Strategies in fixed are neither promoted on their record nor for
+        exploration.
+
+        Returns:
+            (names, explored): explored is True when a strategy was promoted
+            to the front for exploration rather than on its record
+        """
+        with self._lock:
+            counts = self._counts(bucket).get('strategies', {})
+        ranked, last = self._ranked(names, counts)
+        if len(ranked) > 1 and self._rng.random() < self.explore:
+            ranked.insert(0, ranked.pop(self._rng.randrange(1, len(ranked))))
+            return ranked + last, True
+        return ranked + last, False
+
+    def record(self, bucket, tried, winner, explored=False, score=1.0):
+        """
+        Count one detection
+
+        Args:
+            bucket: Bucket the image fell in
+            tried: (name, ms) of the strategies run, in order
+            winner: Name of the strategy whose quad was accepted, None for a miss
+            explored: The order came from exploration (see order)
+            score: Quality of the winner's quad, 0..1; strategies are ranked
+                on their score per try
+        """
+        delta = {'strategies': {}, 'requests': {}}
+        for name, ms in tried:
+            won = name == winner
+            delta['strategies'][name] = {'tries': 1, 'wins': int(won), 'score': score if won else 0.0, 'ms': ms}
+        delta['requests']['explore' if explored else 'adaptive'] = {
+            'count': 1, 'found': int(winner is not None), 'ms': sum(ms for _, ms in tried)}
+
+        with self._lock:
+            _add(self._pending.setdefault(bucket, {}), delta)
+        if self.path:
+            self._changed()
+
+    def _changed(self):
+        """Note new counts, and start this process's saver on the first"""
+        self._dirty.set()
+        if self._saver_pid != os.getpid():
+            with self._lock:
+                if self._saver_pid != os.getpid():
+                    # Threads do not survive fork, every worker starts its own
+                    self._saver_pid = os.getpid()
+                    threading.Thread(target=self._save_loop, name='scheduler-save', daemon=True).start()
+
+    def _save_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.save_interval)
+            self._dirty.clear()
+            if not self.save():
+                self._dirty.set()
+
+    def stats(self):
+        """Per bucket: current order, strategy success rates and scores, and mean cascade time by order kind"""
+        with self._lock:
+            counts = self._counts()
+        buckets = {}
+        for bucket, entry in sorted(counts.items()):
+            strategies = entry.get('strategies', {})
+            ranked, last = self._ranked(list(strategies), strategies)
+            buckets[bucket] = {
+                'order': ranked + last,
+                'strategies': {name: {
+                    'tries': s.get('tries', 0),
+                    'wins': s.get('wins', 0),
+                    'rate': round(s.get('wins', 0) / s['tries'], 3) if s.get('tries') else None,
+                    'score': round(s.get('score', 0) / s['tries'], 3) if s.get('tries') else None,
+                    'mean_ms': round(s.get('ms', 0) / s['tries'], 2) if s.get('tries') else None,
+                } for name, s in strategies.items()},
+                'requests': {kind: {
+                    'count': r.get('count', 0),
+                    'found': r.get('found', 0),
+                    'mean_ms': round(r.get('ms', 0) / r['count'], 2) if r.get('count') else None,
+                } for kind, r in entry.get('requests', {}).items()},
+            }
+        return {'explore': self.explore, 'path': self.path, 'buckets': buckets}
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # A damaged file only costs the history, never detection
+            return {}
+
+    def save(self):
+        """
+        Merge the counts recorded since the last save into path
+
+        Returns False when the file could not be written; the counts are then
+        kept for the next save.
+        """
+        if not self.path:
+            return True
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        try:
+            with open(self.path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                counts = self._read()
+                _add(counts, pending)
+                tmp = f'{self.path}.{os.getpid()}.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(counts, f)
+                os.replace(tmp, self.path)
+        except OSError:
+            with self._lock:
+                _add(self._pending, pending)
+            return False
+        with self._lock:
+            self._base = counts
+        return True
@@ -0,0 +1,197 @@
+"""
+Synthetic document scenes with known page corners
+
+Every scene is a page with lines of "text" placed with a random rotation and
+perspective on a textured background, under uneven lighting and sensor
+noise. Scenes are fully determined by (width, height, seed), so benchmarks
+can regenerate the same data set offline instead of shipping photos.
+"""
+import cv2
+import numpy as np
+
+# Megapixel bucket -> (width, height) of a 4:3 phone photo
+RESOLUTIONS = {
+    2: (1632, 1224),
+    12: (4000, 3000),
+    24: (5664, 4248),
+    48: (8000, 6000),
+}
+
+# Page aspect ratios (long / short): A4, US Letter, a till receipt
+PAGE_ASPECTS = (1.414, 1.294, 2.4)
+
+BACKGROUNDS = ('plain', 'wood', 'fabric')
+
+
+def make_background(width, height, rng, kind):
+    """Dark-to-mid uint8 BGR surface the page lies on"""
+    base = rng.uniform(35, 110)
+    tint = rng.uniform(0.75, 1.0, size=3)
+
+    # Low-frequency variation shared by every kind
+    coarse = rng.uniform(-20, 20, size=(9, 12)).astype("float32")
+    surface = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    surface += base
+
+    if kind == 'wood':
+        # Grain: stretched noise along one axis
+        grain = rng.uniform(-18, 18, size=(max(2, height // 16), 6)).astype("float32")
+        surface += cv2.resize(grain, (width, height), interpolation=cv2.INTER_LINEAR)
+    elif kind == 'fabric':
+        # Fine weave: small noise tile repeated over the frame
+        tile = rng.uniform(-14, 14, size=(32, 32)).astype("float32")
+        tile = cv2.GaussianBlur(tile, (3, 3), 0)
+        reps = (height // 32 + 1, width // 32 + 1)
+        surface += np.tile(tile, reps)[:height, :width]
+
+    gray = np.clip(surface, 0, 255).astype(np.uint8)
+    del surface
+    return cv2.merge([cv2.convertScaleAbs(gray, alpha=float(t)) for t in tint])
+
+
+def add_clutter(scene, rng, count):
+    """Scatter small objects (paper scraps, coins, pens) over the background"""
+    height, width = scene.shape[:2]
+    size = 0.04 * min(width, height)
+    for _ in range(count):
+        x, y = int(rng.uniform(0, width)), int(rng.uniform(0, height))
+        color = tuple(int(c) for c in rng.uniform(20, 230, size=3))
+        kind = rng.integers(3)
+        if kind == 0:
+            w, h = rng.uniform(0.2, 1.0, size=2) * size
+            box = cv2.boxPoints(((x, y), (w, h), rng.uniform(0, 180)))
+            cv2.fillConvexPoly(scene, box.astype(np.int32), color)
+        elif kind == 1:
+            cv2.circle(scene, (x, y), int(rng.uniform(0.1, 0.5) * size), color, -1)
+        else:
+            dx, dy = rng.uniform(-1, 1, size=2) * 2 * size
+            cv2.line(scene, (x, y), (int(x + dx), int(y + dy)), color, max(1, int(size / 15)))
+
+
+def make_page(rng, aspect, long_edge=1100):
+    """Page image with lines of text, portrait orientation"""
+    page_h = long_edge
+    page_w = int(round(long_edge / aspect))
+    shade = rng.uniform(215, 250)
+    page = np.empty((page_h, page_w, 3), dtype=np.uint8)
+    page[:] = (shade * rng.uniform(0.95, 1.0), shade * rng.uniform(0.97, 1.0), shade)
+
+    margin = page_w // 10
+    line_height = max(6, page_h // 90)
+    for y in range(margin, page_h - margin, 3 * line_height):
+        line_end = int(rng.uniform(0.45, 0.9) * page_w)
+        ink = int(rng.uniform(20, 70))
+        cv2.rectangle(page, (margin, y), (line_end, y + line_height), (ink, ink, ink), -1)
+    return page
+
+
+def page_corners(width, height, page_w, page_h, rng):
+    """Random rotated and perspective-jittered placement inside the frame"""
+    area_fraction = rng.uniform(0.25, 0.55)
+    scale = np.sqrt(area_fraction * width * height / float(page_w * page_h))
+    half = np.array([page_w, page_h], dtype="float32") * scale / 2.0
+
+    angle = np.deg2rad(rng.uniform(-15, 15))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)],
+                         [np.sin(angle), np.cos(angle)]], dtype="float32")
+
+    box = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype="float32") * half
+    box = box @ rotation.T
+    jitter = 0.05 * min(width, height)
+    box += rng.uniform(-jitter, jitter, size=(4, 2)).astype("float32")
+
+    # Shrink pages that would not fit (a tall page in a landscape frame)
+    margin = 0.03 * min(width, height)
+    room = np.array([width, height], dtype="float32") - 2 * margin
+    box *= min(1.0, float(np.min(room / (box.max(axis=0) - box.min(axis=0)))))
+
+    # Centre with some play, keeping every corner off the frame edge
+    lo = -box.min(axis=0) + margin
+    hi = np.array([width, height], dtype="float32") - box.max(axis=0) - margin
+    centre = np.array([rng.uniform(lo[0], max(lo[0], hi[0])), rng.uniform(lo[1], max(lo[1], hi[1]))],
+                      dtype="float32")
+    return (box + centre).astype("float32")
+
+
+def apply_lighting(scene, rng):
+    """Uneven illumination: a linear falloff plus a vignette, applied in place"""
+    height, width = scene.shape[:2]
+    small_w, small_h = 64, 48
+    xs = np.linspace(-1, 1, small_w, dtype="float32")[np.newaxis, :]
+    ys = np.linspace(-1, 1, small_h, dtype="float32")[:, np.newaxis]
+
+    direction = rng.uniform(-1, 1, size=2)
+    gain = 1.0 + 0.12 * (direction[0] * xs + direction[1] * ys)
+    gain *= 1.0 - rng.uniform(0.05, 0.2) * (xs ** 2 + ys ** 2) / 2.0
+
+    # Gain as uint8 (128 = 1.0) so full resolution scenes stay in uint8
+    gain = np.clip(gain * 128.0, 0, 255).astype(np.uint8)
+    gain = cv2.resize(gain, (width, height), interpolation=cv2.INTER_LINEAR)
+    gain = cv2.merge([gain, gain, gain])
+    cv2.multiply(scene, gain, dst=scene, scale=1.0 / 128.0)
+
+
+def apply_noise(scene, rng):
+    """Gaussian sensor noise, applied in place"""
+    sigma = rng.uniform(2, 8)
+    noise = np.empty_like(scene)
+    cv2.setRNGSeed(int(rng.integers(0, 2 ** 31)))
+    cv2.randn(noise, (128, 128, 128), (sigma, sigma, sigma))
+    cv2.addWeighted(scene, 1.0, noise, 1.0, -128.0, dst=scene)
+
+
+def make_scene(width, height, seed=0, background=None, clutter=0, contrast=1.0):
+    """
+    Render a page on a textured background with a random perspective
+
+    Args:
+        width: Scene width in pixels
+        height: Scene height in pixels
+        seed: Random seed, the same seed always renders the same scene
+        background: One of BACKGROUNDS, random when None
+        clutter: Number of small objects scattered around the page
+        contrast: Exposure scale, below 1 renders a dim, low contrast capture
+
+    Returns:
+        (image, corners) where corners are the page corners (tl, tr, br, bl)
+    """
+    rng = np.random.default_rng(seed)
+    kind = background or BACKGROUNDS[int(rng.integers(len(BACKGROUNDS)))]
+
+    scene = make_background(width, height, rng, kind)
+    if clutter:
+        add_clutter(scene, rng, clutter)
+    page = make_page(rng, PAGE_ASPECTS[int(rng.integers(len(PAGE_ASPECTS)))])
+    page_h, page_w = page.shape[:2]
+    corners = page_corners(width, height, page_w, page_h, rng)
+
+    src = np.array([[0, 0], [page_w - 1, 0], [page_w - 1, page_h - 1], [0, page_h - 1]], dtype="float32")
+    M = cv2.getPerspectiveTransform(src, corners)
+    cv2.warpPerspective(page, M, (width, height), dst=scene, borderMode=cv2.BORDER_TRANSPARENT)
+
+    apply_lighting(scene, rng)
+    apply_noise(scene, rng)
+
+    if rng.uniform() < 0.3:
+        # Slight defocus on some captures
+        cv2.GaussianBlur(scene, (3, 3), 0, dst=scene)
+
+    if contrast != 1.0:
+        cv2.convertScaleAbs(scene, dst=scene, alpha=contrast)
+
+    return scene, corners
+
+
+def make_dataset(buckets, count, seed=0, clutter=0, contrast=1.0):
+    """
+    Yield (bucket, index, image, corners) for count scenes per megapixel bucket
+
+    Scenes are rendered one at a time so large buckets never sit in memory together.
+    """
+    for mp in buckets:
+        width, height = RESOLUTIONS[mp]
+        for index in range(count):
+            image, corners = make_scene(width, height, seed=seed + 1000 * mp + index, clutter=clutter,
+                                        contrast=contrast)
+            yield mp, index, image, corners
+
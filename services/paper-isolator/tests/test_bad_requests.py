@@ -0,0 +1,98 @@
+"""
+Invalid options are client errors: 400 with a message, never a 500
+"""
+import base64
+
+import cv2
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.fixture(scope='module')
+def jpeg():
+    image = np.full((240, 320, 3), 40, dtype=np.uint8)
+    cv2.rectangle(image, (60, 40), (260, 200), (235, 235, 235), -1)
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize('query', [
+    'detect_engine=nope',
+    'detect_max_edge=-1',
+    'detect_max_edge=big',
+    'output_paper=a9',
+    'output_dpi=0',
+    'output_dpi=high',
+    'output_dpi=1200',
+    'output_paper=legal&output_dpi=600',
+    'detect_hint=1,2,3',
+    'detect_hint=1,2,3,4,5,6,7,nan',
+    'output_quality=101',
+])
+def test_raw_options(client, jpeg, query):
+    response = client.post(f'/paper-isolate?{query}', data=jpeg, content_type='image/jpeg')
+
+    assert response.status_code == 400
+    assert response.json['document_detected'] is False
+
+
+@pytest.mark.parametrize('fields', [
+    {'detect_engine': 'nope'},
+    {'detect_max_edge': -1},
+    {'detect_hint': 5},
+    {'detect_hint': [[0, 0], [10, 0], [10, 'x'], [0, 10]]},
+])
+def test_json_options(client, jpeg, fields):
+    body = dict(fields, image=base64.b64encode(jpeg).decode())
+
+    assert client.post('/paper-isolate', json=body).status_code == 400
+    assert client.post('/paper-isolate/jobs', json=body).status_code == 400
+    assert client.post('/paper-isolate/batch', json=dict(fields, images=[body['image']])).status_code == 400
+
+
+def test_deadline_header(client, jpeg):
+    response = client.post('/paper-isolate', data=jpeg, content_type='image/jpeg', headers={'X-Deadline-Ms': 'soon'})
+
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('body', [
+    b'[1, 2]',
+    b'{"image": "abc\\u0041"}',
+    b'{"image": "abcde"}',
+    b'{"image": "ab',
+    b'{"detect_engine": ',
+])
+def test_malformed_json(client, body):
+    response = client.post('/paper-isolate', data=body, content_type='application/json')
+
+    assert response.status_code == 400
+
+
+def test_batch_body_limit(client, jpeg, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_BODY_BYTES', 1024)
+    body = {'images': [base64.b64encode(jpeg).decode()] * 4}
+
+    assert client.post('/paper-isolate/batch', json=body).status_code == 413
+
+
+def test_batch_pixel_limit(client, jpeg, monkeypatch):
+    monkeypatch.setattr(app, 'MAX_IMAGE_PIXELS', 1000)
+    response = client.post('/paper-isolate/batch', json={'images': [base64.b64encode(jpeg).decode(), 7]})
+
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json['results']] == [413, 400]
+
+
+def test_output_size_within_limit(client, jpeg):
+    response = client.post('/paper-isolate?output_paper=legal&output_dpi=600&output_max_edge=4000',
+                           data=jpeg, content_type='image/jpeg')
+
+    assert response.status_code == 200
+    assert max(int(response.headers['X-Image-Width']), int(response.headers['X-Image-Height'])) == 4000
@@ -0,0 +1,103 @@
+"""
+Result cache: bounded by bytes with LRU eviction, keyed by image and options
+"""
+import pytest
+
+import app
+from cache import ENTRY_OVERHEAD, ResultCache, cache_key
+
+IMAGE = b'\xff\xd8' + bytes(range(256)) * 4
+
+
+def test_eviction_respects_max_bytes():
+    cache = ResultCache(max_bytes=10 * ENTRY_OVERHEAD)
+    sizes = [ENTRY_OVERHEAD, 3 * ENTRY_OVERHEAD, 0, 2 * ENTRY_OVERHEAD, 5 * ENTRY_OVERHEAD, 100]
+    for index, size in enumerate(sizes):
+        assert cache.put(f'k{index}', index, size)
+        assert cache.current_bytes <= cache.max_bytes
+    stats = cache.stats()
+    assert stats['bytes'] == cache.current_bytes == sum(
+        size + ENTRY_OVERHEAD for index, size in enumerate(sizes) if cache.get(f'k{index}') is not None)
+    assert stats['evictions'] == len(sizes) - stats['entries']
+
+
+def test_eviction_order_is_lru():
+    cache = ResultCache(max_bytes=3 * ENTRY_OVERHEAD)
+    for key in 'abc':
+        cache.put(key, key, 0)
+    # A hit makes 'a' the most recent, so 'b' is the oldest
+    assert cache.get('a') == 'a'
+    cache.put('d', 'd', 0)
+    assert cache.get('b') is None
+    assert [cache.get(key) for key in 'acd'] == ['a', 'c', 'd']
+    # Replacing an entry refreshes it and counts its new size only
+    cache.put('a', 'A', ENTRY_OVERHEAD)
+    assert cache.current_bytes == 3 * ENTRY_OVERHEAD
+    assert (cache.get('a'), cache.get('c'), cache.get('d')) == ('A', None, 'd')
+
+
+def test_too_large_for_the_cache():
+    cache = ResultCache(max_bytes=4 * ENTRY_OVERHEAD)
+    cache.put('small', 1, 0)
+    # Refused outright, without evicting what is there
+    assert not cache.put('large', 2, 4 * ENTRY_OVERHEAD)
+    assert cache.get('large') is None and cache.get('small') == 1
+    assert cache.stats()['evictions'] == 0
+    assert cache.put('fits', 3, 3 * ENTRY_OVERHEAD)
+    assert cache.get('small') is None and cache.current_bytes == 4 * ENTRY_OVERHEAD
+
+
+def test_disabled():
+    cache = ResultCache(max_bytes=0)
+    assert not cache.put('k', 1, 0)
+    assert cache.get('k') is None and cache.stats()['misses'] == 1
+
+
+def test_clear_and_counters():
+    cache = ResultCache(max_bytes=8 * ENTRY_OVERHEAD)
+    cache.put('k', 1, 10)
+    cache.get('k')
+    cache.get('missing')
+    assert cache.stats()['hit_rate'] == 0.5
+    cache.clear()
+    assert cache.get('k') is None
+    assert cache.stats()['entries'] == cache.stats()['bytes'] == 0
+
+
+@pytest.mark.parametrize('fields', [
+    {'detect_max_edge': '800'},
+    {'detect_max_edge': '0'},
+    {'detect_engine': 'lines'},
+    {'detect_engine': 'fast'},
+    {'detect_concurrent': 'true'},
+    {'detect_multi': 'true'},
+    {'detect_hint': '1,2,3,4,5,6,7,8'},
+    {'detect_hint': '1,2,3,4,5,6,7,9'},
+    {'output_max_edge': '1000'},
+    {'output_paper': 'a4'},
+    {'output_paper': 'letter'},
+    {'output_paper': 'a4', 'output_dpi': '300'},
+    {'output_quality': '80'},
+])
+def test_options_change_the_key(fields):
+    default = app.detection_options({})
+    options = app.detection_options(fields)
+    assert options != default
+    assert cache_key(IMAGE, options) != cache_key(IMAGE, default)
+
+
+def test_all_option_variants_distinct():
+    variants = [{}, {'output_quality': '80'}, {'output_quality': '81'}, {'output_dpi': '300'},
+                {'output_paper': 'a4'}, {'output_paper': 'a4', 'output_dpi': '300'}, {'detect_max_edge': '800'}]
+    keys = {cache_key(IMAGE, app.detection_options(fields)) for fields in variants}
+    assert len(keys) == len(variants)
+
+
+def test_key_depends_on_image_not_its_type_or_option_order():
+    options = app.detection_options({})
+    key = cache_key(IMAGE, options)
+    assert cache_key(bytearray(IMAGE), options) == key
+    assert cache_key(memoryview(IMAGE), options) == key
+    assert cache_key(IMAGE, dict(reversed(list(options.items())))) == key
+    assert cache_key(IMAGE[:-1] + b'\x00', options) != key
+    assert cache_key(IMAGE + b'\x00', options) != key
@@ -0,0 +1,93 @@
+"""
+Concurrent detection reports the same strategies and stages as a sequential run
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import app
+
+QUAD = np.array([[[120, 80]], [[520, 100]], [[500, 400]], [[140, 380]]], dtype=np.int32)
+
+
+@pytest.fixture
+def image():
+    return np.full((480, 640, 3), 128, dtype=np.uint8)
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    """A miss, the winner, and a strategy still running after the answer is chosen"""
+    release = threading.Event()
+    finished = threading.Event()
+
+    def miss(stages, min_area, max_area):
+        stages.gray()
+        return None
+
+    def win(stages, min_area, max_area):
+        stages.enhanced()
+        return QUAD
+
+    def straggler(stages, min_area, max_area):
+        release.wait(5)
+        try:
+            stages.threshold()
+        finally:
+            finished.set()
+        return QUAD
+
+    monkeypatch.setitem(app.DETECTION_ENGINES, 'test',
+                        lambda: [('miss', miss), ('win', win), ('straggler', straggler)])
+    monkeypatch.setattr(app, '_detect_pool', ThreadPoolExecutor(max_workers=3))
+    monkeypatch.setattr(app, 'ADAPTIVE_ORDER', False)
+    yield release, finished
+    release.set()
+
+
+def names(entries):
+    return [entry['name'] for entry in entries]
+
+
+def test_straggler_does_not_record(image, engine):
+    release, finished = engine
+    sequential = {}
+    app.find_document_corners(image, stats=sequential, engine='test')
+    assert names(sequential['strategies']) == ['miss', 'win']
+
+    stats = {}
+    pts = app.find_document_corners(image, stats=stats, engine='test', concurrent=True)
+    assert pts is not None and stats['strategy'] == 'win'
+    recorded = {key: list(stats[key]) for key in ('strategies', 'stages')}
+
+    # Let the straggler finish its stage and strategy after the answer
+    release.set()
+    assert finished.wait(5)
+    time.sleep(0.05)
+    assert {key: stats[key] for key in ('strategies', 'stages')} == recorded
+    assert names(stats['strategies']) == names(sequential['strategies'])
+    assert names(stats['stages']) == names(sequential['stages'])
+    assert 'threshold' not in names(stats['stages'])
+
+
+def test_deadline_keeps_later_result(image, engine, monkeypatch):
+    # Past the deadline the answer may come from a later strategy that already
+    # finished; its record is kept with it
+    release, finished = engine
+
+    def slow_win(stages, min_area, max_area):
+        time.sleep(0.2)
+        return None
+
+    monkeypatch.setitem(app.DETECTION_ENGINES, 'test',
+                        lambda: [('slow', slow_win), ('quick', lambda stages, *_: (stages.gray(), QUAD)[1])])
+    stats = {}
+    pts = app.find_document_corners(image, stats=stats, engine='test', concurrent=True,
+                                    deadline=time.perf_counter() + 0.1)
+    assert pts is not None
+    assert stats['truncated'] and stats['strategy'] == 'quick'
+    assert names(stats['strategies']) == ['quick']
+    assert 'gray' in names(stats['stages'])
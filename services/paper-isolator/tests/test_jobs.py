@@ -0,0 +1,132 @@
+"""
+JobQueue: results kept for a TTL within count and size limits, shared through the job directory
+"""
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import jobs
+from jobs import JobQueue, QueueFull
+
+
+def result(value, size=0):
+    return lambda: ({'value': value, 'pad': 'x' * size}, 200)
+
+
+def run(queue, fn):
+    """Submit fn and wait for it to finish"""
+    job_id = queue.submit(fn)
+    record = queue.get(job_id, wait=5)
+    assert record['status'] == 'done'
+    return job_id
+
+
+def test_result_and_failure():
+    queue = JobQueue()
+    record = queue.get(run(queue, result(1)))
+    assert (record['result']['value'], record['status_code']) == (1, 200)
+
+    def fail():
+        raise RuntimeError('boom')
+    record = queue.get(queue.submit(fail), wait=5)
+    assert (record['status'], record['error'], record['status_code']) == ('failed', 'boom', 500)
+    assert queue.get('0' * 32) is None
+
+
+def test_ttl_expiry(tmp_path):
+    queue = JobQueue(ttl=0.2, directory=str(tmp_path))
+    job_id = run(queue, result(1))
+    assert queue.get(job_id) is not None
+    assert os.path.exists(tmp_path / f'{job_id}.json')
+    time.sleep(0.3)
+    assert queue.get(job_id) is None
+    assert queue.stats()['finished'] == 0
+    assert not os.path.exists(tmp_path / f'{job_id}.json')
+
+
+def test_eviction_order(tmp_path):
+    queue = JobQueue(max_finished=2, directory=str(tmp_path))
+    first, second, third = (run(queue, result(i)) for i in range(3))
+    # The oldest finished job goes first, in memory and on disk
+    assert queue.get(first) is None
+    assert not os.path.exists(tmp_path / f'{first}.json')
+    assert queue.get(second)['result']['value'] == 1
+    assert queue.get(third)['result']['value'] == 2
+    assert queue.stats()['finished'] == 2
+
+
+def test_max_result_bytes():
+    queue = JobQueue(max_result_bytes=3000)
+    small = [run(queue, result(i, 900)) for i in range(4)]
+    assert queue.stats()['finished_bytes'] <= 3000
+    assert queue.get(small[0]) is None and queue.get(small[-1]) is not None
+
+    # A result over the limit on its own evicts everything older but is kept itself
+    large = run(queue, result('large', 10000))
+    assert [queue.get(job_id) for job_id in small] == [None] * 4
+    assert queue.get(large)['result']['value'] == 'large'
+    assert queue.stats()['finished'] == 1
+
+    # and goes as soon as the next result finishes
+    last = run(queue, result('last'))
+    assert queue.get(large) is None
+    assert queue.get(last) is not None
+
+
+def test_queue_full():
+    release = threading.Event()
+    queue = JobQueue(workers=1, max_queued=2)
+    running = queue.submit(lambda: (release.wait(5), 200))
+    while queue.stats()['running'] == 0:
+        time.sleep(0.01)
+    queued = [queue.submit(result(i)) for i in range(2)]
+    with pytest.raises(QueueFull):
+        queue.submit(result(3))
+    assert queue.stats()['rejected'] == 1
+    release.set()
+    for job_id in [running] + queued:
+        assert queue.get(job_id, wait=5)['status'] == 'done'
+
+
+def test_other_instance(tmp_path, monkeypatch):
+    # Two queues on one directory stand for two gunicorn worker processes
+    monkeypatch.setattr(jobs, 'POLL_INTERVAL', 0.01)
+    owner = JobQueue(directory=str(tmp_path))
+    other = JobQueue(directory=str(tmp_path))
+    release = threading.Event()
+    job_id = owner.submit(lambda: (release.wait(5) and {'value': 'shared'}, 201))
+
+    record = other.get(job_id)
+    assert record['status'] in ('queued', 'running')
+    threading.Timer(0.1, release.set).start()
+    # Long-polls the file until the owner writes the result
+    record = other.get(job_id, wait=5)
+    assert (record['status'], record['result'], record['status_code']) == ('done', {'value': 'shared'}, 201)
+    assert other.stats()['finished'] == 0
+
+
+def test_other_instance_expired(tmp_path):
+    # A record whose owner exited without expiring it is dropped by the reader
+    queue = JobQueue(ttl=10, directory=str(tmp_path))
+    job_id = 'a' * 32
+    record = {'id': job_id, 'status': 'done', 'result': {}, 'status_code': 200, 'finished': time.time() - 60}
+    (tmp_path / f'{job_id}.json').write_text(json.dumps(record))
+    assert queue.get(job_id) is None
+    assert not os.path.exists(tmp_path / f'{job_id}.json')
+
+
+@pytest.mark.parametrize('job_id', ['../etc/passwd', 'A' * 32, 'a' * 31, ''])
+def test_other_instance_invalid_id(tmp_path, job_id):
+    assert JobQueue(directory=str(tmp_path)).get(job_id) is None
+
+
+def test_sweep(tmp_path):
+    old, new = tmp_path / f'{"b" * 32}.json', tmp_path / f'{"c" * 32}.json'
+    old.write_text('{}')
+    new.write_text('{}')
+    os.utime(old, (time.time() - 100, time.time() - 100))
+    JobQueue(ttl=10, directory=str(tmp_path))
+    assert not old.exists() and new.exists()
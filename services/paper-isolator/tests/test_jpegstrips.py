@@ -0,0 +1,117 @@
+"""
+A JPEG stitched from strips decodes to the same pixels as one encoded whole
+"""
+import cv2
+import numpy as np
+import pytest
+
+from jpegstrips import MCU_ROWS, StripEncoder, strip_rows
+
+PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 90]
+
+
+def page(height, width, channels=3):
+    rng = np.random.default_rng(height * 1000 + width)
+    y, x = np.mgrid[0:height, 0:width]
+    image = ((x * 3 + y * 5) % 256).astype(np.uint8)
+    image = np.dstack([image, image[::-1, ::-1], 255 - image])[:, :, :channels]
+    noise = rng.integers(-20, 20, size=image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8).squeeze()
+
+
+def stitched(image, rows, params=PARAMS):
+    height, width = image.shape[:2]
+    encoder = StripEncoder(width, height, params)
+    for top in range(0, height, rows):
+        encoder.write(image[top:top + rows])
+    return encoder.finish()
+
+
+def decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+def whole(image, params=PARAMS):
+    return decode(cv2.imencode('.jpg', image, params)[1].tobytes())
+
+
+@pytest.mark.parametrize('height', [1, 15, 16, 17, 47, 100, 257])
+@pytest.mark.parametrize('width', [9, 64, 333])
+@pytest.mark.parametrize('rows', [16, 32, 48])
+def test_matches_whole_image(height, width, rows):
+    image = page(height, width)
+    result = decode(stitched(image, rows))
+    assert result.shape == image.shape
+    assert np.array_equal(result, whole(image))
+
+
+@pytest.mark.parametrize('height', [7, 8, 9, 40, 121])
+@pytest.mark.parametrize('rows', [8, 24])
+def test_grayscale_mcu(height, rows):
+    # One component: 8 row MCUs, so strips of 8 and 24 rows are whole MCUs
+    image = page(height, 50, channels=1)
+    assert np.array_equal(decode(stitched(image, rows)), whole(image))
+
+
+@pytest.mark.parametrize('rows', [16, 32])
+def test_many_restart_markers(rows):
+    # More than 8 strips cycles RST0..RST7
+    image = page(rows * 19 + 5, 40)
+    assert np.array_equal(decode(stitched(image, rows)), whole(image))
+
+
+@pytest.mark.parametrize('rows', [1, 8, 15, 17, 24, 40])
+def test_rows_not_mcu_multiple(rows):
+    # 4:2:0 colour has 16 row MCUs, a strip ending inside one cannot restart there
+    image = page(100, 32)
+    with pytest.raises(ValueError, match='multiple'):
+        stitched(image, rows)
+
+
+def test_rows_not_mcu_multiple_single_strip():
+    # The whole image in one strip is fine whatever its height
+    image = page(37, 32)
+    assert np.array_equal(decode(stitched(image, 37)), whole(image))
+
+
+def test_short_strip_only_last():
+    image = page(64, 32)
+    encoder = StripEncoder(32, 64, PARAMS)
+    encoder.write(image[:32])
+    encoder.write(image[32:48])
+    with pytest.raises(ValueError, match='last'):
+        encoder.write(image[48:])
+
+
+def test_strip_does_not_fit():
+    image = page(32, 32)
+    encoder = StripEncoder(32, 32, PARAMS)
+    with pytest.raises(ValueError, match='fit'):
+        encoder.write(page(16, 31))
+    encoder.write(image[:16])
+    with pytest.raises(ValueError, match='fit'):
+        encoder.write(image)
+    with pytest.raises(ValueError, match='rows'):
+        encoder.finish()
+
+
+def test_different_tables():
+    image = page(32, 32)
+    encoder = StripEncoder(32, 32, PARAMS)
+    encoder.write(image[:16])
+    encoder.params = [cv2.IMWRITE_JPEG_QUALITY, 50]
+    with pytest.raises(ValueError, match='tables'):
+        encoder.write(image[16:])
+
+
+@pytest.mark.parametrize('params', [[cv2.IMWRITE_JPEG_PROGRESSIVE, 1], [cv2.IMWRITE_JPEG_RST_INTERVAL, 4]])
+def test_rejects_non_baseline(params):
+    with pytest.raises(ValueError, match='baseline'):
+        stitched(page(32, 32), 16, PARAMS + params)
+
+
+@pytest.mark.parametrize('width, channels, max_bytes', [(1000, 3, 1), (1000, 3, 100000), (333, 1, 54321), (1, 3, 10**9)])
+def test_strip_rows(width, channels, max_bytes):
+    rows = strip_rows(width, channels, max_bytes)
+    assert rows % MCU_ROWS == 0
+    assert rows == MCU_ROWS or rows * width * channels <= max_bytes
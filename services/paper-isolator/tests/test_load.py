@@ -0,0 +1,128 @@
+"""
+LoadMonitor: counts shared by processes, and the degraded state's hysteresis
+"""
+import multiprocessing
+
+import pytest
+
+import app
+from load import LoadMonitor
+
+
+def load(monitor, count):
+    """Bring this process's count to count"""
+    monitor.exit(monitor.inflight())
+    monitor.enter(count)
+
+
+def test_inflight_hysteresis():
+    monitor = LoadMonitor(high_inflight=4, recover=0.5)
+    # Enters above the watermark, not at it
+    for count, degraded in [(0, False), (4, False), (5, True),
+                            # stays until back to recover * high
+                            (4, True), (3, True), (2, False),
+                            # and the watermark applies again
+                            (4, False), (5, True), (0, False)]:
+        load(monitor, count)
+        assert monitor.degraded() is degraded, count
+
+
+def test_queued_hysteresis():
+    monitor = LoadMonitor(high_queued=10, recover=0.2)
+    for queued, degraded in [(10, False), (11, True), (3, True), (2, False), (10, False)]:
+        assert monitor.degraded(queued) is degraded, queued
+
+
+def test_both_watermarks():
+    # Entering takes either watermark, recovering takes both
+    monitor = LoadMonitor(high_inflight=4, high_queued=4, recover=0.5)
+    load(monitor, 5)
+    assert monitor.degraded(0)
+    load(monitor, 0)
+    assert monitor.degraded(3)
+    assert not monitor.degraded(2)
+    assert monitor.degraded(5)
+    load(monitor, 3)
+    assert monitor.degraded(0)
+    load(monitor, 0)
+
+
+def test_disabled():
+    monitor = LoadMonitor()
+    load(monitor, 100)
+    assert not monitor.degraded(100)
+    assert not monitor.is_degraded()
+    load(monitor, 0)
+
+
+def test_is_degraded_does_not_move_state():
+    monitor = LoadMonitor(high_inflight=2)
+    load(monitor, 3)
+    assert not monitor.is_degraded()
+    assert monitor.degraded()
+    load(monitor, 0)
+    assert monitor.is_degraded()
+    assert monitor.stats()['degraded']
+    assert not monitor.degraded()
+    assert not monitor.is_degraded()
+
+
+def test_try_enter():
+    monitor = LoadMonitor()
+    assert monitor.try_enter(3, weight=2)
+    assert not monitor.try_enter(3, weight=2)
+    assert monitor.try_enter(3)
+    assert monitor.inflight() == 3
+    monitor.exit(3)
+
+
+def _hold(monitor, count, entered, release):
+    monitor.enter(count)
+    entered.set()
+    release.wait(5)
+
+
+@pytest.fixture
+def fork():
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('needs fork, as gunicorn uses')
+    return multiprocessing.get_context('fork')
+
+
+def test_shared_across_processes(fork):
+    # Counts of forked workers add up, and a worker that exits is released
+    monitor = LoadMonitor(high_inflight=4)
+    entered, release = fork.Event(), fork.Event()
+    child = fork.Process(target=_hold, args=(monitor, 3, entered, release))
+    child.start()
+    try:
+        assert entered.wait(5)
+        monitor.enter(2)
+        assert monitor.inflight() == 5
+        assert monitor.degraded()
+    finally:
+        release.set()
+        child.join(5)
+    # The child exited without leaving, as a killed worker would
+    assert monitor.inflight() == 5
+    monitor.release(child.pid)
+    assert monitor.inflight() == 2
+    monitor.exit(2)
+    assert not monitor.degraded()
+
+
+def test_request_options_use_service_queue(monkeypatch):
+    # The queue depth weighed is the service-wide one, the same /load reports
+    monkeypatch.setattr(app, 'load_monitor', LoadMonitor(high_queued=2))
+    monkeypatch.setattr(app, 'queued_jobs', LoadMonitor())
+    app.queued_jobs.enter(3)
+    stats = {}
+    options = app.request_options({}, b'', stats)
+    assert stats.get('degraded') and options['engine'] == app.DEGRADED_ENGINE
+    with app.app.test_client() as client:
+        assert client.get('/paper-isolate/load').get_json()['queued'] == 3
+
+    app.queued_jobs.exit(3)
+    stats = {}
+    app.request_options({}, b'', stats)
+    assert not stats.get('degraded')
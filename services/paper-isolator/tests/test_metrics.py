@@ -0,0 +1,64 @@
+"""
+Metric series shared by worker processes through the spool directory
+"""
+import json
+import os
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def spool(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_registry', [])
+    monkeypatch.setattr(metrics, '_spool', None)
+    metrics.configure(str(tmp_path))
+    return tmp_path
+
+
+def other_worker(spool, pid, histogram, counter):
+    """Spool file of another process with one observation and one increment"""
+    document = {
+        histogram.name: [[['a'], {'counts': [1, 1], 'sum': 0.05, 'count': 1}]],
+        counter.name: [[['a'], 2]],
+    }
+    (spool / f'{pid}.json').write_text(json.dumps(document))
+
+
+def test_render_sums_every_worker(spool):
+    histogram = metrics.Histogram('t_seconds', 'test', ('k',), buckets=(0.1, 1.0))
+    counter = metrics.Counter('t_total', 'test', ('k',))
+    histogram.observe(0.5, k='a')
+    counter.inc(k='a')
+    other_worker(spool, 999999, histogram, counter)
+
+    text = metrics.render()
+
+    assert 't_seconds_bucket{k="a",le="0.1"} 1' in text
+    assert 't_seconds_bucket{k="a",le="1.0"} 2' in text
+    assert 't_seconds_count{k="a"} 2' in text
+    assert 't_total{k="a"} 3.0' in text
+
+
+def test_retired_workers_keep_counting(spool):
+    histogram = metrics.Histogram('t_seconds', 'test', ('k',), buckets=(0.1, 1.0))
+    counter = metrics.Counter('t_total', 'test', ('k',))
+    other_worker(spool, 999998, histogram, counter)
+    other_worker(spool, 999999, histogram, counter)
+
+    metrics.retire(999998)
+    metrics.retire(999999)
+
+    assert sorted(os.listdir(spool)) == ['.lock', metrics.RETIRED]
+    assert 't_total{k="a"} 4.0' in metrics.render()
+
+
+def test_clear(spool):
+    counter = metrics.Counter('t_total', 'test', ('k',))
+    counter.inc(k='a')
+    metrics.flush()
+
+    metrics.clear()
+
+    assert not [name for name in os.listdir(spool) if name.endswith('.json')]
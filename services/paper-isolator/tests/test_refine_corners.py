@@ -0,0 +1,51 @@
+"""
+Corner refinement on pages clipped by the frame edge
+
+Hull and minAreaRect corners of a page running off the photo land on or past
+the border; cornerSubPix rejects an initial corner outside its patch, which
+used to fail the whole request.
+"""
+import cv2
+import numpy as np
+
+import app
+
+WIDTH, HEIGHT = 1632, 1224
+
+
+def edge_page():
+    """Bright convex page on a dark background, cut off by the bottom edge"""
+    image = np.full((HEIGHT, WIDTH, 3), 40, dtype=np.uint8)
+    page = cv2.ellipse2Poly((816, 1000), (520, 420), 8, 0, 360, 45)
+    cv2.fillConvexPoly(image, page, (235, 235, 235))
+    return image
+
+
+def test_corners_on_and_past_the_edge():
+    image = edge_page()
+    rect = np.array([[300, 600], [1300, 600], [1300, 1226], [300, HEIGHT - 1]], dtype="float32")
+
+    refined = app.refine_corners(image, rect, 0.25)
+
+    assert refined.shape == rect.shape
+    assert np.all(np.isfinite(refined))
+    assert np.all(np.abs(refined - rect) <= int(np.ceil(2.0 / 0.25)) + 2 + 1)
+
+
+def test_corners_far_outside_are_kept():
+    image = edge_page()
+    rect = np.array([[-40, -40], [WIDTH + 40, -40], [WIDTH + 40, HEIGHT + 40], [-40, HEIGHT + 40]],
+                    dtype="float32")
+
+    refined = app.refine_corners(image, rect, 0.25)
+
+    np.testing.assert_array_equal(refined, rect)
+
+
+def test_edge_touching_page_request():
+    ok, png = cv2.imencode('.png', edge_page())
+    client = app.app.test_client()
+
+    response = client.post('/paper-isolate', data=png.tobytes(), content_type='image/png')
+
+    assert response.status_code in (200, 404)
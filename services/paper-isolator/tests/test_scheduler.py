@@ -0,0 +1,161 @@
+"""
+Adaptive strategy order: Laplace ranking, fixed fallbacks, saving off the request path
+"""
+import json
+import os
+import random
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+import app
+from scheduler import StrategyScheduler
+
+NAMES = ['a', 'b', 'c', 'd', 'last_1', 'last_2']
+FIXED = ('last_1', 'last_2')
+
+
+def order(scheduler, names=NAMES):
+    return scheduler.order('bucket', names)[0]
+
+
+def test_laplace_prior():
+    scheduler = StrategyScheduler(explore=0.0, fixed=FIXED)
+    # No data: every strategy at 0.5, the engine order is kept
+    assert order(scheduler) == NAMES
+    # One full win (2/3) beats untried (1/2), which beats one miss (1/3)
+    scheduler.record('bucket', [('a', 1.0), ('b', 1.0), ('c', 1.0)], 'c')
+    assert order(scheduler) == ['c', 'd', 'a', 'b', 'last_1', 'last_2']
+    # Other buckets keep their own order
+    assert scheduler.order('other', NAMES)[0] == NAMES
+
+
+def test_laplace_score_and_sample_size():
+    scheduler = StrategyScheduler(explore=0.0)
+    # a: 9 wins in 10 at confidence 0.5 (5.5/12); b: 1 win in 1 at 0.9 (1.9/3)
+    for _ in range(9):
+        scheduler.record('bucket', [('a', 1.0)], 'a', score=0.5)
+    scheduler.record('bucket', [('a', 1.0), ('b', 1.0)], 'b', score=0.9)
+    assert order(scheduler, ['a', 'b']) == ['b', 'a']
+    # Ten more full wins outweigh b's single one: (15.5/22) > (1.9/3)
+    for _ in range(10):
+        scheduler.record('bucket', [('a', 1.0)], 'a', score=1.0)
+    assert order(scheduler, ['a', 'b']) == ['a', 'b']
+    stats = scheduler.stats()['buckets']['bucket']['strategies']
+    assert stats['a']['tries'] == 20 and stats['a']['wins'] == 19 and stats['a']['score'] == 0.725
+
+
+def test_fixed_stay_last():
+    scheduler = StrategyScheduler(explore=0.0, fixed=FIXED)
+    # A fallback that wins everything and a ranked strategy that never does
+    for _ in range(50):
+        scheduler.record('bucket', [(name, 1.0) for name in ['a', 'b', 'c', 'd', 'last_1']], 'last_1')
+    assert order(scheduler) == ['a', 'b', 'c', 'd', 'last_1', 'last_2']
+    # The fixed ones keep the engine order among themselves too
+    assert order(scheduler, ['last_2', 'a', 'last_1']) == ['a', 'last_2', 'last_1']
+    assert scheduler.stats()['buckets']['bucket']['order'][-1] == 'last_1'
+
+
+def test_explore_never_promotes_fixed():
+    scheduler = StrategyScheduler(explore=1.0, rng=random.Random(1), fixed=FIXED)
+    fronts = set()
+    for _ in range(200):
+        names, explored = scheduler.order('bucket', NAMES)
+        assert explored
+        assert names[-2:] == list(FIXED)
+        assert sorted(names[:4]) == ['a', 'b', 'c', 'd']
+        fronts.add(names[0])
+    # The favourite itself is never the one promoted
+    assert fronts == {'b', 'c', 'd'}
+    # Nothing to explore with a single ranked strategy
+    assert scheduler.order('bucket', ['a'] + list(FIXED)) == (['a'] + list(FIXED), False)
+
+
+def test_record_does_not_save(tmp_path):
+    path = str(tmp_path / 'stats.json')
+    scheduler = StrategyScheduler(path, explore=0.0, save_interval=60.0)
+    scheduler.record('bucket', [('a', 1.0)], 'a')
+    # Counted at once, written later by the background thread
+    assert scheduler.stats()['buckets']['bucket']['strategies']['a']['wins'] == 1
+    assert not os.path.exists(path)
+    assert scheduler.save()
+    with open(path) as f:
+        assert json.load(f)['bucket']['strategies']['a']['wins'] == 1
+
+
+def test_background_save(tmp_path):
+    # Two schedulers on one file stand for two worker processes
+    path = str(tmp_path / 'stats.json')
+    first = StrategyScheduler(path, save_interval=0.05)
+    second = StrategyScheduler(path, save_interval=0.05)
+    first.record('bucket', [('a', 1.0)], 'a')
+    second.record('bucket', [('a', 1.0), ('b', 2.0)], 'b')
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            with open(path) as f:
+                counts = json.load(f)['bucket']['strategies']
+            if counts.get('b') and counts['a']['tries'] == 2:
+                break
+        except (FileNotFoundError, KeyError):
+            pass
+        time.sleep(0.02)
+    assert counts['a'] == {'tries': 2, 'wins': 1, 'score': 1.0, 'ms': 2.0}
+    assert counts['b']['wins'] == 1
+
+    # A reader started now sees both
+    assert StrategyScheduler(path).stats()['buckets']['bucket']['strategies']['a']['tries'] == 2
+
+
+def test_failed_save_is_retried(tmp_path):
+    path = str(tmp_path / 'missing' / 'stats.json')
+    scheduler = StrategyScheduler(path, save_interval=0.02)
+    scheduler.record('bucket', [('a', 1.0)], 'a')
+    time.sleep(0.1)
+    # The counts were kept, and the saver tries again once the file can be written
+    assert scheduler.stats()['buckets']['bucket']['strategies']['a']['tries'] == 1
+    os.makedirs(tmp_path / 'missing')
+    deadline = time.monotonic() + 5
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert os.path.exists(path)
+
+
+@pytest.fixture
+def page():
+    image = np.full((480, 640, 3), 40, dtype=np.uint8)
+    cv2.fillConvexPoly(image, np.array([[120, 80], [520, 100], [500, 400], [140, 380]]), (235, 235, 235))
+    return image
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = StrategyScheduler(explore=0.0, fixed=app.FALLBACK_STRATEGIES)
+    monkeypatch.setattr(app, 'strategy_scheduler', scheduler)
+    monkeypatch.setattr(app, 'ADAPTIVE_ORDER', True)
+    return scheduler
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_fallback_against_engine_order(page, scheduler, concurrent):
+    names = [name for name, _ in app.engine_strategies('contour')]
+    stats = {}
+    app.find_document_corners(page, stats=stats, engine='contour')
+    assert (stats['strategy'], stats['fallback']) == (names[0], False)
+
+    # Promote the engine's second strategy in this image's bucket
+    bucket = app.strategy_bucket('contour', app.DetectionStages(page), {})
+    for _ in range(20):
+        scheduler.record(bucket, [(names[0], 1.0)], None)
+        scheduler.record(bucket, [(names[1], 1.0)], names[1])
+    assert scheduler.order(bucket, names)[0][0] == names[1]
+
+    stats = {}
+    assert app.find_document_corners(page, stats=stats, engine='contour', concurrent=concurrent) is not None
+    # Winning first in the adaptive order is still a fallback of the engine
+    assert stats['strategy'] == names[1]
+    assert stats['order'] == 'adaptive'
+    assert stats['fallback'] is True
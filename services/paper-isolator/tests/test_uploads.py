@@ -0,0 +1,152 @@
+"""
+Streaming JSON body parsing: the image decodes the same however the body is chunked
+"""
+import base64
+import io
+import json
+
+import pytest
+
+import uploads
+from uploads import BadRequest, BodyTooLarge, _Base64Sink, read_json_image
+
+IMAGE = bytes(range(256)) * 3 + b'tail'
+ENCODED = base64.b64encode(IMAGE)
+
+
+def parse(body, chunk_bytes=7, length=..., max_bytes=0, monkeypatch=None):
+    if monkeypatch is not None:
+        monkeypatch.setattr(uploads, 'CHUNK_BYTES', chunk_bytes)
+    return read_json_image(io.BytesIO(body), len(body) if length is ... else length, max_bytes)
+
+
+def sink_decode(text, chunk_bytes, length=None):
+    sink = _Base64Sink(length)
+    for start in range(0, len(text), chunk_bytes):
+        sink.write(text[start:start + chunk_bytes])
+    return bytes(sink.finish())
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 2, 3, 5, 64, 1 << 20])
+def test_sink_chunk_boundaries(chunk_bytes):
+    assert sink_decode(ENCODED, chunk_bytes) == IMAGE
+    assert sink_decode(ENCODED, chunk_bytes, length=len(ENCODED)) == IMAGE
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 2, 3, 7])
+def test_sink_split_escapes(chunk_bytes):
+    # JSON encoders may escape '/' and wrap lines with escaped newlines
+    text = ENCODED.replace(b'/', b'\\/')
+    text = b'\\n'.join(text[i:i + 76] for i in range(0, len(text), 76)) + b'\\r\\n'
+    assert sink_decode(text, chunk_bytes) == IMAGE
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 3, 1 << 20])
+def test_sink_whitespace(chunk_bytes):
+    text = b' \n'.join(ENCODED[i:i + 5] for i in range(0, len(ENCODED), 5)) + b'\t'
+    assert sink_decode(text, chunk_bytes) == IMAGE
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 4, 1 << 20])
+@pytest.mark.parametrize('header', [b'data:image/jpeg;base64,', b'data:image\\/png;base64,', b'data:;base64,'])
+def test_sink_data_url(chunk_bytes, header):
+    assert sink_decode(header + ENCODED, chunk_bytes) == IMAGE
+
+
+@pytest.mark.parametrize('text', [
+    b'data:image/jpeg,' + ENCODED,                   # not base64
+    b'data:image/jpeg;base64',                       # header never ends
+    b'data:' + b'x' * uploads.MAX_DATA_URL_HEADER + b';base64,' + ENCODED,
+    b'QUJD\\u0044',                                  # unicode escapes are not decoded
+    b'QUJD\\',                                       # escape cut off by the end of the string
+    b'QUJDR',                                        # a lone 6 bit character
+])
+def test_sink_invalid(text):
+    with pytest.raises(BadRequest):
+        sink_decode(text, 3)
+
+
+def test_sink_short_image():
+    # Prefixes of "data:" are plain base64 when the string ends there
+    assert sink_decode(b'da', 1) == base64.b64decode(b'da==')
+    assert sink_decode(b'', 1) == b''
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 2, 7, 1 << 20])
+def test_json_chunk_boundaries(monkeypatch, chunk_bytes):
+    body = json.dumps({'output_dpi': 150, 'image': ENCODED.decode(), 'note': 'a "quoted" image: x'}).encode()
+    data = parse(body, chunk_bytes, monkeypatch=monkeypatch)
+    assert bytes(data['image']) == IMAGE
+    assert data['output_dpi'] == 150
+    assert data['note'] == 'a "quoted" image: x'
+
+
+@pytest.mark.parametrize('length', [..., None])
+def test_json_whitespace_and_data_url(monkeypatch, length):
+    body = (b'\r\n {\n  "image" :\t "data:image/jpeg;base64,' + ENCODED[:100] + b'\\n' + ENCODED[100:]
+            + b'" ,\n  "detect_engine" : "fast"\n}\n')
+    data = parse(body, 5, length=length, monkeypatch=monkeypatch)
+    assert bytes(data['image']) == IMAGE
+    assert data['detect_engine'] == 'fast'
+
+
+def test_json_key_order(monkeypatch):
+    # The image is found after other fields, and only as a top level key
+    body = json.dumps({
+        'options': {'image': 'not decoded'},
+        'label': 'image',
+        'image': ENCODED.decode(),
+    }).encode()
+    data = parse(body, 3, monkeypatch=monkeypatch)
+    assert bytes(data['image']) == IMAGE
+    assert data['options'] == {'image': 'not decoded'}
+    assert data['label'] == 'image'
+
+
+def test_json_without_image(monkeypatch):
+    assert parse(b'{"a": [1, {"b": "c"}]}', 2, monkeypatch=monkeypatch) == {'a': [1, {'b': 'c'}]}
+    data = parse(b'{"image": 5}', 2, monkeypatch=monkeypatch)
+    assert data == {'image': 5}
+
+
+def test_json_duplicate_key(monkeypatch):
+    body = b'{"image": "' + ENCODED + b'", "image": "QUJD"}'
+    with pytest.raises(BadRequest, match='Duplicate'):
+        parse(body, 16, monkeypatch=monkeypatch)
+
+
+@pytest.mark.parametrize('max_bytes, chunk_bytes', [(200, 7), (200, 64), (1000, 1 << 20)])
+def test_json_limit_mid_token(monkeypatch, max_bytes, chunk_bytes):
+    body = b'{"image": "' + ENCODED + b'"}'
+    # Declared length over the limit is refused before reading
+    with pytest.raises(BodyTooLarge):
+        parse(body, chunk_bytes, max_bytes=max_bytes, monkeypatch=monkeypatch)
+    # A chunked upload is stopped once the limit is crossed, inside the image string
+    stream = io.BytesIO(body)
+    monkeypatch.setattr(uploads, 'CHUNK_BYTES', chunk_bytes)
+    with pytest.raises(BodyTooLarge):
+        read_json_image(stream, None, max_bytes)
+    assert stream.tell() <= max_bytes + chunk_bytes
+
+
+def test_json_fields_limit(monkeypatch):
+    body = json.dumps({'image': 'QUJD', 'pad': 'x' * uploads.MAX_FIELDS_BYTES}).encode()
+    with pytest.raises(BadRequest, match='exceed'):
+        parse(body, 1 << 20, monkeypatch=monkeypatch)
+
+
+@pytest.mark.parametrize('cut', [1, 20, 200, -2, -1])
+def test_json_truncated(monkeypatch, cut):
+    body = b'{"image": "' + ENCODED + b'", "detect_engine": "fast"}'
+    # Content-Length promises the whole body, the stream ends early
+    with pytest.raises(BadRequest):
+        parse(body[:cut], 7, length=len(body), monkeypatch=monkeypatch)
+    # Without a length the document itself is incomplete
+    with pytest.raises(BadRequest):
+        parse(body[:cut], 7, length=None, monkeypatch=monkeypatch)
+
+
+@pytest.mark.parametrize('body', [b'', b'[1, 2]', b'"image"', b'{"image": "QUJD"', b'{"image": "QUJD"} x'])
+def test_json_invalid(monkeypatch, body):
+    with pytest.raises(BadRequest):
+        parse(body, 3, length=None, monkeypatch=monkeypatch)
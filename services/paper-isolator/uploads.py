@@ -0,0 +1,283 @@
+"""
+Request bodies read as streams, with size limits enforced while reading
+
+request.get_json() buffers the whole body, json.loads() copies the base64
+text into a str and b64decode() makes a third, binary copy, all before the
+image header has even been looked at. read_json_image instead reads the
+body in chunks and decodes the "image" string straight into one buffer
+allocated up front (3/4 of Content-Length bounds the decoded size). Only
+the small remainder of the document (the option fields) goes through
+json.loads.
+
+Both readers stop at max_bytes, before reading the rest of an oversized
+upload, and raise BodyTooLarge.
+"""
+import binascii
+import json
+
+CHUNK_BYTES = 1024 * 1024
+
+# JSON outside the image string (option fields) is parsed in memory, keep it small
+MAX_FIELDS_BYTES = 64 * 1024
+
+_WHITESPACE = b' \t\r\n'
+_SPACES = tuple(_WHITESPACE[i:i + 1] for i in range(len(_WHITESPACE)))
+
+# "image" may be a data URL (data:image/jpeg;base64,...), its header is skipped
+_DATA_URL = b'data:'
+MAX_DATA_URL_HEADER = 256
+
+
+class BodyTooLarge(ValueError):
+    """The request body or the image in it exceeds the configured limit"""
+
+
+class BadRequest(ValueError):
+    """The request is malformed or asks for something invalid, a client error"""
+
+
+def _read(stream, size):
+    """Up to size bytes from a WSGI input stream, b'' at the end"""
+    return stream.read(size) or b''
+
+
+def read_stream(stream, length, max_bytes):
+    """
+    Read a whole body into a single preallocated buffer
+
+    Args:
+        stream: WSGI input stream
+        length: Content-Length, None for a chunked upload of unknown size
+        max_bytes: Largest body accepted, 0 for no limit
+
+    Returns:
+        bytearray that np.frombuffer can wrap without copying
+    """
+    if length is None:
+        # Chunked upload: grow the buffer, but never past the limit
+        body = bytearray()
+        while True:
+            chunk = _read(stream, CHUNK_BYTES)
+            if not chunk:
+                return body
+            body += chunk
+            if max_bytes and len(body) > max_bytes:
+                raise BodyTooLarge(f'Request body exceeds {max_bytes} bytes')
+
+    if max_bytes and length > max_bytes:
+        raise BodyTooLarge(f'Request body of {length} bytes exceeds {max_bytes} bytes')
+
+    body = bytearray(length)
+    view = memoryview(body)
+    received = 0
+    while received < length:
+        if hasattr(stream, 'readinto'):
+            count = stream.readinto(view[received:])
+        else:
+            # Some servers (gunicorn) hand over a plain file-like body
+            chunk = _read(stream, min(length - received, CHUNK_BYTES))
+            count = len(chunk)
+            view[received:received + count] = chunk
+        if not count:
+            break
+        received += count
+
+    if received < length:
+        raise BadRequest(f"Request body truncated: {received} of {length} bytes")
+    return body
+
+
+class _Base64Sink:
+    """Incremental base64 decoder writing into one buffer"""
+
+    def __init__(self, length):
+        # Decoded data is at most 3/4 of the base64 text, itself shorter than the body
+        self.buffer = bytearray(length * 3 // 4 + 3) if length is not None else bytearray()
+        self.size = 0
+        self._carry = b''
+        self._escape = False
+        self._head = b''     # start of the string, until it is known whether it is a data URL
+
+    def write(self, text):
+        if self._escape:
+            text = b'\\' + text
+            self._escape = False
+        if b'\\' in text:
+            if text.endswith(b'\\') and not text.endswith(b'\\\\'):
+                # Escape split across two chunks
+                text, self._escape = text[:-1], True
+            # Encoders may escape the base64 '/' and wrap lines
+            text = text.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+            if b'\\' in text:
+                raise BadRequest('Unsupported escape sequence in "image"')
+        # Line wrapped base64 would otherwise shift the 4 character groups
+        # (memchr scans, cheaper than always copying through translate)
+        if any(space in text for space in _SPACES):
+            text = text.translate(None, _WHITESPACE)
+        if self._head is not None:
+            text = self._skip_data_url(self._head + text)
+            if text is None:
+                return
+
+        text = self._carry + text
+        usable = len(text) - len(text) % 4
+        self._carry = text[usable:]
+        if usable:
+            self._put(self._decode(text[:usable]))
+
+    def _skip_data_url(self, text):
+        """text without its data URL header, None while the header is incomplete"""
+        if not text.startswith(_DATA_URL[:len(text)]):
+            self._head = None
+            return text
+        comma = text.find(b',')
+        if comma < 0:
+            if len(text) > MAX_DATA_URL_HEADER:
+                raise BadRequest('Invalid data URL in "image"')
+            self._head = text
+            return None
+        if not text[:comma].endswith(b';base64'):
+            raise BadRequest('Data URL in "image" must be base64')
+        self._head = None
+        return text[comma + 1:]
+
+    @staticmethod
+    def _decode(text):
+        try:
+            return binascii.a2b_base64(text)
+        except binascii.Error as e:
+            raise BadRequest(f'Invalid base64 in "image": {e}') from None
+
+    def _put(self, data):
+        end = self.size + len(data)
+        if end > len(self.buffer):
+            self.buffer += bytes(end - len(self.buffer))
+        self.buffer[self.size:end] = data
+        self.size = end
+
+    def finish(self):
+        if self._escape:
+            raise BadRequest('Unsupported escape sequence in "image"')
+        if self._head:
+            if self._head.startswith(_DATA_URL):
+                raise BadRequest('Invalid data URL in "image"')
+            # Shorter than "data:", plain base64 after all
+            self._carry, self._head = self._head, None
+        if self._carry:
+            # Unpadded tail
+            self._put(self._decode(self._carry + b'=' * (-len(self._carry) % 4)))
+        return memoryview(self.buffer)[:self.size]
+
+
+def read_json_image(stream, length, max_bytes, field='image'):
+    """
+    Parse a JSON object body, decoding its base64 image field while reading
+
+    Args:
+        stream: WSGI input stream
+        length: Content-Length, None for a chunked upload of unknown size
+        max_bytes: Largest body accepted, 0 for no limit
+        field: Top level key holding the base64 image
+
+    Returns:
+        The parsed object; data[field], when present as a string, is the
+        decoded image as a memoryview over the preallocated buffer
+
+    Raises:
+        BodyTooLarge: The body exceeds max_bytes
+        BadRequest: The body is truncated or not a JSON object, the image
+            field appears twice, or the fields other than the image exceed
+            MAX_FIELDS_BYTES
+    """
+    if max_bytes and length is not None and length > max_bytes:
+        raise BodyTooLarge(f'Request body of {length} bytes exceeds {max_bytes} bytes')
+
+    key = json.dumps(field).encode('utf-8')
+    fields = bytearray()     # the document with the image string left empty
+    sink = None
+    image = None
+    depth = 0
+    in_string = escape = False
+    string_start = 0
+    last_string = None       # last complete string, while only whitespace followed it
+    expect_image = False
+    received = 0
+
+    while True:
+        chunk = _read(stream, CHUNK_BYTES)
+        if not chunk:
+            break
+        received += len(chunk)
+        if max_bytes and received > max_bytes:
+            raise BodyTooLarge(f'Request body exceeds {max_bytes} bytes')
+
+        pos = 0
+        while pos < len(chunk):
+            if sink is not None:
+                # Inside the image string: hand whole runs to the decoder
+                end = chunk.find(b'"', pos)
+                if end < 0:
+                    sink.write(chunk[pos:])
+                    break
+                sink.write(chunk[pos:end])
+                image = sink.finish()
+                sink = None
+                fields += b'"'
+                pos = end + 1
+                continue
+
+            byte = chunk[pos:pos + 1]
+            pos += 1
+            if in_string:
+                fields += byte
+                if escape:
+                    escape = False
+                elif byte == b'\\':
+                    escape = True
+                elif byte == b'"':
+                    in_string = False
+                    last_string = bytes(fields[string_start:])
+                continue
+
+            if expect_image and byte not in _WHITESPACE:
+                expect_image = False
+                if byte == b'"':
+                    if image is not None:
+                        # json.loads keeps the last value, the decoded image would be the first
+                        raise BadRequest(f'Duplicate "{field}" key')
+                    fields += byte
+                    sink = _Base64Sink(length)
+                    continue
+
+            fields += byte
+            if byte == b'"':
+                in_string = True
+                string_start = len(fields) - 1
+            elif byte in b'{[':
+                depth += 1
+                last_string = None
+            elif byte in b'}]':
+                depth -= 1
+                last_string = None
+            elif byte == b':':
+                expect_image = depth == 1 and last_string == key
+                last_string = None
+            elif byte not in _WHITESPACE:
+                last_string = None
+
+            if len(fields) > MAX_FIELDS_BYTES:
+                raise BadRequest(f'JSON fields other than "{field}" exceed {MAX_FIELDS_BYTES} bytes')
+
+    if length is not None and received < length:
+        raise BadRequest(f"Request body truncated: {received} of {length} bytes")
+    if sink is not None:
+        raise BadRequest(f'Unterminated "{field}" string')
+    try:
+        data = json.loads(bytes(fields))
+    except ValueError as e:
+        raise BadRequest(f'Invalid JSON body: {e}') from None
+    if not isinstance(data, dict):
+        raise BadRequest('Request body must be a JSON object')
+    if image is not None:
+        data[field] = image
+    return data